@@ -0,0 +1,189 @@
+# Content-addressed action cache for the generated project.yaml: each action is hashed on its run command (definition and parameters
+# such as --start-date, --intervals and --disease), the source of its script and local imports, the codelists it reads and the
+# hashes of the actions whose outputs it reads. Hashes are saved to action_manifest.json; an action is skippable when its
+# hash is unchanged and all its outputs were written after that hash was first recorded.
+
+import ast
+import functools
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+
+from disease_registry import codelists_module_path, registry
+
+manifest_path = Path("action_manifest.json")
+
+# Codelists read by every cohort/measures action, whatever the disease
+shared_codelists = ["ethnicity_codes"]
+
+def hash_bytes(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+# Actions in generated project.yaml text: name -> run command, needs and output paths
+def parse_actions(yaml_text):
+    actions = {}
+    current = None
+    section = None
+    for line in yaml_text.splitlines():
+        action_match = re.match(r"^  (\w+):\s*$", line)
+        if action_match:
+            current = actions.setdefault(action_match.group(1), {"run": "", "needs": [], "outputs": []})
+            section = None
+            continue
+        if current is None or line.lstrip().startswith("#"):
+            continue
+        stripped = line.strip()
+        if stripped.startswith("run:"):
+            current["run"] = stripped[len("run:"):].strip()
+            section = "run"
+        elif stripped.startswith("needs:"):
+            current["needs"] = [need.strip() for need in stripped[len("needs:"):].strip(" []").split(",") if need.strip()]
+            section = None
+        elif stripped.startswith("outputs:"):
+            section = "outputs"
+        elif section == "run" and stripped:
+            current["run"] += " " + stripped
+        elif section == "outputs" and re.match(r"^\w+:\s*\S+", stripped) and not stripped.endswith(":"):
+            current["outputs"].append(stripped.split(":", 1)[1].strip())
+    return actions
+
+# Generated project.yaml text split into the header and one block of text per action, in file order
+def action_blocks(yaml_text):
+    blocks = re.split(r"(?m)^(?=  \w+:\s*$)", yaml_text)
+    return blocks[0], {re.match(r"  (\w+):", block).group(1): block for block in blocks[1:]}
+
+# Action block with arguments added to the end of its run command (after the "--" that ehrQL passes arguments to the definition after)
+def append_run_args(block, arguments):
+    run = re.search(r"(?m)^    run: .*(?:\n      .*)*", block)
+    separator = "\n      --" if run.group(0).startswith("    run: ehrql:") and not re.search(r"(?m)^      --$", run.group(0)) else ""
+    return block[: run.end()] + f"{separator}\n      {arguments}" + block[run.end():]
+
+# Generated project.yaml text with arguments added to every ehrQL action (e.g. a study end date read by every definition), except
+# actions already given the option (e.g. the earlier end date of the measures an incremental refresh extends)
+def add_definition_args(yaml_text, arguments):
+    option = arguments.split()[0]
+    header, blocks = action_blocks(yaml_text)
+    for name, block in blocks.items():
+        run = re.search(r"(?m)^    run: .*(?:\n      .*)*", block)
+        if re.search(r"(?m)^    run: ehrql:", block) and not re.search(rf"(?m)^      {re.escape(option)}\b", run.group(0)):
+            blocks[name] = append_run_args(block, arguments)
+    return header + "".join(blocks.values())
+
+# Script run by an action (e.g. analysis/dataset_definition_measures.py)
+def action_script(run):
+    match = re.search(r"(analysis/\S+\.(?:py|do|R))", run)
+    return Path(match.group(1)) if match else None
+
+# Modules imported by a Python script (parsed once per script, as every action running it asks again)
+@functools.lru_cache(maxsize=None)
+def imported_modules(script):
+    names = []
+    for node in ast.walk(ast.parse(script.read_text())):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names.append(node.module)
+    return tuple(name.split(".")[-1] for name in names)
+
+# Python script and the local modules it imports (recursively), e.g. dataset_definition.py and codelists_ehrQL.py
+def local_sources(script, seen=None):
+    seen = set() if seen is None else seen
+    if script in seen or not script.exists():
+        return seen
+    seen.add(script)
+    if script.suffix != ".py":
+        return seen
+    for module in imported_modules(script):
+        local_sources(script.parent / f"{module}.py", seen)
+    return seen
+
+# Codelist name -> CSV files it is built from, following combined codelists (e.g. asthma_snomed = asthma_diag + asthma_emerg)
+def codelist_files(module_path=codelists_module_path):
+    dependencies = {}
+    for node in ast.parse(Path(module_path).read_text()).body:
+        if not (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)):
+            continue
+        files = set()
+        for child in ast.walk(node.value):
+            if isinstance(child, ast.Call) and getattr(child.func, "id", None) == "codelist_from_csv":
+                files.add(child.args[0].value)
+            elif isinstance(child, ast.Name):
+                files |= dependencies.get(child.id, set())
+        dependencies[node.targets[0].id] = files
+    return dependencies
+
+# Diseases an action runs for (--disease/--diseases arguments), or None for all diseases
+def action_diseases(run):
+    match = re.search(r'--diseases? "([^"]+)"', run)
+    return match.group(1).split(",") if match else None
+
+# Codelist CSVs read by a cohort/measures action
+def action_codelists(run, diseases, dependencies):
+    names = list(shared_codelists)
+    for disease in action_diseases(run) or diseases:
+        names += list(registry[disease].codelists.values())
+    return sorted(set().union(*[dependencies.get(name, set()) for name in names]))
+
+# Whether an action reads the outputs of an action it needs: ehrQL actions only read outputs passed in their arguments (e.g. the
+# features table with --features), not the cohort their needs produce; processing stages read their needs' cohort/measures files
+def reads_outputs(action, need):
+    if not action["run"].startswith("ehrql:"):
+        return True
+    return any(output in action["run"] for output in need["outputs"])
+
+# Hash of every action's inputs (in dependency order, so upstream hashes of the outputs an action reads feed into its hash)
+def action_hashes(actions, diseases):
+    dependencies = codelist_files()
+    hashes = {}
+    inputs = {}
+
+    def visit(name):
+        if name in hashes:
+            return hashes[name]
+        action = actions[name]
+        script = action_script(action["run"])
+        sources = sorted(local_sources(script)) if script else []
+        files = [str(path) for path in sources]
+        if action["run"].startswith("ehrql:"):
+            files += action_codelists(action["run"], diseases, dependencies)
+        needs = [visit(need) for need in action["needs"] if need in actions and reads_outputs(action, actions[need])]
+        inputs[name] = files
+        hashes[name] = hash_bytes(action["run"], *[Path(path).read_bytes() for path in files], *needs)
+        return hashes[name]
+
+    for name in actions:
+        visit(name)
+    return hashes, inputs
+
+# All outputs exist and were written at or after a time
+def outputs_current(outputs, since):
+    paths = [path for pattern in outputs for path in glob.glob(pattern)]
+    return bool(outputs) and all(glob.glob(pattern) for pattern in outputs) and all(os.path.getmtime(path) >= since for path in paths)
+
+# Update action_manifest.json for generated project.yaml text and return it
+def update_manifest(yaml_text, diseases, path=manifest_path):
+    actions = parse_actions(yaml_text)
+    hashes, inputs = action_hashes(actions, diseases)
+    previous = json.loads(Path(path).read_text())["actions"] if Path(path).exists() else {}
+    now = time.time()
+    manifest = {}
+    for name, action in actions.items():
+        unchanged = name in previous and previous[name]["hash"] == hashes[name]
+        hashed_at = previous[name]["hashed_at"] if unchanged else now
+        manifest[name] = {
+            "hash": hashes[name],
+            "hashed_at": hashed_at,
+            "inputs": inputs[name],
+            "outputs": action["outputs"],
+            "skippable": unchanged and outputs_current(action["outputs"], hashed_at),
+        }
+    Path(path).write_text(json.dumps({"actions": manifest}, indent=2) + "\n")
+    return manifest
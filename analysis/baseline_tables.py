@@ -0,0 +1,230 @@
+# Baseline tables of the demographics cohort in one streamed pass, replacing 000_baseline_data_reference_all.do and
+# 001_baseline_data_diseases.do (which load the whole cohort, then collapse and re-save a table once per variable and disease).
+# Counts by IMD quintile, ethnicity, gender and age band, and mean/SD age, of the reference population and each incident disease
+# cohort are accumulated chunk by chunk (running means and variances merged with Chan's parallel update), so memory is bounded by the
+# chunk size and the number of strata. Writes the same rounded and redacted tables:
+#  - output/tables/reference_table_rounded_all.csv (reference population, age bands at study midpoint)
+#  - output/tables/baseline_table_rounded.csv (each disease, age bands at diagnosis)
+#
+#   python analysis/baseline_tables.py --input output/dataset_definition_demographics_disease.arrow
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from disease_registry import disease_names
+from instrumentation import recorder
+from read_outputs import output_extensions, read_chunks
+
+tables_dir = Path("output/tables")
+cohort_stem = "output/dataset_definition_demographics_disease"
+reference_table = "reference_table_rounded_all.csv"
+baseline_table = "baseline_table_rounded.csv"
+
+# Categories of each variable, in the order of the do-files' value labels (values outside them are missing)
+imd_categories = ["1 (most deprived)", "2", "3", "4", "5 (least deprived)", "Unknown"]
+ethnicity_categories = ["White", "Asian or Asian British", "Black or Black British", "Mixed", "Chinese or Other Ethnic Groups", "Unknown"]
+gender_categories = ["Female", "Male"]
+age_band_categories = ["0 to 9", "10 to 19", "20 to 29", "30 to 39", "40 to 49", "50 to 59", "60 to 69", "70 to 79", "80 or above"]
+
+# Variable label and categories of each table variable (the missing category, decoded by Stata as "", is the last code)
+variables = {
+    "imd": ("Index of multiple deprivation", imd_categories),
+    "ethnicity": ("Ethnicity", ethnicity_categories),
+    "gender": ("Gender", gender_categories),
+    "age_band": ("Age band, years", age_band_categories),
+}
+n_codes = max(len(categories) for _, categories in variables.values()) + 1
+
+# Age at study midpoint (August 2020) from age at index date
+midpoint_offset = 4.38
+
+columns = ["cohort", "year", "variable", "categories", "mean_age", "stdev_age", "count", "total", "percent"]
+
+# Running count, mean and sum of squared deviations of a value for each cohort
+class RunningStats:
+    def __init__(self, size):
+        self.n = np.zeros(size)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+
+    # Merge the statistics of a chunk (values: rows x cohorts, NaN where a row is not in the cohort or has no value)
+    def update(self, values):
+        valid = ~np.isnan(values)
+        n = valid.sum(axis=0).astype(float)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(n > 0, np.nansum(values, axis=0) / n, 0.0)
+        m2 = np.nansum((values - mean) ** 2, axis=0)
+        total = self.n + n
+        delta = mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.mean = np.where(total > 0, self.mean + delta * n / total, 0.0)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta ** 2 * self.n * n / total, 0.0)
+        self.n = total
+
+    # Sample standard deviation (missing for fewer than two values, as Stata's collapse (sd))
+    def sd(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.n > 1, np.sqrt(self.m2 / (self.n - 1)), np.nan)
+
+# Per-cohort accumulators: cohort 0 is the reference population, cohort i the incident cases of the i-th disease
+class BaselineCounts:
+    def __init__(self, diseases):
+        self.diseases = diseases
+        self.counts = np.zeros((len(diseases) + 1, len(variables), n_codes), dtype=np.int64)
+        self.rows = np.zeros(len(diseases) + 1, dtype=np.int64)
+        self.age = RunningStats(len(diseases) + 1)
+        self.rows_read = 0
+
+    def update(self, chunk):
+        self.rows_read += len(chunk)
+        chunk = chunk[chunk["sex"].isin(["female", "male"])]
+        n = len(chunk)
+        if n == 0:
+            return
+        # Membership (rows x cohorts) and age (age at index date plus offset, or age at diagnosis) of each cohort
+        members = np.ones((n, len(self.diseases) + 1), dtype=bool)
+        ages = np.empty((n, len(self.diseases) + 1))
+        ages[:, 0] = numeric(chunk["age"]) + midpoint_offset
+        for index, disease in enumerate(self.diseases, start=1):
+            age = numeric(chunk[f"{disease}_age"])
+            members[:, index] = (
+                flag(chunk[f"{disease}_inc_case"]) & (age >= 0) & flag(chunk[f"{disease}_pre_reg"]) & flag(chunk[f"{disease}_alive_inc"])
+            )
+            ages[:, index] = age
+        ages[~members] = np.nan
+        self.rows += members.sum(axis=0)
+        self.age.update(ages)
+
+        # Shared variables: one indicator matrix per variable, counted for every cohort in one product
+        codes = {
+            "imd": category_codes(chunk["imd_quintile"], imd_categories),
+            "ethnicity": category_codes(chunk["ethnicity"], ethnicity_categories),
+            "gender": category_codes(chunk["sex"], ["female", "male"]),
+        }
+        for position, name in enumerate(variables):
+            if name in codes:
+                indicators = np.zeros((n, n_codes))
+                indicators[np.arange(n), codes[name]] = 1
+                self.counts[:, position, :] += (members.T.astype(float) @ indicators).astype(np.int64)
+        # Age bands differ by cohort (midpoint or diagnosis), so are counted from the flattened (cohort, band) codes of members
+        bands = age_band_codes(ages, len(age_band_categories))
+        cohorts = np.broadcast_to(np.arange(ages.shape[1]), ages.shape)
+        flat = np.bincount((cohorts * n_codes + bands)[members], minlength=ages.shape[1] * n_codes)
+        self.counts[:, list(variables).index("age_band"), :] += flat.reshape(ages.shape[1], n_codes)
+
+# Rows of T/F (or bool) flags that are true (missing values false)
+def flag(values):
+    return values.astype(object).isin([True, "T"]).to_numpy()
+
+def numeric(values):
+    return pd.to_numeric(values, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+
+# Index of each value in categories, or the missing code
+def category_codes(values, categories):
+    codes = pd.Index(categories).get_indexer(values.astype(object))
+    return np.where(codes < 0, n_codes - 1, codes)
+
+# Ten-year age band index (last band open-ended), or the missing code for missing or negative ages
+def age_band_codes(ages, bands):
+    with np.errstate(invalid="ignore"):
+        codes = np.minimum(np.floor(ages / 10), bands - 1)
+    return np.where(np.isnan(ages) | (ages < 0), n_codes - 1, codes).astype(np.int64)
+
+# Stata's round(x, unit)
+def round_to(values, unit):
+    return np.floor(np.asarray(values, dtype=float) / unit + 0.5) * unit
+
+# Rows of one cohort's table, in the order the do-files append them (mean age first, then variables in reverse order)
+def cohort_rows(counts, rows, age_n, mean_age, stdev_age, cohort, year, age_variable, percent_unit):
+    table = []
+    # Mean and SD age: counts rounded to 5, all values redacted if the rounded count is <=7
+    count = round_to(rows, 5)
+    redacted = count <= 7
+    table.append({
+        "cohort": cohort, "year": year, "variable": age_variable, "categories": "Not applicable",
+        "mean_age": np.nan if redacted or age_n == 0 else mean_age,
+        "stdev_age": np.nan if redacted else stdev_age,
+        "count": np.nan if redacted else count, "total": np.nan if redacted else count, "percent": np.nan,
+    })
+    for position, (label, categories) in reversed(list(enumerate(variables.values()))):
+        # Categories present in the cohort (contract), counts rounded to 5 and totalled before redaction
+        present = np.flatnonzero(counts[position])
+        rounded = round_to(counts[position][present], 5)
+        total = rounded.sum()
+        for code, count in zip(present, rounded):
+            redacted = count <= 7
+            percent = round_to(count / total * 100, percent_unit) if total > 0 else np.nan
+            table.append({
+                "cohort": cohort, "year": year, "variable": label,
+                "categories": categories[code] if code < len(categories) else "",
+                "mean_age": np.nan, "stdev_age": np.nan,
+                "count": np.nan if redacted else count, "total": np.nan if redacted else total,
+                "percent": np.nan if redacted else percent,
+            })
+    return table
+
+def build_tables(accumulated):
+    sd = accumulated.age.sd()
+    values = lambda index: (accumulated.counts[index], accumulated.rows[index], accumulated.age.n[index], accumulated.age.mean[index], sd[index])
+    reference = pd.DataFrame(
+        cohort_rows(*values(0), "Reference population", "2016 to 2024", "Mean age, years", 0.0001), columns=columns
+    )
+    # Later diseases first, as each disease's rows are appended above the previous ones; percentages rounded to whole numbers
+    # (001_baseline_data_diseases.do rounds to 0001, i.e. 1)
+    baseline = []
+    for index, disease in reversed(list(enumerate(accumulated.diseases, start=1))):
+        baseline += cohort_rows(*values(index), disease, None, "Age", 1)
+    baseline = pd.DataFrame(baseline, columns=columns).drop(columns="year")
+    return {reference_table: reference, baseline_table: baseline}
+
+# Tables as written by Stata's export delimited with display formats (%14.0f counts, %14.4f ages and percentages, missing empty)
+def formatted(table):
+    table = table.copy()
+    for column in ["count", "total"]:
+        table[column] = table[column].map(lambda value: "" if pd.isna(value) else f"{value:.0f}")
+    for column in ["mean_age", "stdev_age", "percent"]:
+        table[column] = table[column].map(lambda value: "" if pd.isna(value) else f"{value:.4f}")
+    return table
+
+def accumulate(path, diseases, chunk_size=100000):
+    accumulated = BaselineCounts(diseases)
+    usecols = ["sex", "age", "ethnicity", "imd_quintile"] + [
+        f"{disease}_{suffix}" for disease in diseases for suffix in ["inc_case", "age", "pre_reg", "alive_inc"]
+    ]
+    for chunk in read_chunks(path, chunk_size, columns=usecols, string_columns=["sex", "ethnicity", "imd_quintile"]):
+        accumulated.update(chunk)
+    return accumulated
+
+# Demographics cohort output in any supported format
+def cohort_path():
+    for extension in output_extensions.values():
+        if Path(cohort_stem + extension).exists():
+            return Path(cohort_stem + extension)
+    sys.exit(f"No demographics cohort output found at {cohort_stem}.*")
+
+def write_tables(tables, directory=tables_dir):
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    paths = []
+    for name, table in tables.items():
+        formatted(table).to_csv(Path(directory) / name, index=False)
+        paths.append(Path(directory) / name)
+    return paths
+
+
+if __name__ == "__main__":
+    timings = recorder()
+    parser = ArgumentParser()
+    parser.add_argument("--input", type=str, help="demographics cohort output (default: output/dataset_definition_demographics_disease.*)")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    args = parser.parse_args()
+
+    with timings.stage("accumulate"):
+        accumulated = accumulate(args.input or cohort_path(), disease_names(demographics=True), args.chunk_size)
+    tables = build_tables(accumulated)
+    paths = write_tables(tables)
+    print(f"Wrote {', '.join(map(str, paths))}")
+    timings.finish(rows_in=accumulated.rows_read, rows_out=sum(len(table) for table in tables.values()))
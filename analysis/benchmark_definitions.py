@@ -0,0 +1,294 @@
+# Benchmarks of the ehrQL definitions at realistic population sizes: synthetic TPP tables (patients, clinical_events, apcs,
+# practice_registrations, addresses, ethnicity_from_sus) are generated with typical event densities and codes drawn from the study
+# codelists, then the cohort definition, the demographics definition and one measures action are run against them with
+# --dummy-tables, recording wall time, peak RSS of the ehrQL process and rows per second in a JSON report.
+#
+# Generate synthetic tables for one population size:
+#   python analysis/benchmark_definitions.py tables 100000 output/benchmarks/tables_100000
+# Run the benchmarks (tables generated on first use; --ehrql is the command prefix, e.g. "opensafely exec ehrql:v1"):
+#   python analysis/benchmark_definitions.py run [--sizes 10000,100000,1000000] [--ehrql ehrql] [--report output/benchmarks/benchmark_report.json]
+# Compare a report with a baseline (non-zero exit status if wall time or peak RSS grew by more than --tolerance):
+#   python analysis/benchmark_definitions.py compare output/benchmarks/baseline.json output/benchmarks/benchmark_report.json
+
+import csv
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+import codelists_ehrQL as codelists
+from disease_registry import diseases
+
+benchmarks_dir = Path("output/benchmarks")
+report_path = benchmarks_dir / "benchmark_report.json"
+default_sizes = [10000, 100000, 1000000]
+
+# Mean rows per patient (clinical events and admissions over the whole record) and share of rows coded from the study codelists
+event_density = {
+    "clinical_events": 30.0,
+    "apcs": 0.8,
+    "extra_registrations": 0.5,
+    "extra_addresses": 1.0,
+}
+codelist_share = {"clinical_events": 0.2, "apcs": 0.3}
+record_start = np.datetime64("2005-01-01")
+record_end = np.datetime64("2024-11-30")
+
+# Columns of each synthetic table (TPP schema; columns the definitions do not read are left empty)
+table_columns = {
+    "patients": ["patient_id", "date_of_birth", "sex", "date_of_death"],
+    "clinical_events": ["patient_id", "date", "snomedct_code", "ctv3_code", "numeric_value", "consultation_id"],
+    "apcs": [
+        "patient_id", "apcs_ident", "admission_date", "discharge_date", "admission_method", "discharge_destination",
+        "patient_classification", "spell_core_hrg_sus", "all_diagnoses", "primary_diagnosis", "secondary_diagnosis",
+        "all_procedures", "days_in_critical_care",
+    ],
+    "practice_registrations": ["patient_id", "start_date", "end_date", "practice_pseudo_id", "practice_stp", "practice_nuts1_region_name"],
+    "addresses": [
+        "patient_id", "address_id", "start_date", "end_date", "address_type", "rural_urban_classification", "imd_rounded",
+        "msoa_code", "has_postcode", "care_home_is_potential_match", "care_home_requires_nursing", "care_home_does_not_require_nursing",
+    ],
+    "ethnicity_from_sus": ["patient_id", "code"],
+}
+
+# Benchmarked actions: name -> (ehrQL command, definition, arguments after --)
+targets = {
+    "dataset_definition": ("generate-dataset", "analysis/dataset_definition.py", []),
+    "dataset_definition_demographics_disease": ("generate-dataset", "analysis/dataset_definition_demographics_disease.py", []),
+    "measures_asthma_2016": (
+        "generate-measures", "analysis/dataset_definition_measures.py", ["--start-date", "2016-04-01", "--intervals", "12", "--disease", "asthma"],
+    ),
+}
+
+# Patients generated per batch (bounds memory when writing the 1M-patient tables)
+batch_size = 50000
+
+# Study codes to draw from: SNOMED (diagnostic, resolved and ethnicity codes) and ICD10 (diagnostic codes)
+def study_codes():
+    snomed, icd = set(codelists.ethnicity_codes), set()
+    for disease in diseases:
+        for kind, name in disease.codelists.items():
+            (icd if kind == "icd" else snomed).update(getattr(codelists, name))
+    return sorted(snomed), sorted(icd)
+
+def random_dates(rng, size, start=record_start, end=record_end):
+    days = (end - start).astype(int)
+    return start + rng.integers(0, days, size).astype("timedelta64[D]")
+
+def date_strings(dates):
+    return np.where(np.isnat(dates), "", np.datetime_as_string(dates, unit="D"))
+
+# Codes for n rows: a share from the study codes, the rest from a pool of other codes
+def draw_codes(rng, n, study, other, share):
+    from_study = rng.random(n) < share
+    return np.where(from_study, rng.choice(study, n), rng.choice(other, n))
+
+# One batch of synthetic rows for patient ids first_id..first_id + n - 1: table name -> dict of column arrays
+def generate_batch(rng, first_id, n, snomed, icd):
+    other_snomed = np.array([str(100000000 + i) for i in range(5000)])
+    other_icd = np.array([f"Z{i:02d}{j}" for i in range(100) for j in range(10)])
+    patient_id = np.arange(first_id, first_id + n)
+
+    birth = random_dates(rng, n, np.datetime64("1920-01-01"), np.datetime64("2024-01-01")).astype("datetime64[M]").astype("datetime64[D]")
+    death = random_dates(rng, n, np.datetime64("2010-01-01"))
+    death = np.where((rng.random(n) < 0.1) & (death > birth), death, np.datetime64("NaT"))
+    batch = {
+        "patients": {
+            "patient_id": patient_id,
+            "date_of_birth": date_strings(birth),
+            "sex": rng.choice(["female", "male", "intersex", "unknown"], n, p=[0.49, 0.49, 0.01, 0.01]),
+            "date_of_death": date_strings(death),
+        },
+    }
+
+    events = rng.poisson(event_density["clinical_events"], n)
+    event_patient = np.repeat(patient_id, events)
+    batch["clinical_events"] = {
+        "patient_id": event_patient,
+        "date": date_strings(random_dates(rng, len(event_patient))),
+        "snomedct_code": draw_codes(rng, len(event_patient), snomed, other_snomed, codelist_share["clinical_events"]),
+    }
+
+    admissions = rng.poisson(event_density["apcs"], n)
+    admission_patient = np.repeat(patient_id, admissions)
+    admission_date = random_dates(rng, len(admission_patient))
+    primary = draw_codes(rng, len(admission_patient), icd, other_icd, codelist_share["apcs"])
+    batch["apcs"] = {
+        "patient_id": admission_patient,
+        "apcs_ident": np.arange(len(admission_patient)) + first_id * 10,
+        "admission_date": date_strings(admission_date),
+        "discharge_date": date_strings(admission_date + rng.integers(0, 15, len(admission_patient)).astype("timedelta64[D]")),
+        "primary_diagnosis": primary,
+        "all_diagnoses": primary,
+    }
+
+    # Consecutive registration spells, the last one current for most patients
+    spells = 1 + rng.poisson(event_density["extra_registrations"], n)
+    spell_patient = np.repeat(patient_id, spells)
+    spell_start = random_dates(rng, len(spell_patient), np.datetime64("1990-01-01"))
+    order = np.lexsort((spell_start, spell_patient))
+    spell_patient, spell_start = spell_patient[order], spell_start[order]
+    last_spell = np.append(spell_patient[1:] != spell_patient[:-1], True)
+    next_start = np.append(spell_start[1:], np.datetime64("NaT"))
+    spell_end = np.where(last_spell, np.where(rng.random(len(spell_patient)) < 0.85, np.datetime64("NaT"), random_dates(rng, len(spell_patient))), next_start)
+    spell_end = np.where(~np.isnat(spell_end) & (spell_end <= spell_start), spell_start + np.timedelta64(30, "D"), spell_end)
+    batch["practice_registrations"] = {
+        "patient_id": spell_patient,
+        "start_date": date_strings(spell_start),
+        "end_date": date_strings(spell_end),
+        "practice_pseudo_id": rng.integers(1, 6000, len(spell_patient)),
+    }
+
+    addresses = 1 + rng.poisson(event_density["extra_addresses"], n)
+    address_patient = np.repeat(patient_id, addresses)
+    address_start = random_dates(rng, len(address_patient), np.datetime64("1990-01-01"))
+    batch["addresses"] = {
+        "patient_id": address_patient,
+        "address_id": np.arange(len(address_patient)) + first_id * 10,
+        "start_date": date_strings(address_start),
+        "imd_rounded": rng.integers(0, 329, len(address_patient)) * 100,
+        "has_postcode": np.full(len(address_patient), "T"),
+    }
+
+    sus = rng.random(n) < 0.5
+    batch["ethnicity_from_sus"] = {
+        "patient_id": patient_id[sus],
+        "code": rng.choice(list("ABCDEFGHJKLMNPRS"), sus.sum()),
+    }
+    return batch
+
+# Write synthetic tables for a population size, in batches; returns rows written per table
+def generate_tables(patients, directory, seed=20240401):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    snomed, icd = study_codes()
+    files = {name: open(directory / f"{name}.csv", "w", newline="") for name in table_columns}
+    writers = {name: csv.writer(file) for name, file in files.items()}
+    rows = {name: 0 for name in table_columns}
+    try:
+        for name, writer in writers.items():
+            writer.writerow(table_columns[name])
+        for first_id in range(1, patients + 1, batch_size):
+            batch = generate_batch(rng, first_id, min(batch_size, patients + 1 - first_id), snomed, icd)
+            for name, columns in batch.items():
+                length = len(columns["patient_id"])
+                empty = np.full(length, "")
+                writers[name].writerows(zip(*[columns.get(column, empty) for column in table_columns[name]]))
+                rows[name] += length
+    finally:
+        for file in files.values():
+            file.close()
+    (directory / "tables.json").write_text(json.dumps({"patients": patients, "seed": seed, "rows": rows}, indent=2) + "\n")
+    return rows
+
+# Tables for a population size, generated unless already present for the same size
+def ensure_tables(patients):
+    directory = benchmarks_dir / f"tables_{patients}"
+    manifest = directory / "tables.json"
+    if manifest.exists() and json.loads(manifest.read_text())["patients"] == patients:
+        return directory, json.loads(manifest.read_text())["rows"]
+    return directory, generate_tables(patients, directory)
+
+# Run one command; wall time, peak RSS of its process (MB) and exit status
+def measure(command):
+    start = time.perf_counter()
+    process = subprocess.Popen(command)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return time.perf_counter() - start, usage.ru_maxrss / 1024, process.returncode
+
+# measure() in a fresh interpreter: on Linux a child's peak RSS starts from its parent's at fork, and this process holds the tables
+def timed_run(command):
+    result = benchmarks_dir / "measure.json"
+    subprocess.run([sys.executable, __file__, "measure", str(result), "--", *command], check=True)
+    wall, peak_rss, returncode = json.loads(result.read_text())
+    result.unlink()
+    return wall, peak_rss, returncode
+
+def count_rows(path):
+    if not Path(path).exists():
+        return None
+    with open(path, newline="") as f:
+        return max(sum(1 for _ in f) - 1, 0)
+
+def run_benchmarks(sizes, ehrql, report=report_path):
+    results = []
+    for patients in sizes:
+        tables, rows = ensure_tables(patients)
+        input_rows = sum(rows.values())
+        for name, (command, definition, arguments) in targets.items():
+            output = benchmarks_dir / f"{name}_{patients}.csv"
+            full_command = shlex.split(ehrql) + [command, definition, "--dummy-tables", str(tables), "--output", str(output)]
+            if arguments:
+                full_command += ["--"] + arguments
+            print(f"{name} ({patients} patients): {' '.join(full_command)}")
+            wall, peak_rss, returncode = timed_run(full_command)
+            results.append({
+                "target": name,
+                "patients": patients,
+                "input_rows": input_rows,
+                "output_rows": count_rows(output),
+                "wall_seconds": round(wall, 3),
+                "peak_rss_mb": round(peak_rss, 1),
+                "rows_per_second": round(input_rows / wall, 1) if wall else None,
+                "returncode": returncode,
+            })
+            print(f"  {wall:.1f}s, peak RSS {peak_rss:.0f} MB, {input_rows / wall:,.0f} input rows/s" + (f" (exit {returncode})" if returncode else ""))
+    Path(report).parent.mkdir(parents=True, exist_ok=True)
+    Path(report).write_text(json.dumps({"created_at": time.time(), "ehrql": ehrql, "event_density": event_density, "results": results}, indent=2) + "\n")
+    return results
+
+# Results whose wall time or peak RSS grew by more than tolerance (a fraction) against a baseline report
+def regressions(baseline, current, tolerance):
+    baseline_results = {(result["target"], result["patients"]): result for result in json.loads(Path(baseline).read_text())["results"]}
+    found = []
+    for result in json.loads(Path(current).read_text())["results"]:
+        base = baseline_results.get((result["target"], result["patients"]))
+        if base is None:
+            continue
+        for metric in ["wall_seconds", "peak_rss_mb"]:
+            if base[metric] and result[metric] > base[metric] * (1 + tolerance):
+                found.append((result["target"], result["patients"], metric, base[metric], result[metric]))
+    return found
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    tables_parser = commands.add_parser("tables")
+    tables_parser.add_argument("patients", type=int)
+    tables_parser.add_argument("directory")
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--sizes", type=str, default=",".join(map(str, default_sizes)))
+    run_parser.add_argument("--ehrql", type=str, default="ehrql")
+    run_parser.add_argument("--report", type=str, default=str(report_path))
+    measure_parser = commands.add_parser("measure")
+    measure_parser.add_argument("result")
+    measure_parser.add_argument("benchmark_command", nargs="+")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.command == "tables":
+        rows = generate_tables(args.patients, args.directory)
+        print(", ".join(f"{name}: {count}" for name, count in rows.items()))
+    elif args.command == "measure":
+        Path(args.result).write_text(json.dumps(measure(args.benchmark_command)))
+    elif args.command == "run":
+        run_benchmarks([int(size) for size in args.sizes.split(",")], args.ehrql, args.report)
+    else:
+        found = regressions(args.baseline, args.current, args.tolerance)
+        for target, patients, metric, before, after in found:
+            print(f"{target} ({patients} patients): {metric} {before} -> {after}")
+        if found:
+            sys.exit(1)
+        print("No regressions")
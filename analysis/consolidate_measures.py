@@ -0,0 +1,81 @@
+# Consolidate all measures outputs (combined or per-disease/year files, any output format) in a single pass into:
+#  - output/data/measures_consolidated/: typed Parquet table partitioned by disease, with disease, measure family and interval
+#    parsed into columns
+#  - output/data/measures_consolidated.dta: the appended measures (columns and values as in the measures CSVs) for
+#    002_processing_data.do, replacing its import/append/save loop over every measures file
+#
+#   python analysis/consolidate_measures.py [measures directory]
+
+import re
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as parquet
+
+from disease_registry import split_measure
+from instrumentation import recorder
+from read_outputs import output_files, read_table, stata_frame
+
+measures_dir = Path("output/measures")
+consolidated_dir = Path("output/data/measures_consolidated")
+consolidated_dta = Path("output/data/measures_consolidated.dta")
+
+# Measure group_by columns (see dataset_definition_measures.py)
+group_columns = ["sex", "age", "ethnicity", "imd"]
+
+# Measures output files (combined output if present, otherwise per-disease/year files, or only one disease's if given), one per stem
+# whatever the format
+def measures_inputs(directory=measures_dir, disease=None):
+    files = {}
+    for path in output_files([directory]):
+        stem = path.name.split(".")[0]
+        if stem.startswith("measures_dataset"):
+            files.setdefault(stem, path)
+    if "measures_dataset" in files:
+        return [files["measures_dataset"]]
+    stems = sorted(files)
+    if disease is not None:
+        stems = [stem for stem in stems if re.fullmatch(rf"measures_dataset_{re.escape(disease)}_\d{{4}}", stem)]
+    return [files[stem] for stem in stems]
+
+# Read every measures file once and concatenate, with disease and measure family parsed from the measure name
+def consolidate(paths):
+    tables = [read_table(path, string_columns=group_columns) for path in paths]
+    measures = pd.concat(tables, ignore_index=True, sort=False)
+    for column in group_columns:
+        if column in measures:
+            measures[column] = measures[column].astype("string")
+    parsed = pd.DataFrame(
+        [split_measure(measure) for measure in measures["measure"]],
+        columns=["disease", "measure_family"],
+        index=measures.index,
+    )
+    return pd.concat([measures, parsed], axis=1)
+
+def write_outputs(measures):
+    consolidated_dir.parent.mkdir(parents=True, exist_ok=True)
+    parquet.write_to_dataset(
+        pa.Table.from_pandas(measures, preserve_index=False),
+        root_path=str(consolidated_dir),
+        partition_cols=["disease"],
+        existing_data_behavior="delete_matching",
+    )
+    appended = measures.drop(columns=["disease", "measure_family"])
+    appended = appended.sort_values(["measure", "interval_start", "sex", "age"], kind="stable", na_position="first")
+    stata_frame(appended).to_stata(consolidated_dta, write_index=False, version=118)
+
+
+if __name__ == "__main__":
+    timings = recorder()
+    directory = Path(sys.argv[1]) if len(sys.argv) > 1 else measures_dir
+    paths = measures_inputs(directory)
+    if not paths:
+        sys.exit(f"No measures outputs found in {directory}")
+    with timings.stage("consolidate"):
+        measures = consolidate(paths)
+    with timings.stage("write_outputs"):
+        write_outputs(measures)
+    print(f"Consolidated {len(paths)} measures files ({len(measures)} rows) into {consolidated_dir} and {consolidated_dta}")
+    timings.finish(rows_in=len(measures), rows_out=len(measures))
@@ -3,60 +3,73 @@ from ehrql.tables.tpp import patients, practice_registrations, clinical_events,
 from ehrql.codes import ICD10Code
 from datetime import date, datetime
 import codelists_ehrQL as codelists
-
-diseases = ["asthma", "copd", "chd", "stroke", "heart_failure", "dementia", "multiple_sclerosis", "epilepsy", "crohns_disease", "ulcerative_colitis", "dm_type2", "ckd", "psoriasis", "atopic_dermatitis", "osteoporosis", "rheumatoid", "depression", "depression_broad", "coeliac", "pmr"]
-codelist_types = ["snomed", "icd", "resolved"]
-
-dataset = create_dataset()
-dataset.configure_dummy_data(population_size=1000)
+from disease_registry import cohort_end_date, registry, disease_names
+from patient_shards import in_patient_shard
+from features_table import event_columns, features_table
+from argparse import ArgumentParser
+
+# Arguments (from project.yaml): patient shard to extract (all patients if not given), features table to read event dates, ethnicity
+# and IMD from (derived from the raw tables if not given), study end date; other arguments belong to importing definitions
+parser = ArgumentParser()
+parser.add_argument("--shard", type=int)
+parser.add_argument("--shards", type=int)
+parser.add_argument("--features", type=str)
+parser.add_argument("--end-date", type=str, default=cohort_end_date)
+args, _ = parser.parse_known_args()
+
+diseases = disease_names()
 
 index_date = "2016-04-01"
-end_date = "2024-11-30"
-
-# Incident diagnostic code in primary care record (SNOMED) (assuming before study end date)
-def first_code_in_period_snomed(dx_codelist):
-    return clinical_events.where(
-        clinical_events.snomedct_code.is_in(dx_codelist)
-    ).where(
-        clinical_events.date.is_on_or_before(end_date)
-    ).sort_by(
-        clinical_events.date
-    ).first_for_patient()
-
-# Incident diagnostic code in secondary care record (ICD10 primary diagnoses) (assuming before study end date)
-def first_code_in_period_icd(dx_codelist):
-    return apcs.where(
-        apcs.primary_diagnosis.is_in(dx_codelist)
-    ).where(
-        apcs.admission_date.is_on_or_before(end_date)
-    ).sort_by(
-        apcs.admission_date
-    ).first_for_patient()
-
-# Last diagnostic code in primary care record (SNOMED) (assuming before study end date)
-def last_code_in_period_snomed(dx_codelist):
-    return clinical_events.where(
-        clinical_events.snomedct_code.is_in(dx_codelist)
-    ).where(
-        clinical_events.date.is_on_or_before(end_date)
-    ).sort_by(
-        clinical_events.date
-    ).last_for_patient()
-
-# Last diagnostic code in secondary care record (ICD10 primary diagnoses) (assuming before study end date)
-def last_code_in_period_icd(dx_codelist):
-    return apcs.where(
-        apcs.primary_diagnosis.is_in(dx_codelist)
-    ).where(
-        apcs.admission_date.is_on_or_before(end_date)
-    ).sort_by(
-        apcs.admission_date
-    ).last_for_patient()
+end_date = args.end_date
+
+# Clinical events and admissions before study end date, filtered by each codelist
+events_to_end = clinical_events.where(clinical_events.date.is_on_or_before(end_date))
+admissions_to_end = apcs.where(apcs.admission_date.is_on_or_before(end_date))
+
+# Clinical events (before study end date) with a code in any SNOMED codelist of the given diseases (diagnostic and resolved by
+# default), selected in one pass over clinical_events; each codelist's dates are then read from this frame
+def snomed_events_for(diseases, kinds=("snomed", "resolved")):
+    codes = set()
+    for disease in diseases:
+        for kind in kinds:
+            codelist_name = getattr(registry[disease], kind)
+            if codelist_name:
+                codes.update(getattr(codelists, codelist_name))
+    return events_to_end.where(
+        events_to_end.snomedct_code.is_in(sorted(codes))
+    )
+
+# First date, last date and number of diagnostic codes in primary care record (SNOMED), aggregated from one filtered frame (clinical
+# events before study end date, or the events of several codelists selected by snomed_events_for)
+def code_summary_snomed(dx_codelist, snomed_events=events_to_end):
+    events = snomed_events.where(
+        snomed_events.snomedct_code.is_in(dx_codelist)
+    )
+    return {
+        "first_date": events.date.minimum_for_patient(),
+        "last_date": events.date.maximum_for_patient(),
+        "count": events.count_for_patient(),
+    }
 
 # Expand 3-character ICD10 codes
 def expand_three_char_icd10_codes(dx_codelist):
     return dx_codelist + [f"{code}X" for code in dx_codelist if len(code) == 3]
 
+# First date, last date and number of diagnostic codes in secondary care record (ICD10 primary diagnoses), aggregated from one filtered frame (assuming before study end date)
+def code_summary_icd(dx_codelist):
+    admissions = admissions_to_end.where(
+        admissions_to_end.primary_diagnosis.is_in(expand_three_char_icd10_codes(dx_codelist))
+    )
+    return {
+        "first_date": admissions.admission_date.minimum_for_patient(),
+        "last_date": admissions.admission_date.maximum_for_patient(),
+        "count": admissions.count_for_patient(),
+    }
+
+# Summary of a registered codelist by name (no dates for a disease without that codelist), from the given events if any
+def codelist_summary(code_summary, codelist_name, *events):
+    return code_summary(getattr(codelists, codelist_name) if codelist_name else [], *events)
+
 # Registration for 12 months prior to incident diagnosis date
 def preceding_registration(dx_date):
     return practice_registrations.where(
@@ -65,41 +78,36 @@ def preceding_registration(dx_date):
         practice_registrations.end_date.is_on_or_before(dx_date)
     )
 
-# Define sex, date of death (only need to capture once) 
-dataset.sex = patients.sex
-dataset.date_of_death = patients.date_of_death
+# Alive at a date (or no recorded death)
+def alive_on(date):
+    return patients.date_of_death.is_after(date) | patients.date_of_death.is_null()
 
-# Any practice registration before study end date
-any_registration = practice_registrations.where(
+# Practice registrations overlapping the study period
+study_registrations = practice_registrations.where(
             practice_registrations.start_date <= end_date
         ).except_where(
             practice_registrations.end_date < index_date    
-        ).exists_for_patient()
+        )
+
+# Any practice registration before study end date
+any_registration = study_registrations.exists_for_patient()
 
 # Registration start date (to calculate age at diagnosis)
-dataset.registration_start = practice_registrations.where(
-            practice_registrations.start_date <= end_date
-        ).except_where(
-            practice_registrations.end_date < index_date   
-        ).sort_by(
-            practice_registrations.start_date
+registration_start = study_registrations.sort_by(
+            study_registrations.start_date
         ).last_for_patient().start_date
 
-# Define age at practice registration start date
-dataset.age_reg = patients.age_on(dataset.registration_start)
-
 # Define patient ethnicity
 latest_ethnicity_code = (
-    clinical_events.where(clinical_events.snomedct_code.is_in(codelists.ethnicity_codes))
-    .where(clinical_events.date.is_on_or_before(end_date))
-    .sort_by(clinical_events.date)
+    events_to_end.where(events_to_end.snomedct_code.is_in(codelists.ethnicity_codes))
+    .sort_by(events_to_end.date)
     .last_for_patient().snomedct_code.to_category(codelists.ethnicity_codes)
 )
 
 # Extract ethnicity from SUS records if it isn't present in primary care data 
 ethnicity_sus = ethnicity_from_sus.code
 
-dataset.ethnicity = case(
+ethnicity = case(
     when((latest_ethnicity_code == "1") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["A", "B", "C"])))).then("White"),
     when((latest_ethnicity_code == "2") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["D", "E", "F", "G"])))).then("Mixed"),
     when((latest_ethnicity_code == "3") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["H", "J", "K", "L"])))).then("Asian or Asian British"),
@@ -111,7 +119,7 @@ dataset.ethnicity = case(
 # Define patient IMD
 latest_address_per_patient = addresses.sort_by(addresses.start_date).last_for_patient()
 imd_rounded = latest_address_per_patient.imd_rounded
-dataset.imd_quintile = case(
+imd_quintile = case(
     when((imd_rounded >= 0) & (imd_rounded < int(32844 * 1 / 5))).then("1 (most deprived)"),
     when(imd_rounded < int(32844 * 2 / 5)).then("2"),
     when(imd_rounded < int(32844 * 3 / 5)).then("3"),
@@ -120,53 +128,39 @@ dataset.imd_quintile = case(
     otherwise="Unknown",
 )
 
-# Define population as any registered patient after index date, then apply further restrictions in later processing steps
-dataset.define_population(
-    any_registration & dataset.sex.is_in(["male", "female"])
-)  
-
-for disease in diseases:
-    # Dictionaries to store dates
-    snomed_inc_date = {}  
-    snomed_last_date = {}
-    icd_inc_date = {}
-    icd_last_date = {}
-    last_date = {}
-
-    for codelist_type in codelist_types:
-
-        if (f"{codelist_type}" == "snomed"):
-            if hasattr(codelists, f"{disease}_snomed"):
-                disease_codelist = getattr(codelists, f"{disease}_snomed")
-                snomed_inc_date[f"{disease}_snomed_inc_date"] = (first_code_in_period_snomed(disease_codelist).date)
-                snomed_last_date[f"{disease}_snomed_last_date"] = (last_code_in_period_snomed(disease_codelist).date)
-            else:
-                snomed_inc_date[f"{disease}_snomed_inc_date"] = (first_code_in_period_snomed([]).date)
-                snomed_last_date[f"{disease}_snomed_last_date"] = (last_code_in_period_snomed([]).date)
-        elif (f"{codelist_type}" == "icd"):
-            if hasattr(codelists, f"{disease}_icd"):
-                disease_codelist = getattr(codelists, f"{disease}_icd")
-                disease_codelist = expand_three_char_icd10_codes(disease_codelist)   
-                icd_inc_date[f"{disease}_icd_inc_date"] = (first_code_in_period_icd(disease_codelist).admission_date)
-                icd_last_date[f"{disease}_icd_last_date"] = (last_code_in_period_icd(disease_codelist).admission_date)
-            else:
-                icd_inc_date[f"{disease}_icd_inc_date"] = (first_code_in_period_icd([]).admission_date)
-                icd_last_date[f"{disease}_icd_last_date"] = (last_code_in_period_icd([]).admission_date)
-        elif (f"{codelist_type}" == "resolved"):
-            if hasattr(codelists, f"{disease}_resolved"):
-                disease_codelist = getattr(codelists, f"{disease}_resolved")    
-                dataset.add_column(f"{disease}_resolved_date", last_code_in_period_snomed(disease_codelist).date)
-            else:
-                dataset.add_column(f"{disease}_resolved_date", last_code_in_period_snomed([]).date)  
-        else:
-            dataset.add_column(f"{disease}_{codelist_type}_inc_date", None)
+# First and last diagnostic code dates and last resolved code date of one disease, one aggregation per codelist (SNOMED codes read
+# from the clinical events selected for all diseases by snomed_events_for, if given)
+def event_dates(disease, snomed_events=events_to_end):
+    registered = registry[disease]
+    snomed_summary = codelist_summary(code_summary_snomed, registered.snomed, snomed_events)
+    icd_summary = codelist_summary(code_summary_icd, registered.icd)
+    resolved_summary = codelist_summary(code_summary_snomed, registered.resolved, snomed_events)
+    return {
+        "snomed_first": snomed_summary["first_date"],
+        "snomed_last": snomed_summary["last_date"],
+        "icd_first": icd_summary["first_date"],
+        "icd_last": icd_summary["last_date"],
+        "resolved_last": resolved_summary["last_date"],
+    }
+
+# The same dates read from the features table (no resolved date for diseases without a resolved codelist)
+def feature_event_dates(disease, features):
+    dates = {"resolved_last": code_summary_snomed([])["last_date"]}
+    for summary, column in event_columns(registry[disease]).items():
+        dates[summary] = getattr(features, column)
+    return dates
+
+# Add incident, last and resolved diagnosis columns for one disease
+def add_disease_columns(dataset, disease, dates=None):
+    if dates is None:
+        dates = event_dates(disease)
+
+    # Last resolved code for each disease
+    dataset.add_column(f"{disease}_resolved_date", dates["resolved_last"])
 
     # Incident date for each disease
     dataset.add_column(f"{disease}_inc_date",
-        minimum_of(*[date for date in [
-            (snomed_inc_date[f"{disease}_snomed_inc_date"]),
-            (icd_inc_date[f"{disease}_icd_inc_date"])
-            ] if date is not None]),
+        minimum_of(dates["snomed_first"], dates["icd_first"]),
     )
 
     # 12 months registration preceding incident diagnosis date
@@ -177,20 +171,60 @@ for disease in diseases:
 
     # Alive at incident diagnosis date
     dataset.add_column(f"{disease}_alive_inc",
-        (
-            (dataset.date_of_death.is_after(getattr(dataset, f"{disease}_inc_date"))) |
-            dataset.date_of_death.is_null()
-        ).when_null_then(False)
+        alive_on(getattr(dataset, f"{disease}_inc_date")).when_null_then(False)
     )
     
     # Last diagnosis date for each disease
-    last_date[f"{disease}_last_date"] = maximum_of(
-        snomed_last_date[f"{disease}_snomed_last_date"],
-        icd_last_date[f"{disease}_icd_last_date"]
-    )
+    last_date = maximum_of(dates["snomed_last"], dates["icd_last"])
 
     # Did the patient have resolved diagnosis code after the last appearance of a diagnostic code for that disease
     dataset.add_column(f"{disease}_resolved", 
-        (getattr(dataset, f"{disease}_resolved_date") > (last_date[f"{disease}_last_date"])
+        (getattr(dataset, f"{disease}_resolved_date") > last_date
         ).when_null_then(False)
-    )
\ No newline at end of file
+    )
+
+# Build dataset with disease columns only for the requested diseases (defaults to all diseases), for all patients or one patient shard,
+# reading event dates, ethnicity and IMD from a features table if given
+def build_dataset(diseases=diseases, shard=None, shards=None, features=None):
+    dataset = create_dataset()
+    dataset.configure_dummy_data(population_size=1000)
+
+    # Define sex, date of death (only need to capture once) 
+    dataset.sex = patients.sex
+    dataset.date_of_death = patients.date_of_death
+
+    # Registration start date and age at practice registration start date
+    dataset.registration_start = registration_start
+    dataset.age_reg = patients.age_on(dataset.registration_start)
+
+    # Patient ethnicity and IMD
+    dataset.ethnicity = features.ethnicity if features is not None else ethnicity
+    dataset.imd_quintile = features.imd_quintile if features is not None else imd_quintile
+
+    # Define population as any registered patient after index date, then apply further restrictions in later processing steps
+    population = any_registration & dataset.sex.is_in(["male", "female"])
+    if shards:
+        population = population & in_patient_shard(shard, shards)
+    dataset.define_population(population)
+
+    if features is not None:
+        for disease in diseases:
+            add_disease_columns(dataset, disease, feature_event_dates(disease, features))
+    else:
+        # Clinical events of every requested disease's codelists selected in one pass, then split into each disease's dates
+        snomed_events = snomed_events_for(diseases)
+        for disease in diseases:
+            add_disease_columns(dataset, disease, event_dates(disease, snomed_events))
+
+    return dataset
+
+# Full dataset (all diseases) built on first access, so that importing this module for a subset of diseases does not construct every disease's columns
+_dataset = None
+
+def __getattr__(name):
+    global _dataset
+    if name == "dataset":
+        if _dataset is None:
+            _dataset = build_dataset(shard=args.shard, shards=args.shards, features=features_table(args.features) if args.features else None)
+        return _dataset
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
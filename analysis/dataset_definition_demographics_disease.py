@@ -3,61 +3,40 @@ from ehrql.tables.tpp import patients, practice_registrations, clinical_events,
 from ehrql.codes import ICD10Code
 from datetime import date, datetime
 import codelists_ehrQL as codelists
+from disease_registry import cohort_end_date, registry, disease_names
+from patient_shards import in_patient_shard
+from features_table import features_table
+from dataset_definition import (
+    alive_on, any_registration, code_summary_icd, code_summary_snomed, codelist_summary, events_to_end, preceding_registration,
+    snomed_events_for,
+)
+from argparse import ArgumentParser
+
+# Arguments (from project.yaml): patient shard to extract (all patients if not given), features table to read event dates, ethnicity
+# and IMD from (derived from the raw tables if not given), study end date
+parser = ArgumentParser()
+parser.add_argument("--shard", type=int)
+parser.add_argument("--shards", type=int)
+parser.add_argument("--features", type=str)
+parser.add_argument("--end-date", type=str, default=cohort_end_date)
+args = parser.parse_args()
 
-diseases = ["asthma", "copd", "chd", "stroke", "heart_failure", "dementia", "multiple_sclerosis", "epilepsy", "crohns_disease", "ulcerative_colitis", "dm_type2", "ckd", "psoriasis", "atopic_dermatitis", "osteoporosis", "rheumatoid", "depression", "coeliac", "pmr"]
-codelist_types = ["snomed", "icd"]
+features = features_table(args.features) if args.features else None
+
+diseases = disease_names(demographics=True)
 
 index_date = "2016-04-01"
-end_date = "2024-11-30"
+end_date = args.end_date
 
 dataset = create_dataset()
 dataset.configure_dummy_data(population_size=1000)
 
-# Incident diagnostic code in primary care record (SNOMED) assuming before study end date
-def first_code_in_period_snomed(dx_codelist):
-    return clinical_events.where(
-        clinical_events.snomedct_code.is_in(dx_codelist)
-    ).where(
-        clinical_events.date.is_on_or_before(end_date)
-    ).sort_by(
-        clinical_events.date
-    ).first_for_patient()
-
-# Incident diagnostic code in secondary care record (ICD10 primary diagnoses) assuming before study end date
-def first_code_in_period_icd(dx_codelist):
-    return apcs.where(
-        apcs.primary_diagnosis.is_in(dx_codelist)
-    ).where(
-        apcs.admission_date.is_on_or_before(end_date)
-    ).sort_by(
-        apcs.admission_date
-    ).first_for_patient()
-
-# Expand 3-character ICD10 codes
-def expand_three_char_icd10_codes(dx_codelist):
-    return dx_codelist + [f"{code}X" for code in dx_codelist if len(code) == 3]
-
-# Registration for 12 months prior to incident diagnosis date
-def preceding_registration(dx_date):
-    return practice_registrations.where(
-        practice_registrations.start_date.is_on_or_before(dx_date - months(12))
-    ).except_where(
-        practice_registrations.end_date.is_on_or_before(dx_date)
-    )
-
 # Define sex
 dataset.sex = patients.sex
 
 # Date of death
 dataset.date_of_death = patients.date_of_death
 
-# Any practice registration before study end date
-any_registration = practice_registrations.where(
-            practice_registrations.start_date <= end_date
-        ).except_where(
-            practice_registrations.end_date < index_date    
-        ).exists_for_patient()
-
 # Age at index date
 dataset.age = patients.age_on(index_date)
 
@@ -73,65 +52,67 @@ age_band = case(
     when((dataset.age >= 80)).then("age_greater_equal_80"),
 )
 
-# Define patient ethnicity
-latest_ethnicity_code = (
-    clinical_events.where(clinical_events.snomedct_code.is_in(codelists.ethnicity_codes))
-    .where(clinical_events.date.is_on_or_before(end_date))
-    .sort_by(clinical_events.date)
-    .last_for_patient().snomedct_code.to_category(codelists.ethnicity_codes)
-)
+if features is not None:
+    # Ethnicity and IMD quintile (address at study end date) from the features table
+    dataset.ethnicity = features.ethnicity
+    dataset.imd_quintile = features.imd_quintile_end
+else:
+    # Define patient ethnicity
+    latest_ethnicity_code = (
+        events_to_end.where(events_to_end.snomedct_code.is_in(codelists.ethnicity_codes))
+        .sort_by(events_to_end.date)
+        .last_for_patient().snomedct_code.to_category(codelists.ethnicity_codes)
+    )
 
-## Extract ethnicity from SUS records if it isn't present in primary care data 
-ethnicity_sus = ethnicity_from_sus.code
-
-dataset.ethnicity = case(
-    when((latest_ethnicity_code == "1") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["A", "B", "C"])))).then("White"),
-    when((latest_ethnicity_code == "2") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["D", "E", "F", "G"])))).then("Mixed"),
-    when((latest_ethnicity_code == "3") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["H", "J", "K", "L"])))).then("Asian or Asian British"),
-    when((latest_ethnicity_code == "4") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["M", "N", "P"])))).then("Black or Black British"),
-    when((latest_ethnicity_code == "5") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["R", "S"])))).then("Chinese or Other Ethnic Groups"),
-    otherwise="Unknown", 
-) 
-
-# Define patient IMD
-imd = addresses.for_patient_on(end_date).imd_rounded
-
-dataset.imd_quintile = case(
-    when((imd >= 0) & (imd < int(32844 * 1 / 5))).then("1 (most deprived)"),
-    when(imd < int(32844 * 2 / 5)).then("2"),
-    when(imd < int(32844 * 3 / 5)).then("3"),
-    when(imd < int(32844 * 4 / 5)).then("4"),
-    when(imd < int(32844 * 5 / 5)).then("5 (least deprived)"),
-    otherwise="Unknown",
-)
+    ## Extract ethnicity from SUS records if it isn't present in primary care data 
+    ethnicity_sus = ethnicity_from_sus.code
+
+    dataset.ethnicity = case(
+        when((latest_ethnicity_code == "1") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["A", "B", "C"])))).then("White"),
+        when((latest_ethnicity_code == "2") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["D", "E", "F", "G"])))).then("Mixed"),
+        when((latest_ethnicity_code == "3") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["H", "J", "K", "L"])))).then("Asian or Asian British"),
+        when((latest_ethnicity_code == "4") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["M", "N", "P"])))).then("Black or Black British"),
+        when((latest_ethnicity_code == "5") | ((latest_ethnicity_code.is_null()) & (ethnicity_sus.is_in(["R", "S"])))).then("Chinese or Other Ethnic Groups"),
+        otherwise="Unknown", 
+    ) 
+
+    # Define patient IMD
+    imd = addresses.for_patient_on(end_date).imd_rounded
+
+    dataset.imd_quintile = case(
+        when((imd >= 0) & (imd < int(32844 * 1 / 5))).then("1 (most deprived)"),
+        when(imd < int(32844 * 2 / 5)).then("2"),
+        when(imd < int(32844 * 3 / 5)).then("3"),
+        when(imd < int(32844 * 4 / 5)).then("4"),
+        when(imd < int(32844 * 5 / 5)).then("5 (least deprived)"),
+        otherwise="Unknown",
+    )
 
 # Define population
-dataset.define_population(
+population = (
     age_band.is_not_null()
     & dataset.sex.is_in(["male", "female"])
-    & (dataset.date_of_death.is_after(index_date) | dataset.date_of_death.is_null())
+    & alive_on(index_date)
     & any_registration
 )
+if args.shards:
+    population = population & in_patient_shard(args.shard, args.shards)
+dataset.define_population(population)
+
+# Clinical events of every disease's diagnostic codelist selected in one pass
+if features is None:
+    snomed_events = snomed_events_for(diseases, kinds=("snomed",))
 
 for disease in diseases:
 
-    for codelist_type in codelist_types:
-
-        if (f"{codelist_type}" == "snomed"):
-            if hasattr(codelists, f"{disease}_snomed"):
-                disease_codelist = getattr(codelists, f"{disease}_snomed")
-                dataset.add_column(f"{disease}_prim_date", first_code_in_period_snomed(disease_codelist).date)
-            else:
-                dataset.add_column(f"{disease}_prim_date", first_code_in_period_snomed([]).date)
-        elif (f"{codelist_type}" == "icd"):
-            if hasattr(codelists, f"{disease}_icd"):
-                disease_codelist = getattr(codelists, f"{disease}_icd")
-                disease_codelist = expand_three_char_icd10_codes(disease_codelist)   
-                dataset.add_column(f"{disease}_sec_date", first_code_in_period_icd(disease_codelist).admission_date)
-            else:
-                dataset.add_column(f"{disease}_sec_date", first_code_in_period_icd([]).admission_date)
-        else:
-            dataset.add_column(f"{disease}_{codelist_type}_inc_date", None)
+    registered = registry[disease]
+
+    if features is not None:
+        dataset.add_column(f"{disease}_prim_date", getattr(features, f"{disease}_snomed_first"))
+        dataset.add_column(f"{disease}_sec_date", getattr(features, f"{disease}_icd_first"))
+    else:
+        dataset.add_column(f"{disease}_prim_date", codelist_summary(code_summary_snomed, registered.snomed, snomed_events)["first_date"])
+        dataset.add_column(f"{disease}_sec_date", codelist_summary(code_summary_icd, registered.icd)["first_date"])
 
     # Incident date for each disease 
     dataset.add_column(f"{disease}_inc_date",
@@ -161,6 +142,5 @@ for disease in diseases:
 
     # Alive at incident diagnosis date
     dataset.add_column(f"{disease}_alive_inc",
-        ((dataset.date_of_death.is_after(getattr(dataset, f"{disease}_inc_date"))) | dataset.date_of_death.is_null()
-        ).when_null_then(False)
-    )
\ No newline at end of file
+        alive_on(getattr(dataset, f"{disease}_inc_date")).when_null_then(False)
+    )
@@ -0,0 +1,38 @@
+from ehrql import create_dataset, case, when
+from ehrql.tables.tpp import addresses
+from dataset_definition import (
+    any_registration, end_date, ethnicity, event_dates, imd_quintile, snomed_events_for,
+)
+from disease_registry import diseases
+from features_table import event_columns
+
+# Per-patient features shared by the cohort, demographics and measures definitions (read with --features), so the event tables are
+# queried once per refresh rather than once per consumer
+dataset = create_dataset()
+dataset.configure_dummy_data(population_size=1000)
+
+# Any registered patient after index date (covers the cohort, demographics and measures populations)
+dataset.define_population(any_registration)
+
+# Ethnicity, and IMD quintile of the latest address (cohort and measures definitions)
+dataset.ethnicity = ethnicity
+dataset.imd_quintile = imd_quintile
+
+# IMD quintile of the address at study end date (demographics definition)
+imd_end = addresses.for_patient_on(end_date).imd_rounded
+dataset.imd_quintile_end = case(
+    when((imd_end >= 0) & (imd_end < int(32844 * 1 / 5))).then("1 (most deprived)"),
+    when(imd_end < int(32844 * 2 / 5)).then("2"),
+    when(imd_end < int(32844 * 3 / 5)).then("3"),
+    when(imd_end < int(32844 * 4 / 5)).then("4"),
+    when(imd_end < int(32844 * 5 / 5)).then("5 (least deprived)"),
+    otherwise="Unknown",
+)
+
+# First and last diagnostic code dates and last resolved code dates, the clinical events of every disease's SNOMED codelists
+# selected in one pass and then split into each disease's dates
+snomed_events = snomed_events_for([disease.name for disease in diseases])
+for disease in diseases:
+    dates = event_dates(disease.name, snomed_events)
+    for summary, column in event_columns(disease).items():
+        dataset.add_column(column, dates[summary])
@@ -1,9 +1,9 @@
-from ehrql import months, years, case, when, create_measures, INTERVAL, minimum_of, maximum_of
+from ehrql import months, years, case, when, create_measures, INTERVAL
 from ehrql.tables.tpp import patients, practice_registrations
-from datetime import date, datetime
-import codelists_ehrQL as codelists
-from analysis.dataset_definition import dataset
-import sys
+from datetime import date, timedelta
+from disease_registry import cohort_end_date, measure_families
+from analysis.dataset_definition import alive_on, build_dataset, diseases
+from features_table import features_table
 
 # Arguments (from project.yaml)
 from argparse import ArgumentParser
@@ -11,13 +11,65 @@ from argparse import ArgumentParser
 parser = ArgumentParser()
 parser.add_argument("--start-date", type=str)
 parser.add_argument("--intervals", type=int)
+# Single disease (compatibility mode, one action per disease and year)
 parser.add_argument("--disease", type=str)
+# Comma-separated list of diseases (all diseases measured in one pass if neither argument given)
+parser.add_argument("--diseases", type=str)
+# Incremental refresh: intervals are new months only; prevalence measured for financial years completed within them
+parser.add_argument("--incremental", action="store_true")
+# Comma-separated measure families to define (all families if not given), e.g. "incidence,inc_ethn,inc_imd"
+parser.add_argument("--measures", type=str)
+# Features table to read event dates, ethnicity and IMD from (derived from the raw tables if not given)
+parser.add_argument("--features", type=str)
+# Study end date of the cohort (read by dataset_definition.py); no interval may end after it
+parser.add_argument("--end-date", type=str, default=cohort_end_date)
 args = parser.parse_args()
 
 start_date = args.start_date
 intervals = args.intervals
 intervals_years = int(intervals/12)
-disease = args.disease
+
+# First and last day of the monthly intervals
+window_start = date.fromisoformat(start_date)
+window_end_month = window_start.month - 1 + intervals
+window_end = date(window_start.year + window_end_month // 12, window_end_month % 12 + 1, 1) - timedelta(days=1)
+
+# Intervals past the cohort end date would be measured without any diagnoses after it (and merged as real data by a refresh)
+if window_end > date.fromisoformat(args.end_date):
+    parser.error(f"Intervals end on {window_end}, after the cohort end date {args.end_date} (pass a later --end-date)")
+
+# Prevalence intervals (financial years)
+if args.incremental:
+    prevalence_intervals = [
+        (date(year, 4, 1), date(year + 1, 3, 31))
+        for year in range(window_start.year - 1, window_end.year + 1)
+        if window_start <= date(year + 1, 3, 31) <= window_end
+    ]
+else:
+    prevalence_intervals = years(intervals_years).starting_on(start_date)
+
+if args.disease:
+    measure_diseases = [args.disease]
+elif args.diseases:
+    measure_diseases = [disease.strip() for disease in args.diseases.split(",") if disease.strip()]
+else:
+    measure_diseases = diseases
+
+unknown_diseases = [disease for disease in measure_diseases if disease not in diseases]
+if unknown_diseases:
+    parser.error(f"Unknown disease(s): {', '.join(unknown_diseases)}")
+
+if args.measures:
+    families = [family.strip() for family in args.measures.split(",") if family.strip()]
+else:
+    families = measure_families
+
+unknown_families = [family for family in families if family not in measure_families]
+if unknown_families:
+    parser.error(f"Unknown measure family(s): {', '.join(unknown_families)}")
+
+# Dataset with columns for the measured diseases only
+dataset = build_dataset(measure_diseases, features=features_table(args.features) if args.features else None)
 
 index_date = INTERVAL.start_date
 end_date = INTERVAL.end_date
@@ -55,13 +107,14 @@ measures.configure_dummy_data(population_size=1000, legacy=True)
 measures.configure_disclosure_control(enabled=False)
 measures.define_defaults(intervals=months(intervals).starting_on(start_date))
 
+# Conditions common to every disease's measures: known age band and sex, alive at interval start, and the incidence population
+# (12 months' registration before interval start)
+age_sex_known = age_band.is_not_null() & dataset.sex.is_in(["male", "female"])
+alive_at_index = alive_on(index_date)
+incidence_population = age_sex_known & alive_at_index & preceding_reg_index
+
 # Prevalence denominator
-prev_denominator = (
-    age_band.is_not_null()
-    & dataset.sex.is_in(["male", "female"])
-    & (dataset.date_of_death.is_after(index_date) | dataset.date_of_death.is_null())
-    & curr_registered
-)
+prev_denominator = age_sex_known & alive_at_index & curr_registered
 
 # Dictionaries to store values
 prev = {}
@@ -71,84 +124,86 @@ inc_case_12m_alive = {}
 incidence_numerators = {}
 incidence_denominators = {}
 
-# Prevalent diagnosis (at interval start)
-prev[disease + "_prev"] = (
-    (getattr(dataset, disease + "_inc_date") < index_date)
-    & ((~getattr(dataset, disease + "_resolved")) | (getattr(dataset, disease + "_resolved") & (getattr(dataset, disease + "_resolved_date") > index_date)))
-).when_null_then(False)
-
-# Prevalence numerator - people registered for more than one year on index date who have an diagnostic code on or before index date
-prev_numerators[disease + "_prev_num"] = (
-    prev[disease + "_prev"] & prev_denominator
-)
-
-# Incident case (i.e. incident date within interval window)
-inc_case[disease + "_inc_case"] = (
-    (getattr(dataset, disease + "_inc_date")).is_on_or_between(index_date, end_date)
-).when_null_then(False)
-
-# Preceding registration and alive at incident diagnosis date
-inc_case_12m_alive[disease + "_inc_case_12m_alive"] = ( 
-    inc_case[disease + "_inc_case"]
-    & getattr(dataset, disease + "_pre_reg")
-    & getattr(dataset, disease + "_alive_inc")
-).when_null_then(False)
-
-# Incidence numerator - people with new diagnostic codes in the 1 month after index date who have 12m+ preceding registration and alive 
-incidence_numerators[disease + "_inc_num"] = (
-    inc_case_12m_alive[disease + "_inc_case_12m_alive"]
-    & age_band.is_not_null()
-    & dataset.sex.is_in(["male", "female"])
-)
+for disease in measure_diseases:
 
-# Incidence denominator - people with 12m+ registration prior to index date who do not have a diagnostic code on or before index date
-incidence_denominators[disease + "_inc_denom"] = (
-    (~prev[disease + "_prev"])
-    & age_band.is_not_null()
-    & dataset.sex.is_in(["male", "female"])
-    & (dataset.date_of_death.is_after(index_date) | dataset.date_of_death.is_null())
-    & preceding_reg_index
-)
+    # Prevalent diagnosis (at interval start)
+    prev[disease + "_prev"] = (
+        (getattr(dataset, disease + "_inc_date") < index_date)
+        & ((~getattr(dataset, disease + "_resolved")) | (getattr(dataset, disease + "_resolved") & (getattr(dataset, disease + "_resolved_date") > index_date)))
+    ).when_null_then(False)
 
-# Prevalence by age and sex
-measures.define_measure(
-    name=disease + "_prevalence",
-    numerator=prev_numerators[disease + "_prev_num"],
-    denominator=prev_denominator,
-    intervals=years(intervals_years).starting_on(start_date),
-    group_by={
-        "sex": dataset.sex,
-        "age": age_band,  
-    },
-)
+    # Prevalence numerator - people registered for more than one year on index date who have an diagnostic code on or before index date
+    prev_numerators[disease + "_prev_num"] = (
+        prev[disease + "_prev"] & prev_denominator
+    )
 
-# Incidence by age and sex
-measures.define_measure(
-    name=disease + "_incidence",
-    numerator=incidence_numerators[disease + "_inc_num"],
-    denominator=incidence_denominators[disease + "_inc_denom"],
-    group_by={
-        "sex": dataset.sex,
-        "age": age_band,  
-    },
-)
+    # Incident case (i.e. incident date within interval window)
+    inc_case[disease + "_inc_case"] = (
+        (getattr(dataset, disease + "_inc_date")).is_on_or_between(index_date, end_date)
+    ).when_null_then(False)
+
+    # Preceding registration and alive at incident diagnosis date
+    inc_case_12m_alive[disease + "_inc_case_12m_alive"] = ( 
+        inc_case[disease + "_inc_case"]
+        & getattr(dataset, disease + "_pre_reg")
+        & getattr(dataset, disease + "_alive_inc")
+    ).when_null_then(False)
+
+    # Incidence numerator - people with new diagnostic codes in the 1 month after index date who have 12m+ preceding registration and alive 
+    incidence_numerators[disease + "_inc_num"] = (
+        inc_case_12m_alive[disease + "_inc_case_12m_alive"]
+        & age_sex_known
+    )
 
-# Incidence by ethnicity
-measures.define_measure(
-    name=disease + "_inc_ethn",
-    numerator=incidence_numerators[disease + "_inc_num"],
-    denominator=incidence_denominators[disease + "_inc_denom"],
-    group_by={
-        "ethnicity": dataset.ethnicity,
-    },
-)
+    # Incidence denominator - people with 12m+ registration prior to index date who do not have a diagnostic code on or before index date
+    incidence_denominators[disease + "_inc_denom"] = (
+        (~prev[disease + "_prev"])
+        & incidence_population
+    )
 
-# Incidence by IMD quintile
-measures.define_measure(
-    name=disease + "_inc_imd",
-    numerator=incidence_numerators[disease + "_inc_num"],
-    denominator=incidence_denominators[disease + "_inc_denom"],
-    group_by={
-        "imd": dataset.imd_quintile,
-    },
-)
\ No newline at end of file
+    # Prevalence by age and sex (no complete financial year in an incremental refresh window)
+    if "prevalence" in families and (prevalence_intervals or not args.incremental):
+        measures.define_measure(
+            name=disease + "_prevalence",
+            numerator=prev_numerators[disease + "_prev_num"],
+            denominator=prev_denominator,
+            intervals=prevalence_intervals,
+            group_by={
+                "sex": dataset.sex,
+                "age": age_band,  
+            },
+        )
+
+    # Incidence by age and sex
+    if "incidence" in families:
+        measures.define_measure(
+            name=disease + "_incidence",
+            numerator=incidence_numerators[disease + "_inc_num"],
+            denominator=incidence_denominators[disease + "_inc_denom"],
+            group_by={
+                "sex": dataset.sex,
+                "age": age_band,  
+            },
+        )
+
+    # Incidence by ethnicity
+    if "inc_ethn" in families:
+        measures.define_measure(
+            name=disease + "_inc_ethn",
+            numerator=incidence_numerators[disease + "_inc_num"],
+            denominator=incidence_denominators[disease + "_inc_denom"],
+            group_by={
+                "ethnicity": dataset.ethnicity,
+            },
+        )
+
+    # Incidence by IMD quintile
+    if "inc_imd" in families:
+        measures.define_measure(
+            name=disease + "_inc_imd",
+            numerator=incidence_numerators[disease + "_inc_num"],
+            denominator=incidence_denominators[disease + "_inc_denom"],
+            group_by={
+                "imd": dataset.imd_quintile,
+            },
+        )
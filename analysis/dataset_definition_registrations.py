@@ -0,0 +1,20 @@
+from ehrql import create_dataset
+from ehrql.tables.tpp import patients, practice_registrations
+from dataset_definition import any_registration, end_date
+
+# Date of birth and registration spells of the cohort population, from which interval_measures.py derives age bands, current
+# registration and 12-month preceding registration at every interval start in closed form (instead of one query per interval)
+dataset = create_dataset()
+dataset.configure_dummy_data(population_size=1000)
+
+dataset.define_population(any_registration & patients.sex.is_in(["male", "female"]))
+
+dataset.date_of_birth = patients.date_of_birth
+
+# One row per registration spell starting before study end date (end_date missing for current registrations)
+spells = practice_registrations.where(practice_registrations.start_date <= end_date)
+dataset.add_event_table(
+    "registrations",
+    start_date=spells.start_date,
+    end_date=spells.end_date,
+)
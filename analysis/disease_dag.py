@@ -0,0 +1,54 @@
+# Per-disease chains for generate_yaml.py --schedule per-disease: each disease's processing, figures and forecasts run as a chain
+# of actions needing only that disease's measures, so one disease can be forecast while others are still being extracted (the
+# job-runner starts an action as soon as its needs are done; with --measures-mode combined every chain still needs the one
+# measures action).
+#
+# Combine the per-disease tables read by later stages (run after every disease's forecasts):
+#   python analysis/disease_dag.py gather
+
+import sys
+from pathlib import Path
+
+from disease_registry import disease_names
+from render_figures import forecast_families, no_ethnicity_figures, rate_families
+
+tables_dir = Path("output/tables")
+
+# Tables written per disease by the chain, and combined by gather into the files an all-disease run writes
+gathered_tables = ["arima_standardised", "change_incidence_byyear"]
+
+# Figures drawn for one disease by render_figures.py rates / forecasts
+def rate_figures(disease):
+    return [
+        f"output/figures/{family}_{disease}.svg"
+        for family in rate_families
+        if not (family == "unadj_ethn" and disease in no_ethnicity_figures)
+    ]
+
+def forecast_figures(disease):
+    return [f"output/figures/{family}_incidence_{disease}.svg" for family in forecast_families]
+
+# Combine per-disease tables into the all-disease tables (diseases in alphabetical order, as an all-disease run writes them)
+def gather(diseases, directory=tables_dir):
+    paths = []
+    for table in gathered_tables:
+        inputs = [Path(directory) / f"{table}_{disease}.csv" for disease in sorted(diseases)]
+        missing = [str(path) for path in inputs if not path.exists()]
+        if missing:
+            sys.exit(f"Missing per-disease tables: {', '.join(missing)}")
+        lines = []
+        for index, path in enumerate(inputs):
+            text = path.read_text().splitlines(keepends=True)
+            lines += text if index == 0 else text[1:]
+        output = Path(directory) / f"{table}.csv"
+        output.write_text("".join(lines))
+        paths.append(output)
+    return paths
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "gather"
+    if command != "gather":
+        sys.exit(f"Unknown command: {command} (expected gather)")
+    for path in gather(disease_names()):
+        print(f"Wrote {path}")
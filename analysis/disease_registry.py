@@ -0,0 +1,113 @@
+# Disease registry: every disease in the study with its codelists (names of the codelists in codelists_ehrQL.py), display names and
+# SARIMA order, and the study-wide settings (study end date, measure families), imported by the dataset definitions, generate_yaml.py
+# and the Python measures, processing, forecasting and figure stages.
+#
+# Check every registered codelist is defined in codelists_ehrQL.py (non-zero exit status if not):
+#   python analysis/disease_registry.py check
+
+import ast
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+
+codelists_module_path = Path(__file__).parent / "codelists_ehrQL.py"
+
+# Default study end date of the cohort definitions (generate_yaml.py --end-date passes a later one to every definition as --end-date)
+cohort_end_date = "2024-11-30"
+
+# Measure name suffixes (measure families) defined in dataset_definition_measures.py
+measure_families = ["prevalence", "incidence", "inc_ethn", "inc_imd"]
+
+# Seasonal ARIMA spec: (order, seasonal order, include drift)
+SarimaOrder = Tuple[Tuple[int, int, int], Tuple[int, int, int], bool]
+
+@dataclass(frozen=True)
+class Disease:
+    name: str
+    # Full name (as in processed tables, e.g. "Crohn's Disease")
+    display_name: str
+    # Title of figures and forecast summaries (defaults to the full name)
+    title: Optional[str] = None
+    # Codelist names in codelists_ehrQL.py (None if the disease has no such codelist)
+    snomed: Optional[str] = None
+    icd: Optional[str] = None
+    resolved: Optional[str] = None
+    # Seasonal ARIMA order for the counterfactual forecast (None: order selected by search)
+    sarima_order: Optional[SarimaOrder] = None
+    # Included in the demographics cohort (dataset_definition_demographics_disease.py)
+    demographics: bool = True
+
+    @property
+    def figure_title(self):
+        return self.title or self.display_name
+
+    @property
+    def codelists(self):
+        return {kind: name for kind, name in [("snomed", self.snomed), ("icd", self.icd), ("resolved", self.resolved)] if name}
+
+def disease(name, display_name=None, resolved=False, **kwargs):
+    return Disease(
+        name=name,
+        display_name=display_name or name.replace("_", " ").title(),
+        snomed=f"{name}_snomed",
+        icd=f"{name}_icd",
+        resolved=f"{name}_resolved" if resolved else None,
+        **kwargs,
+    )
+
+diseases = [
+    disease("asthma", resolved=True, sarima_order=((0, 0, 0), (0, 1, 1), False)),
+    disease("copd", "COPD", resolved=True, sarima_order=((0, 0, 0), (0, 1, 1), True)),
+    disease("chd", "Coronary Heart Disease", sarima_order=((1, 0, 0), (0, 1, 1), True)),
+    disease("stroke", title="Stroke and TIA", sarima_order=((0, 0, 2), (1, 1, 0), False)),
+    disease("heart_failure", resolved=True, sarima_order=((3, 0, 0), (0, 1, 1), True)),
+    disease("dementia", sarima_order=((3, 0, 0), (0, 1, 1), False)),
+    disease("multiple_sclerosis", sarima_order=((1, 0, 0), (1, 1, 0), False)),
+    disease("epilepsy", resolved=True, sarima_order=((0, 0, 0), (1, 1, 1), False)),
+    disease("crohns_disease", "Crohn's Disease", sarima_order=((0, 0, 0), (0, 1, 1), True)),
+    disease("ulcerative_colitis", sarima_order=((0, 0, 0), (0, 1, 1), False)),
+    disease("dm_type2", "Type 2 Diabetes Mellitus", title="Diabetes Mellitus Type 2", resolved=True, sarima_order=((4, 0, 1), (0, 1, 1), True)),
+    disease("ckd", "Chronic Kidney Disease", resolved=True, sarima_order=((0, 0, 1), (0, 1, 2), False)),
+    disease("psoriasis", sarima_order=((0, 0, 0), (0, 1, 1), True)),
+    disease("atopic_dermatitis", sarima_order=((0, 1, 1), (0, 1, 1), False)),
+    disease("osteoporosis", resolved=True, sarima_order=((0, 0, 0), (0, 1, 1), False)),
+    disease("rheumatoid", "Rheumatoid Arthritis", sarima_order=((0, 0, 0), (0, 1, 1), False)),
+    disease("depression", resolved=True, sarima_order=((0, 0, 0), (0, 1, 1), True)),
+    disease("depression_broad", resolved=True, title="Depression and depressive symptoms", demographics=False),
+    disease("coeliac", "Coeliac Disease", sarima_order=((0, 0, 0), (1, 1, 1), True)),
+    disease("pmr", "Polymyalgia Rheumatica", sarima_order=((0, 0, 1), (1, 1, 0), True)),
+]
+
+registry = {disease.name: disease for disease in diseases}
+
+# Disease names in study order (only those in the demographics cohort if demographics=True)
+def disease_names(demographics=False):
+    return [disease.name for disease in diseases if disease.demographics or not demographics]
+
+# Disease and measure family from a measure name (e.g. "heart_failure_inc_imd" -> ("heart_failure", "inc_imd"))
+def split_measure(measure):
+    for family in measure_families:
+        if measure.endswith(f"_{family}"):
+            return measure[: -len(family) - 1], family
+    raise ValueError(f"Unrecognised measure: {measure}")
+
+# Registered codelists not defined in codelists_ehrQL.py
+def missing_codelists(module_path=codelists_module_path):
+    defined = {
+        node.targets[0].id for node in ast.parse(Path(module_path).read_text()).body
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)
+    }
+    return [(disease.name, name) for disease in diseases for name in disease.codelists.values() if name not in defined]
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "check"
+    if command != "check":
+        sys.exit(f"Unknown command: {command} (expected check)")
+    missing = missing_codelists()
+    for name, codelist in missing:
+        print(f"{name}: codelist {codelist} is not defined in {codelists_module_path}")
+    if missing:
+        sys.exit(1)
+    print(f"All codelists of {len(diseases)} diseases are defined")
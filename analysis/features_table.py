@@ -0,0 +1,49 @@
+# Per-patient features table (output of dataset_definition_features.py): first and last diagnostic code dates of each disease in
+# primary (SNOMED) and secondary care (ICD10), last resolved code dates, ethnicity and IMD quintile. The cohort, demographics and
+# measures definitions read these columns with --features instead of re-querying clinical_events, apcs and addresses.
+
+import datetime
+
+from disease_registry import diseases
+
+features_path = "output/features.arrow"
+
+ethnicity_categories = ["White", "Mixed", "Asian or Asian British", "Black or Black British", "Chinese or Other Ethnic Groups", "Unknown"]
+imd_categories = ["1 (most deprived)", "2", "3", "4", "5 (least deprived)", "Unknown"]
+
+# Event date columns of one disease: summary -> column name (resolved dates only for diseases with a resolved codelist)
+def event_columns(disease):
+    columns = {
+        "snomed_first": f"{disease.name}_snomed_first",
+        "snomed_last": f"{disease.name}_snomed_last",
+        "icd_first": f"{disease.name}_icd_first",
+        "icd_last": f"{disease.name}_icd_last",
+    }
+    if disease.resolved:
+        columns["resolved_last"] = f"{disease.name}_resolved_last"
+    return columns
+
+# Column name -> (type, categories) of the features table (every registered disease, so all consumers read the same file layout)
+def feature_columns():
+    columns = {
+        "ethnicity": (str, ethnicity_categories),
+        # IMD quintile of the latest address (cohort) and of the address at study end date (demographics)
+        "imd_quintile": (str, imd_categories),
+        "imd_quintile_end": (str, imd_categories),
+    }
+    for disease in diseases:
+        columns.update({name: (datetime.date, None) for name in event_columns(disease).values()})
+    return columns
+
+# ehrQL patient table read from a features output (ehrQL imported here, so the column layout can be read without it)
+def features_table(path=features_path):
+    import types
+
+    from ehrql.tables import PatientFrame, Series, table_from_file
+
+    namespace = {
+        name: Series(column_type, categories=categories) if categories else Series(column_type)
+        for name, (column_type, categories) in feature_columns().items()
+    }
+    frame = types.new_class("features", (PatientFrame,), exec_body=lambda body: body.update(namespace))
+    return table_from_file(path)(frame)
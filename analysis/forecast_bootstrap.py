@@ -0,0 +1,36 @@
+# Batched bootstrap prediction intervals for seasonal ARIMA forecasts: all future paths are drawn as one array per model. A path
+# deviates from the point forecast by the psi-weighted sum of its innovations (psi-weights of the full AR polynomial, including
+# the non-seasonal and seasonal differencing), so with innovations resampled from the model residuals:
+#   paths = point forecast + resampled residuals (npaths x horizon) @ lower-triangular Toeplitz matrix of psi-weights
+# Window sums (e.g. observed vs predicted by year) and their empirical quantiles are taken from the same paths.
+
+import numpy as np
+from numpy.polynomial import polynomial
+
+# MA(infinity) weights psi_0..psi_{horizon-1} of a fitted SARIMAX model in levels
+def psi_weights(results, order, seasonal_order, seasonal_period, horizon):
+    from statsmodels.tsa.arima_process import arma2ma
+
+    differencing = polynomial.polypow([1, -1], order[1])
+    seasonal_differencing = polynomial.polypow([1] + [0] * (seasonal_period - 1) + [-1], seasonal_order[1])
+    ar = polynomial.polymul(polynomial.polymul(results.polynomial_reduced_ar, differencing), seasonal_differencing)
+    return arma2ma(ar, results.polynomial_reduced_ma, lags=horizon)
+
+# Lower-triangular Toeplitz matrix: row k holds psi_k, psi_{k-1}, ..., psi_0 (response of step k to the innovation at each step)
+def psi_matrix(psi):
+    lags = np.subtract.outer(np.arange(len(psi)), np.arange(len(psi)))
+    return np.where(lags >= 0, psi[np.clip(lags, 0, None)], 0.0)
+
+# Simulated future paths (npaths x horizon) with innovations resampled from the residuals
+def simulate_paths(mean, psi, residuals, npaths, rng):
+    shocks = rng.choice(np.asarray(residuals, dtype=float), size=(npaths, len(psi)))
+    return np.asarray(mean, dtype=float) + shocks @ psi_matrix(psi).T
+
+# Indicator matrix (windows x horizon) for windows given as (first, last) forecast steps, first exclusive and last inclusive
+def window_matrix(horizon, windows):
+    steps = np.arange(1, horizon + 1)
+    return np.array([(steps > first) & (steps <= last) for first, last in windows], dtype=float)
+
+# Empirical quantiles of each column (month or window) over the simulated paths
+def path_quantiles(values, probabilities=(0.025, 0.975)):
+    return np.quantile(values, probabilities, axis=0)
@@ -0,0 +1,260 @@
+# Timing instrumentation for the pipeline's Python stages and ehrQL actions. A Python stage run with --timings
+# logs/timings/{action}.json (added to each instrumented action by generate_yaml.py --instrument) records its wall time, CPU time,
+# peak RSS and rows in and out in that JSON file. ehrQL definitions are not instrumented: ehrQL loads a definition to build its
+# queries and extracts afterwards, so only a timer outside the definition measures extraction. The time command runs an ehrQL action
+# of project.yaml locally (through opensafely exec) and records its wall time; its rows out are counted from its outputs by the summary.
+#
+# Time an ehrQL action locally:
+#   python analysis/instrumentation.py time generate_dataset
+# Rank the slowest actions and diseases from the recorded timings:
+#   python analysis/instrumentation.py summary
+#   python analysis/instrumentation.py summary --directory logs/timings --top 20
+
+import datetime
+import json
+import os
+import re
+import resource
+import shlex
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from pathlib import Path
+
+timings_dir = Path("logs/timings")
+
+# Scripts that accept --timings (ehrQL actions are timed with the time command; the Stata and R stages are listed as not timed by the
+# summary)
+instrumented_scripts = [
+    "analysis/consolidate_measures.py",
+    "analysis/redact_standardise.py",
+    "analysis/render_figures.py",
+    "analysis/sarima_forecast.py",
+    "analysis/baseline_tables.py",
+    "analysis/sparse_cohort.py",
+    "analysis/interval_measures.py",
+    "analysis/measures_shards.py",
+    "analysis/patient_shards.py",
+]
+
+# Row counts are rounded to the nearest 5, as the timings are released with the other moderately sensitive logs
+def rounded(rows):
+    return None if rows is None else int(5 * round(rows / 5))
+
+# Peak resident set size in MB (ru_maxrss is in KB on Linux) of this process, or of its largest finished child process
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+class Recorder:
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self.started = datetime.datetime.now().isoformat(timespec="seconds")
+        self.start_wall = time.perf_counter()
+        self.stages = {}
+
+    # Add the wall time of a block to a named stage (repeated blocks are summed)
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    # Write the timings file (no-op without --timings); may be called again to overwrite it with later totals
+    def finish(self, rows_in=None, rows_out=None):
+        if self.path is None:
+            return
+        times = os.times()
+        record = {
+            "action": self.path.stem,
+            "script": sys.argv[0],
+            "arguments": sys.argv[1:],
+            "started": self.started,
+            "wall_seconds": round(time.perf_counter() - self.start_wall, 3),
+            # CPU time since process start, including finished worker processes
+            "cpu_seconds": round(times.user + times.system + times.children_user + times.children_system, 3),
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_children_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+            "rows_in": rounded(rows_in),
+            "rows_out": rounded(rows_out),
+            "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+        }
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps(record, indent=2) + "\n")
+        except OSError as error:
+            print(f"Could not write timings to {self.path}: {error}", file=sys.stderr)
+
+_recorder = None
+
+# Recorder shared by every module of this process, created on first use from --timings PATH (removed from sys.argv, so scripts'
+# own argument parsing is unchanged)
+def recorder():
+    global _recorder
+    if _recorder is None:
+        path = None
+        if "--timings" in sys.argv[:-1]:
+            index = sys.argv.index("--timings")
+            path = sys.argv[index + 1]
+            del sys.argv[index:index + 2]
+        _recorder = Recorder(path)
+    return _recorder
+
+# Add --timings and a timings output to each action of generated project.yaml text that runs an instrumented script
+def instrument_actions(yaml_text, directory=timings_dir):
+    from action_cache import action_blocks, append_run_args
+
+    header, blocks = action_blocks(yaml_text)
+    for name, block in blocks.items():
+        run = re.search(r"(?m)^    run: .*(?:\n      .*)*", block)
+        if not run or not any(script in run.group(0) for script in instrumented_scripts):
+            continue
+        path = f"{directory}/{name}.json"
+        block = append_run_args(block, f"--timings {path}")
+        if "      moderately_sensitive:\n" in block:
+            block = block.replace("      moderately_sensitive:\n", f"      moderately_sensitive:\n        timings: {path}\n", 1)
+        else:
+            body = block.rstrip("\n")
+            block = body + f"\n      moderately_sensitive:\n        timings: {path}\n" + block[len(body) + 1:]
+        blocks[name] = block
+    return header + "".join(blocks.values())
+
+# Run an ehrQL action of project.yaml locally and record its wall time (CPU time and memory are those of the container, not recorded)
+def time_action(name, actions, directory=timings_dir):
+    image, *arguments = shlex.split(actions[name]["run"])
+    if not image.startswith("ehrql:"):
+        raise ValueError(f"{name} is not an ehrQL action (Python stages record their own timings with --timings)")
+    started = datetime.datetime.now().isoformat(timespec="seconds")
+    start = time.perf_counter()
+    subprocess.run(["opensafely", "exec", image, *arguments], check=True)
+    record = {
+        "action": name,
+        "script": arguments[1] if len(arguments) > 1 else image,
+        "arguments": arguments,
+        "started": started,
+        "wall_seconds": round(time.perf_counter() - start, 3),
+        "cpu_seconds": None,
+        "peak_rss_mb": None,
+        "peak_rss_children_mb": None,
+        "rows_in": None,
+        "rows_out": None,
+        "stages": {},
+    }
+    path = Path(directory) / f"{name}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(record, indent=2) + "\n")
+    return record
+
+# Disease an action was run for (its --disease argument), or None
+def record_disease(record):
+    arguments = record["arguments"]
+    if "--disease" in arguments[:-1]:
+        return arguments[arguments.index("--disease") + 1]
+    return None
+
+# Rows in the output files of an action (None if any is missing or not a table)
+def output_rows(patterns):
+    import glob
+
+    from read_outputs import table_format
+
+    paths = [path for pattern in patterns for path in sorted(glob.glob(pattern))]
+    if not paths or any(table_format(path) is None for path in paths):
+        return None
+    rows = 0
+    for path in paths:
+        output_format = table_format(path)
+        if output_format == "arrow":
+            import pyarrow as pa
+
+            rows += pa.ipc.open_file(pa.memory_map(path)).read_all().num_rows
+        elif output_format == "parquet":
+            import pyarrow.parquet as parquet
+
+            rows += parquet.ParquetFile(path).metadata.num_rows
+        else:
+            import gzip
+
+            with (gzip.open if output_format == "csv.gz" else open)(path, "rt") as file:
+                rows += sum(1 for _ in file) - 1
+    return rows
+
+def read_records(directory=timings_dir):
+    return [json.loads(path.read_text()) for path in sorted(Path(directory).glob("*.json"))]
+
+def summary(records, actions=None, top=10):
+    actions = actions or {}
+    lines = []
+    for record in records:
+        if record["rows_out"] is None and record["action"] in actions:
+            tables = [path for path in actions[record["action"]]["outputs"] if not path.startswith("logs/")]
+            record["rows_out"] = output_rows(tables)
+
+    ranked = sorted(records, key=lambda record: -record["wall_seconds"])
+    lines.append(f"Slowest actions ({len(records)} recorded)")
+    lines.append(f"  {'action':<48} {'wall s':>9} {'cpu s':>9} {'peak MB':>9} {'rows in':>12} {'rows out':>12}")
+    for record in ranked[:top]:
+        peaks = [peak for peak in (record["peak_rss_mb"], record["peak_rss_children_mb"]) if peak is not None]
+        cpu = "" if record["cpu_seconds"] is None else f"{record['cpu_seconds']:.1f}"
+        peak = f"{max(peaks):.1f}" if peaks else ""
+        rows_in, rows_out = ("" if rows is None else rows for rows in (record["rows_in"], record["rows_out"]))
+        lines.append(f"  {record['action']:<48} {record['wall_seconds']:>9.1f} {cpu:>9} {peak:>9} {rows_in:>12} {rows_out:>12}")
+
+    # Wall time of the actions run for one disease alone (e.g. per-disease measures and processing chains)
+    diseases = {}
+    for record in records:
+        disease = record_disease(record)
+        if disease is not None:
+            totals = diseases.setdefault(disease, {"actions": 0.0, "count": 0})
+            totals["actions"] += record["wall_seconds"]
+            totals["count"] += 1
+    if diseases:
+        lines.append("")
+        lines.append("Slowest diseases")
+        lines.append(f"  {'disease':<24} {'single-disease actions':>23} {'action wall s':>14}")
+        for disease, totals in sorted(diseases.items(), key=lambda item: -item[1]["actions"])[:top]:
+            lines.append(f"  {disease:<24} {totals['count']:>23} {totals['actions']:>14.1f}")
+
+    recorded = {record["action"] for record in records}
+    missing = [name for name in actions if name not in recorded]
+    if missing:
+        lines.append("")
+        lines.append(f"No timings recorded for {len(missing)} action(s): {', '.join(missing)}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary")
+    summary_parser.add_argument("--directory", type=str, default=str(timings_dir))
+    summary_parser.add_argument("--project", type=str, default="project.yaml")
+    summary_parser.add_argument("--top", type=int, default=10)
+    time_parser = subparsers.add_parser("time")
+    time_parser.add_argument("action", type=str)
+    time_parser.add_argument("--directory", type=str, default=str(timings_dir))
+    time_parser.add_argument("--project", type=str, default="project.yaml")
+    args = parser.parse_args()
+
+    if args.command == "time":
+        from action_cache import parse_actions
+
+        actions = parse_actions(Path(args.project).read_text())
+        if args.action not in actions:
+            sys.exit(f"No action {args.action} in {args.project}")
+        record = time_action(args.action, actions, args.directory)
+        print(f"{args.action}: {record['wall_seconds']:.1f} s (written to {Path(args.directory) / (args.action + '.json')})")
+        sys.exit()
+
+    records = read_records(args.directory)
+    if not records:
+        sys.exit(f"No timings found in {args.directory} (generate project.yaml with --instrument and run the actions, or time ehrQL actions)")
+    actions = {}
+    if Path(args.project).exists():
+        from action_cache import parse_actions
+
+        actions = parse_actions(Path(args.project).read_text())
+    print(summary(records, actions, args.top))
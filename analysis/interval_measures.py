@@ -0,0 +1,245 @@
+# Measures computed in closed form from patient-level outputs, instead of re-querying registrations, ages and diagnoses for every
+# interval: the cohort (generate_dataset) and dates of birth and registration spells (generate_registrations) are read once, and
+# each registration spell, prevalent period and date of death becomes a range of monthly interval indices (interval k starts on the
+# first day of month k after --start-date). Registration at every interval start is then a difference array over these ranges, age
+# bands follow from the months since birth, and the denominators shared by all diseases (age band, sex, alive, current or 12-month
+# preceding registration) are computed once per patient and interval, leaving only the prevalent exclusion to each disease.
+#
+# Definitions follow dataset_definition_measures.py; numerators are counted among patients in any incidence denominator of the interval
+# (the population of an ehrQL measures run over the same diseases).
+#
+#   python analysis/interval_measures.py --start-date 2016-04-01 --intervals 104
+#     [--diseases asthma,copd] [--measures incidence,inc_ethn] [--cohort output/dataset_definition.csv or sparse output/cohort]
+#     [--registrations output/registrations] [--output output/measures/measures_dataset.csv]
+
+import csv
+from argparse import ArgumentParser
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from disease_registry import disease_names, measure_families
+from instrumentation import recorder
+from measures_shards import layout_columns
+from read_outputs import output_files, read_table
+
+# Age bands of dataset_definition_measures.py: (name, lowest age)
+age_bands = [
+    ("age_0_9", 0), ("age_10_19", 10), ("age_20_29", 20), ("age_30_39", 30), ("age_40_49", 40),
+    ("age_50_59", 50), ("age_60_69", 60), ("age_70_79", 70), ("age_greater_equal_80", 80),
+]
+sexes = ["female", "male"]
+
+# Patients processed together (memory is a few patient x interval arrays per chunk)
+chunk_size = 100000
+
+# Month number (year * 12 + month - 1) of each date, and whether it falls after the first of the month (NaN/False if missing)
+def month_numbers(dates):
+    dates = pd.to_datetime(pd.Series(dates), errors="coerce")
+    months = (dates.dt.year * 12 + dates.dt.month - 1).to_numpy(dtype=float)
+    after_first = (dates.dt.day > 1).fillna(False).to_numpy(dtype=bool)
+    return months, after_first
+
+# Index of the first interval starting on or after each date
+def first_interval_on_or_after(dates, first_month):
+    months, after_first = month_numbers(dates)
+    return months + after_first - first_month
+
+# Index of the last interval starting before each date (last interval if the date is missing)
+def last_interval_before(dates, first_month, intervals):
+    months, after_first = month_numbers(dates)
+    return np.where(np.isnan(months), intervals - 1, months + after_first - 1 - first_month)
+
+# Index of the last interval starting on or before each date (last interval if the date is missing)
+def last_interval_on_or_before(dates, first_month, intervals):
+    months, _ = month_numbers(dates)
+    return np.where(np.isnan(months), intervals - 1, months - first_month)
+
+# Patient x interval mask of interval indices within [first, last] for ranges given per row of patient (several rows per patient allowed)
+def covered(patient, first, last, patients, intervals):
+    first = np.clip(np.nan_to_num(first, nan=intervals), 0, intervals).astype(int)
+    last = np.clip(np.nan_to_num(last, nan=-1), -1, intervals - 1).astype(int)
+    keep = first <= last
+    starts = np.zeros((patients, intervals + 1), dtype=np.int32)
+    np.add.at(starts, (patient[keep], first[keep]), 1)
+    np.add.at(starts, (patient[keep], last[keep] + 1), -1)
+    return starts.cumsum(axis=1)[:, :intervals] > 0
+
+# Age band index at every interval start (-1 where no age band: missing date of birth or negative age)
+def age_band_codes(date_of_birth, first_month, intervals):
+    months, after_first = month_numbers(date_of_birth)
+    ages = np.floor((first_month + np.arange(intervals)[None, :] - months[:, None] - after_first[:, None]) / 12)
+    codes = np.searchsorted([lowest for _, lowest in age_bands], ages, side="right") - 1
+    return np.where(np.isnan(ages) | (ages < 0), -1, codes)
+
+# Grouped counts: add each interval's patients in mask to counts[interval, group]
+def add_counts(counts, mask, groups):
+    interval, patient = np.nonzero(mask.T)
+    group = groups[patient, interval] if groups.ndim == 2 else groups[patient]
+    keep = group >= 0
+    np.add.at(counts, (interval[keep], group[keep]), 1)
+
+def read_cohort(path, diseases):
+    columns = ["patient_id", "sex", "date_of_death", "ethnicity", "imd_quintile"]
+    for disease in diseases:
+        columns += [f"{disease}_inc_date", f"{disease}_resolved_date", f"{disease}_resolved", f"{disease}_pre_reg", f"{disease}_alive_inc"]
+    cohort = read_table(path, columns=columns, string_columns=["sex", "ethnicity", "imd_quintile"])
+    return cohort.sort_values("patient_id", kind="stable").reset_index(drop=True)
+
+# Dates of birth (patient table) and registration spells (event table) of the generate_registrations output directory
+def read_registrations(directory):
+    tables = {path.name.split(".")[0]: read_table(path) for path in output_files([directory])}
+    return tables["dataset"], tables["registrations"]
+
+def compute_measures(cohort, births, spells, diseases, families, start_date, intervals):
+    first_month = start_date.year * 12 + start_date.month - 1
+    prevalence_starts = list(range(0, intervals - 11, 12))
+
+    ethnicities = sorted(cohort["ethnicity"].dropna().unique())
+    imds = sorted(cohort["imd_quintile"].dropna().unique())
+    family_groups = {
+        "prevalence": len(sexes) * len(age_bands),
+        "incidence": len(sexes) * len(age_bands),
+        "inc_ethn": len(ethnicities),
+        "inc_imd": len(imds),
+    }
+    numerators = {(disease, family): np.zeros((intervals, family_groups[family]), dtype=np.int64) for disease in diseases for family in families}
+    denominators = {key: np.zeros_like(counts) for key, counts in numerators.items()}
+
+    date_of_birth = cohort["patient_id"].map(births.set_index("patient_id")["date_of_birth"])
+    spell_patient = pd.Index(cohort["patient_id"]).get_indexer(spells["patient_id"])
+    spells = spells[spell_patient >= 0].assign(patient=spell_patient[spell_patient >= 0])
+    spell_first = first_interval_on_or_after(spells["start_date"], first_month)
+    # Current registration (for_patient_on) includes a spell ending on the interval start; 12-month preceding registration excludes it
+    spell_last = last_interval_on_or_before(spells["end_date"], first_month, intervals)
+    spell_last_12m = last_interval_before(spells["end_date"], first_month, intervals)
+
+    for chunk_start in range(0, len(cohort), chunk_size):
+        chunk = cohort.iloc[chunk_start:chunk_start + chunk_size]
+        patients = len(chunk)
+        in_chunk = ((spells["patient"] >= chunk_start) & (spells["patient"] < chunk_start + patients)).to_numpy()
+        spell_patient = spells["patient"].to_numpy()[in_chunk] - chunk_start
+
+        # Denominator conditions shared by all diseases, for every patient and interval start
+        age_band = age_band_codes(date_of_birth.iloc[chunk_start:chunk_start + patients], first_month, intervals)
+        sex = pd.Index(sexes).get_indexer(chunk["sex"])
+        alive = np.arange(intervals)[None, :] <= last_interval_before(chunk["date_of_death"], first_month, intervals)[:, None]
+        eligible = (age_band >= 0) & (sex >= 0)[:, None] & alive
+        registered = covered(spell_patient, spell_first[in_chunk], spell_last[in_chunk], patients, intervals)
+        registered_12m = covered(spell_patient, spell_first[in_chunk] + 12, spell_last_12m[in_chunk], patients, intervals)
+        prevalence_denominator = eligible & registered
+        incidence_base = eligible & registered_12m
+
+        groups = {
+            "prevalence": np.where((age_band >= 0) & (sex >= 0)[:, None], sex[:, None] * len(age_bands) + age_band, -1),
+            "inc_ethn": pd.Index(ethnicities).get_indexer(chunk["ethnicity"]),
+            "inc_imd": pd.Index(imds).get_indexer(chunk["imd_quintile"]),
+        }
+        groups["incidence"] = groups["prevalence"]
+
+        # Prevalent periods: from the interval after the incident date to the last interval starting before a resolved code
+        prevalent = {}
+        for disease in diseases:
+            inc_date = chunk[f"{disease}_inc_date"]
+            resolved = chunk[f"{disease}_resolved"].fillna(False).to_numpy(dtype=bool)
+            prevalent_first = month_numbers(inc_date)[0] + 1 - first_month
+            prevalent_last = np.where(resolved, last_interval_before(chunk[f"{disease}_resolved_date"], first_month, intervals), intervals - 1)
+            prevalent[disease] = covered(np.arange(patients), prevalent_first, prevalent_last, patients, intervals)
+
+        incidence_denominator = {disease: incidence_base & ~prevalent[disease] for disease in diseases}
+        population = np.logical_or.reduce(list(incidence_denominator.values()))
+
+        for disease in diseases:
+            # Incident case in an interval: incident date within its month, 12 months preceding registration and alive at diagnosis
+            incident_month = month_numbers(chunk[f"{disease}_inc_date"])[0] - first_month
+            incident = (
+                chunk[f"{disease}_pre_reg"].fillna(False).to_numpy(dtype=bool)
+                & chunk[f"{disease}_alive_inc"].fillna(False).to_numpy(dtype=bool)
+                & (sex >= 0)
+                & (incident_month >= 0) & (incident_month < intervals)
+            )
+            incidence_numerator = covered(np.arange(patients), np.where(incident, incident_month, np.nan), incident_month, patients, intervals)
+            incidence_numerator &= (age_band >= 0) & population
+
+            for family in families:
+                if family == "prevalence":
+                    at_start = np.zeros(intervals, dtype=bool)
+                    at_start[prevalence_starts] = True
+                    add_counts(denominators[disease, family], prevalence_denominator & at_start, groups[family])
+                    add_counts(numerators[disease, family], prevalent[disease] & prevalence_denominator & at_start, groups[family])
+                else:
+                    add_counts(denominators[disease, family], incidence_denominator[disease], groups[family])
+                    add_counts(numerators[disease, family], incidence_numerator, groups[family])
+
+    group_values = {
+        "prevalence": [{"sex": sex, "age": band} for sex in sexes for band, _ in age_bands],
+        "incidence": [{"sex": sex, "age": band} for sex in sexes for band, _ in age_bands],
+        "inc_ethn": [{"ethnicity": value} for value in ethnicities],
+        "inc_imd": [{"imd": value} for value in imds],
+    }
+    rows = []
+    for disease in diseases:
+        for family in families:
+            starts = prevalence_starts if family == "prevalence" else range(intervals)
+            length = 12 if family == "prevalence" else 1
+            for interval in starts:
+                interval_start = add_months(start_date, interval)
+                interval_end = add_months(interval_start, length) - timedelta(days=1)
+                for group, values in enumerate(group_values[family]):
+                    numerator = int(numerators[disease, family][interval, group])
+                    denominator = int(denominators[disease, family][interval, group])
+                    if not numerator and not denominator:
+                        continue
+                    rows.append({
+                        "measure": f"{disease}_{family}",
+                        "interval_start": interval_start.isoformat(),
+                        "interval_end": interval_end.isoformat(),
+                        "ratio": repr(numerator / denominator) if denominator else "",
+                        "numerator": numerator,
+                        "denominator": denominator,
+                        **values,
+                    })
+    return rows
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+def write_measures(path, rows, families):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=layout_columns(families), restval="")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    timings = recorder()
+    parser = ArgumentParser()
+    parser.add_argument("--start-date", type=str, required=True)
+    parser.add_argument("--intervals", type=int, required=True)
+    parser.add_argument("--diseases", type=str)
+    parser.add_argument("--measures", type=str)
+    parser.add_argument("--cohort", type=str, default="output/dataset_definition.csv")
+    parser.add_argument("--registrations", type=str, default="output/registrations")
+    parser.add_argument("--output", type=str, default="output/measures/measures_dataset.csv")
+    args = parser.parse_args()
+
+    diseases = args.diseases.split(",") if args.diseases else disease_names()
+    families = args.measures.split(",") if args.measures else measure_families
+    unknown = [disease for disease in diseases if disease not in disease_names()] + [family for family in families if family not in measure_families]
+    if unknown:
+        parser.error(f"Unknown disease(s) or measure family(s): {', '.join(unknown)}")
+
+    with timings.stage("read_inputs"):
+        cohort = read_cohort(args.cohort, diseases)
+        births, spells = read_registrations(args.registrations)
+    start_date = date.fromisoformat(args.start_date)
+    with timings.stage("compute"):
+        rows = compute_measures(cohort, births, spells, diseases, families, start_date, args.intervals)
+    with timings.stage("write_outputs"):
+        write_measures(args.output, rows, families)
+    print(f"Wrote {len(rows)} measure rows for {len(cohort)} patients to {args.output}")
+    timings.finish(rows_in=len(cohort) + len(spells), rows_out=len(rows))
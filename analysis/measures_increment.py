@@ -0,0 +1,107 @@
+# Incremental measures refresh: merge newly computed months (the measures_increment_* action, from --since onward) into the combined
+# measures of the months before (the pinned measures_dataset_to_* action, in output/measures/base/), writing
+# output/measures/refreshed/measures_dataset.csv. The base must cover every disease up to the day before --since.
+#
+# Merge increments into the base measures (project.yaml passes the outputs of the actions the merge needs):
+#   python analysis/measures_increment.py merge --since 2024-12-01 --base output/measures/base/measures_dataset_to_2024_11.csv \
+#     output/measures/increments/measures_increment_2024_12.csv
+
+import csv
+import sys
+from datetime import date, timedelta
+from pathlib import Path
+
+from disease_registry import split_measure
+
+measures_dir = Path("output/measures")
+combined_file = measures_dir / "measures_dataset.csv"
+refreshed_dir = measures_dir / "refreshed"
+
+# Financial year (starting April) containing a date
+def financial_year(day):
+    return day.year if day.month >= 4 else day.year - 1
+
+# First day of the month after a date
+def next_month_start(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+# Existing measures files, combined output or per-disease/year files
+def measures_files(directory=measures_dir):
+    directory = Path(directory)
+    if (directory / combined_file.name).exists():
+        return [directory / combined_file.name]
+    return sorted(directory.glob("measures_dataset_*.csv"))
+
+# Last monthly incidence interval end date computed for each disease in measures files (existing output/measures/ files by default)
+def existing_coverage(paths=None):
+    coverage = {}
+    for path in measures_files() if paths is None else paths:
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                disease, family = split_measure(row["measure"])
+                if family == "prevalence":
+                    continue
+                interval_end = date.fromisoformat(row["interval_end"])
+                if disease not in coverage or interval_end > coverage[disease]:
+                    coverage[disease] = interval_end
+    return coverage
+
+def read_rows(path):
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        return reader.fieldnames, list(reader)
+
+def write_rows(path, fieldnames, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval="")
+        writer.writeheader()
+        writer.writerows(rows)
+
+# Merge increment rows into existing rows; increment rows replace existing rows for the same measure, interval and group
+def merge_rows(fieldnames, rows, new_fieldnames, new_rows):
+    fieldnames = list(fieldnames) + [name for name in new_fieldnames if name not in fieldnames]
+    key_fields = [name for name in fieldnames if name not in ("ratio", "numerator", "denominator", "interval_end")]
+    merged = {}
+    for row in list(rows) + list(new_rows):
+        merged[tuple(row.get(name, "") for name in key_fields)] = row
+    measure_order = {}
+    for row in merged.values():
+        measure_order.setdefault(row["measure"], len(measure_order))
+    ordered = sorted(merged.values(), key=lambda row: (measure_order[row["measure"]], row["interval_start"]))
+    return fieldnames, ordered
+
+# Merge increments into the base measures, which must cover every disease up to the day before the first increment month
+def merge_increments(since, base, increments, output=refreshed_dir / combined_file.name):
+    fieldnames, rows = read_rows(base)
+    new_fieldnames = []
+    new_rows = []
+    for path in increments:
+        increment_fieldnames, increment_rows = read_rows(path)
+        new_fieldnames += [name for name in increment_fieldnames if name not in new_fieldnames]
+        new_rows += increment_rows
+
+    coverage = existing_coverage([base])
+    required_end = since - timedelta(days=1)
+    diseases = sorted({split_measure(row["measure"])[0] for row in new_rows})
+    gaps = [disease for disease in diseases if coverage.get(disease, date.min) < required_end]
+    if gaps:
+        raise ValueError(
+            f"{base} does not cover {', '.join(gaps)} up to {required_end} (run the measures up to the day before --since first)"
+        )
+
+    fieldnames, merged = merge_rows(fieldnames, rows, new_fieldnames, new_rows)
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    write_rows(output, fieldnames, merged)
+    print(f"Merged {len(new_rows)} rows from {since} onward into {len(rows)} rows of {base}, written to {output}")
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "merge"
+    if command == "merge":
+        if sys.argv[2:3] != ["--since"] or sys.argv[4:5] != ["--base"] or len(sys.argv) < 7:
+            sys.exit("Usage: measures_increment.py merge --since YYYY-MM-01 --base BASE INCREMENT [INCREMENT ...]")
+        merge_increments(date.fromisoformat(sys.argv[3]), sys.argv[5], sys.argv[6:])
+    elif command == "coverage":
+        for disease, interval_end in sorted(existing_coverage().items()):
+            print(f"{disease}: {interval_end}")
+    else:
+        sys.exit(f"Unknown command: {command} (expected merge or coverage)")
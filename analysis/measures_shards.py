@@ -0,0 +1,77 @@
+# Measures shards: generate_yaml.py --measures-mode per-month / per-family splits each disease and financial year into several
+# measures actions (one per month, or one per measure family), written to output/measures/shards/. Each shard computes whole
+# measure intervals, so no cell is split across shards and the reduce step only has to recombine them: rows are regrouped into the
+# per-disease/year layout (measures_dataset_{disease}_{year}.csv) with the columns and row order of a single measures action.
+#
+# Recombine shards (run after all measures shard actions, or after one disease's shard actions for that disease only):
+#   python analysis/measures_shards.py reduce
+#   python analysis/measures_shards.py reduce asthma
+
+import re
+import sys
+from datetime import date
+from pathlib import Path
+
+from disease_registry import measure_families, split_measure
+from instrumentation import recorder
+from measures_increment import financial_year, measures_dir, read_rows, write_rows
+
+shards_dir = measures_dir / "shards"
+
+# Measure value columns, before the group_by columns of each family (see dataset_definition_measures.py)
+value_columns = ["measure", "interval_start", "interval_end", "ratio", "numerator", "denominator"]
+family_group_columns = {
+    "prevalence": ["sex", "age"],
+    "incidence": ["sex", "age"],
+    "inc_ethn": ["ethnicity"],
+    "inc_imd": ["imd"],
+}
+
+# Shard output path for a disease, financial year and shard label (e.g. month "2016_04" or family "inc_imd")
+def shard_path(disease, year, label, directory=shards_dir):
+    return Path(directory) / f"measures_{disease}_{year}_{label}.csv"
+
+# Columns of a measures file holding the given families, in the order a single measures action writes them
+def layout_columns(families):
+    columns = list(value_columns)
+    for family in measure_families:
+        if family in families:
+            columns += [column for column in family_group_columns[family] if column not in columns]
+    return columns
+
+# Rows of every shard grouped into per-disease/year files (returned by output path); rows keep their order within each measure interval
+def reduce_shards(directory=shards_dir, output_dir=measures_dir, disease=None):
+    targets = {}
+    cell_shards = {}
+    for path in sorted(Path(directory).glob("measures_*.csv")):
+        if disease is not None and not re.match(rf"measures_{re.escape(disease)}_\d{{4}}_", path.name):
+            continue
+        _, rows = read_rows(path)
+        for row in rows:
+            cell = (row["measure"], row["interval_start"])
+            if cell_shards.setdefault(cell, path) != path:
+                raise ValueError(f"Measure {cell[0]} interval {cell[1]} is in shards {cell_shards[cell]} and {path}")
+            row_disease, _ = split_measure(row["measure"])
+            year = financial_year(date.fromisoformat(row["interval_start"]))
+            targets.setdefault(Path(output_dir) / f"measures_dataset_{row_disease}_{year}.csv", []).append(row)
+
+    for path, rows in sorted(targets.items()):
+        families = [split_measure(row["measure"])[1] for row in rows]
+        ordered = sorted(rows, key=lambda row: (measure_families.index(split_measure(row["measure"])[1]), row["interval_start"]))
+        write_rows(path, layout_columns(families), ordered)
+        print(f"Reduced {len(rows)} rows into {path}")
+    return targets
+
+
+if __name__ == "__main__":
+    timings = recorder()
+    command = sys.argv[1] if len(sys.argv) > 1 else "reduce"
+    if command != "reduce":
+        sys.exit(f"Unknown command: {command} (expected reduce)")
+    disease = sys.argv[2] if len(sys.argv) > 2 else None
+    with timings.stage("reduce"):
+        targets = reduce_shards(disease=disease)
+    if not targets:
+        sys.exit(f"No measures shards found in {shards_dir}" + (f" for {disease}" if disease else ""))
+    rows = sum(len(rows) for rows in targets.values())
+    timings.finish(rows_in=rows, rows_out=rows)
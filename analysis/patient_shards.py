@@ -0,0 +1,89 @@
+# Patient-sharded cohort extraction: generate_yaml.py --dataset-shards N runs each cohort definition as N actions, each over the
+# patients of one shard, and a merge action combines the shard outputs into the usual cohort file. ehrQL outputs are ordered by
+# patient_id, so merging the (sorted) shards by patient_id gives the same rows in the same order as a single extraction; CSV rows are
+# copied as written, so the merged CSV is byte-identical.
+#
+# Shards partition patients by month of birth (year * 12 + month, modulo N; patients with no date of birth in shard 0), since ehrQL
+# does not expose patient_id as a series. Months of birth are close to uniform, so shards are of similar size for N up to ~100.
+#
+# Merge shard outputs (CSV or Arrow) into one cohort file:
+#   python analysis/patient_shards.py merge output/dataset_definition.csv output/shards/dataset_definition_*_of_4.csv
+
+import glob
+import heapq
+import sys
+from pathlib import Path
+
+from instrumentation import recorder
+
+shards_dir = Path("output/shards")
+
+# Output path of one shard of a cohort output (e.g. output/dataset_definition.csv -> output/shards/dataset_definition_1_of_4.csv)
+def shard_path(output, shard, shards):
+    output = Path(output)
+    stem, extension = output.name.split(".", 1)
+    return shards_dir / f"{stem}_{shard}_of_{shards}.{extension}"
+
+# ehrQL condition selecting the patients of one shard (imported here so the merge step does not need ehrQL)
+def in_patient_shard(shard, shards):
+    from ehrql.tables.tpp import patients
+
+    birth_month = (patients.date_of_birth.year * 12 + patients.date_of_birth.month).when_null_then(0)
+    return (birth_month - (birth_month // shards) * shards) == shard
+
+# patient_id of a CSV row (first column)
+def csv_patient_id(line):
+    return int(line.split(",", 1)[0])
+
+# Merge sorted CSV shards row by row (one row per shard held in memory), keeping rows exactly as written; returns the rows written
+def merge_csv(output, paths):
+    files = [open(path, newline="") for path in paths]
+    try:
+        headers = [file.readline() for file in files]
+        if len(set(header.rstrip("\r\n") for header in headers)) > 1:
+            raise ValueError(f"Shards have different columns: {', '.join(map(str, paths))}")
+        terminator = headers[0][len(headers[0].rstrip("\r\n")):] or "\n"
+        rows = [(line.rstrip("\r\n") for line in file if line.rstrip("\r\n")) for file in files]
+        written = 0
+        with open(output, "w", newline="") as merged:
+            merged.write(headers[0].rstrip("\r\n") + terminator)
+            for row in heapq.merge(*rows, key=csv_patient_id):
+                merged.write(row + terminator)
+                written += 1
+        return written
+    finally:
+        for file in files:
+            file.close()
+
+# Merge Arrow shards into one table ordered by patient_id
+def merge_arrow(output, paths):
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    table = pa.concat_tables([feather.read_table(path) for path in paths]).sort_by("patient_id")
+    feather.write_feather(table, output)
+    return table.num_rows
+
+# Merge shard outputs into a cohort output; returns the rows written
+def merge(output, paths):
+    if not paths:
+        raise FileNotFoundError(f"No shard outputs for {output}")
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    if str(output).endswith(".csv"):
+        return merge_csv(output, paths)
+    elif str(output).endswith(".arrow"):
+        return merge_arrow(output, paths)
+    else:
+        raise ValueError(f"Unsupported cohort output format: {output}")
+
+
+if __name__ == "__main__":
+    timings = recorder()
+    if len(sys.argv) < 4 or sys.argv[1] != "merge":
+        sys.exit("Usage: python analysis/patient_shards.py merge OUTPUT SHARD [SHARD ...]")
+    output = sys.argv[2]
+    paths = sorted(path for pattern in sys.argv[3:] for path in glob.glob(pattern))
+    with timings.stage("merge"):
+        rows = merge(output, paths)
+    print(f"Merged {len(paths)} shards into {output}")
+    timings.finish(rows_in=rows, rows_out=rows)
@@ -0,0 +1,117 @@
+# Reader shim for cohort and measures outputs in any of the formats generate_yaml.py can request (CSV, gzipped CSV, Arrow/Feather,
+# Parquet), so downstream stages read typed columns instead of re-parsing text.
+#
+# Convert outputs to Stata files for the do-files (values kept as in the CSV outputs: dates as YYYY-MM-DD, booleans as T/F):
+#   python analysis/read_outputs.py to-dta output/measures output/dataset_definition_demographics_disease.arrow
+
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+# File extension for each output format
+output_extensions = {"csv": ".csv", "csv.gz": ".csv.gz", "arrow": ".arrow", "parquet": ".parquet"}
+
+# Output path for a file stem (e.g. "output/measures/measures_dataset") in an output format
+def output_path(stem, output_format="csv"):
+    return f"{stem}{output_extensions[output_format]}"
+
+# Input files with a supported extension (directories expanded to their contents)
+def output_files(paths):
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files += sorted(child for child in path.iterdir() if table_format(child) is not None)
+        else:
+            files.append(path)
+    return files
+
+def table_format(path):
+    name = Path(path).name
+    for output_format, extension in sorted(output_extensions.items(), key=lambda item: -len(item[1])):
+        if name.endswith(extension):
+            return output_format
+    return None
+
+# Read an output file into a DataFrame (date columns as datetime64, booleans as bool, string_columns never inferred as numbers); a
+# directory is read as a sparse cohort (see sparse_cohort.py), with the columns of the wide cohort output
+def read_table(path, columns=None, string_columns=()):
+    if Path(path).is_dir():
+        from sparse_cohort import read_sparse_cohort
+
+        return read_sparse_cohort(path, columns, string_columns)
+    output_format = table_format(path)
+    if output_format in ("arrow", "parquet"):
+        import pyarrow.feather as feather
+        import pyarrow.parquet as parquet
+
+        reader = feather.read_table if output_format == "arrow" else parquet.read_table
+        return reader(str(path), columns=columns).to_pandas(date_as_object=False)
+    if output_format in ("csv", "csv.gz"):
+        table = pd.read_csv(path, usecols=columns, dtype={column: "string" for column in string_columns}, low_memory=False)
+        return typed_csv_columns(table)
+    raise ValueError(f"Unsupported output format: {path}")
+
+# Date and T/F columns of a CSV output parsed as datetime64 and bool
+def typed_csv_columns(table):
+    for column in table.columns:
+        if column.endswith("_date") or column in ("interval_start", "interval_end", "date_of_death", "registration_start"):
+            table[column] = pd.to_datetime(table[column], format="%Y-%m-%d", errors="coerce")
+        elif table[column].dropna().isin(["T", "F"]).all() and table[column].notna().any():
+            table[column] = table[column].map({"T": True, "F": False})
+    return table
+
+# Read an output file as DataFrames of at most chunk_size rows (same column types as read_table; memory bounded by the chunk size)
+def read_chunks(path, chunk_size=100000, columns=None, string_columns=()):
+    output_format = table_format(path)
+    if output_format == "arrow":
+        import pyarrow as pa
+
+        # Record batches are memory-mapped, so only the converted slice is held in memory
+        reader = pa.ipc.open_file(pa.memory_map(str(path)))
+        for index in range(reader.num_record_batches):
+            batch = reader.get_batch(index)
+            if columns is not None:
+                batch = batch.select(columns)
+            for offset in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(offset, chunk_size).to_pandas(date_as_object=False)
+    elif output_format == "parquet":
+        import pyarrow.parquet as parquet
+
+        for batch in parquet.ParquetFile(str(path)).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas(date_as_object=False)
+    elif output_format in ("csv", "csv.gz"):
+        dtype = {column: "string" for column in string_columns}
+        for table in pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=chunk_size, low_memory=False):
+            yield typed_csv_columns(table)
+    else:
+        raise ValueError(f"Unsupported output format: {path}")
+
+# Stata-compatible frame with the same values as the CSV outputs the do-files were written against
+def stata_frame(table):
+    table = table.copy()
+    for column in table.columns:
+        values = table[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            table[column] = values.dt.strftime("%Y-%m-%d").fillna("")
+        elif pd.api.types.is_bool_dtype(values) or values.dropna().map(type).eq(bool).all() and values.notna().any():
+            table[column] = values.map({True: "T", False: "F"}).fillna("")
+        elif isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(values) or values.dtype == object:
+            table[column] = values.astype(object).where(values.notna(), "").astype(str)
+        elif pd.api.types.is_extension_array_dtype(values):
+            table[column] = values.astype("float64")
+    return table
+
+# Write a Stata file next to an output (same stem, .dta extension)
+def to_dta(path):
+    dta_path = Path(str(path)[: -len(output_extensions[table_format(path)])] + ".dta")
+    stata_frame(read_table(path)).to_stata(dta_path, write_index=False, version=118)
+    return dta_path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "to-dta":
+        sys.exit("Usage: python analysis/read_outputs.py to-dta <file or directory>...")
+    for path in output_files(sys.argv[2:]):
+        if table_format(path) in ("arrow", "parquet"):
+            print(f"Wrote {to_dta(path)}")
@@ -0,0 +1,222 @@
+# Redaction, rounding and age-standardisation of the consolidated measures table in one grouped pass, replacing the per-stratum
+# egen/sort/fill-forward passes of 002_processing_data.do. Writes the same output/tables/redacted_counts_{disease}.csv files:
+#  - counts summed by measure and month (overall, and by sex, age band, ethnicity and IMD quintile), redacted if <=7 and rounded to 5
+#  - rates per 100,000 from the redacted counts, with ethnicity and IMD strata taken from the inc_ethn/inc_imd measures
+#  - rates standardised to the European Standard Population 2013, overall and by sex
+# Identical output to the do-file has not been verified against a Stata run; use --compare on the Stata processing action's tables.
+#
+#   python analysis/redact_standardise.py
+# One disease, from its own measures files (generate_yaml.py --schedule per-disease):
+#   python analysis/redact_standardise.py --disease asthma
+# Compare with existing redacted_counts files (e.g. from the Stata processing action); non-zero exit status if any differ:
+#   python analysis/redact_standardise.py --compare output/tables
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as parquet
+
+from consolidate_measures import consolidate, consolidated_dir, measures_inputs
+from disease_registry import registry
+from instrumentation import recorder
+
+tables_dir = Path("output/tables")
+
+# Strata: output column suffix -> (measures column, value)
+strata = {
+    "male": ("sex", "male"),
+    "female": ("sex", "female"),
+    "0_9": ("age", "age_0_9"),
+    "10_19": ("age", "age_10_19"),
+    "20_29": ("age", "age_20_29"),
+    "30_39": ("age", "age_30_39"),
+    "40_49": ("age", "age_40_49"),
+    "50_59": ("age", "age_50_59"),
+    "60_69": ("age", "age_60_69"),
+    "70_79": ("age", "age_70_79"),
+    "80": ("age", "age_greater_equal_80"),
+    "white": ("ethnicity", "White"),
+    "mixed": ("ethnicity", "Mixed"),
+    "black": ("ethnicity", "Black or Black British"),
+    "asian": ("ethnicity", "Asian or Asian British"),
+    "other": ("ethnicity", "Chinese or Other Ethnic Groups"),
+    "ethunk": ("ethnicity", "Unknown"),
+    "imd1": ("imd", "1 (most deprived)"),
+    "imd2": ("imd", "2"),
+    "imd3": ("imd", "3"),
+    "imd4": ("imd", "4"),
+    "imd5": ("imd", "5 (least deprived)"),
+    "imdunk": ("imd", "Unknown"),
+}
+
+# European Standard Population 2013 weights for each age band
+esp_2013 = {
+    "age_0_9": 10500,
+    "age_10_19": 11000,
+    "age_20_29": 12000,
+    "age_30_39": 13500,
+    "age_40_49": 14000,
+    "age_50_59": 13500,
+    "age_60_69": 11500,
+    "age_70_79": 9000,
+    "age_greater_equal_80": 5000,
+}
+
+# Standard population for each standardised rate (both sexes, or one sex)
+standard_population = {"all": 200000, "male": 100000, "female": 100000}
+
+# Disease titles: the measure name in proper case (e.g. "Heart Failure"), or the registry full name with underscores where it differs
+def disease_title(disease):
+    title = disease.replace("_", " ").title()
+    if disease in registry and registry[disease].display_name != title:
+        return registry[disease].display_name.replace(" ", "_")
+    return title
+
+# Consolidated measures table (Parquet output of consolidate_measures.py, or consolidated from the measures outputs), or one disease's
+# measures consolidated from its own measures outputs
+def read_measures(directory=consolidated_dir, disease=None):
+    if disease is not None:
+        measures = consolidate(measures_inputs(disease=disease))
+        measures = measures[measures["disease"] == disease].reset_index(drop=True)
+    elif Path(directory).exists():
+        measures = parquet.read_table(str(directory)).to_pandas(date_as_object=False)
+        measures["disease"] = measures["disease"].astype(str)
+    else:
+        measures = consolidate(measures_inputs())
+    return prepared(measures)
+
+# Consolidated measures with empty strings for missing group values (as in Stata) and parsed interval start dates
+def prepared(measures):
+    measures = measures.copy()
+    for column in ["sex", "age", "ethnicity", "imd"]:
+        measures[column] = measures[column].astype(object).where(measures[column].notna(), "")
+    measures["interval_start"] = pd.to_datetime(measures["interval_start"])
+    return measures
+
+# Suppress counts where numerator or denominator <=7, then round to the nearest 5; rates per 100,000 from the rounded counts
+def redact(numerator, denominator):
+    suppressed = (numerator <= 7) | (denominator <= 7)
+    numerator = np.floor(numerator.mask(suppressed) / 5 + 0.5) * 5
+    denominator = np.floor(denominator.mask(suppressed) / 5 + 0.5) * 5
+    return numerator, denominator, (numerator / denominator) * 100000
+
+def process(measures):
+    measures = measures.assign(
+        month=measures["interval_start"].dt.to_period("M"),
+        # Prevalence measures, or incidence measures (incidence, inc_ethn and inc_imd), of a disease share their strata
+        family_group=np.where(measures["measure_family"] == "prevalence", "prevalence", "incidence"),
+    )
+    measure_keys = ["disease", "family_group", "measure", "month"]
+
+    # Overall counts and rates by measure and month
+    totals = measures.groupby(measure_keys, sort=False)[["numerator", "denominator"]].sum()
+    totals["numerator_all"], totals["denominator_all"], totals["rate_all"] = redact(totals["numerator"], totals["denominator"])
+
+    # Counts by stratum: every measures row assigned to its strata in long format, then a single group-by
+    stratum_rows = []
+    for column in ["sex", "age", "ethnicity", "imd"]:
+        labels = {value: name for name, (stratum_column, value) in strata.items() if stratum_column == column}
+        rows = measures[measure_keys + ["numerator", "denominator"]].assign(stratum=measures[column].map(labels))
+        stratum_rows.append(rows[rows["stratum"].notna()])
+    by_stratum = pd.concat(stratum_rows).groupby(measure_keys + ["stratum"], sort=False)[["numerator", "denominator"]].sum()
+    by_stratum["numerator"], by_stratum["denominator"], by_stratum["rate"] = redact(by_stratum["numerator"], by_stratum["denominator"])
+    # Strata shared across the measures of a disease, month and family group (e.g. ethnicity for the incidence measure)
+    shared = by_stratum.groupby(["disease", "family_group", "month", "stratum"], sort=False).max()
+    wide = shared.unstack("stratum")
+    wide.columns = [f"{value}_{stratum}" for value, stratum in wide.columns]
+
+    # Standardised rates: ESP 2013 weighted sum of age-specific rates, overall and by sex
+    weighted = measures[measure_keys + ["sex"]].assign(
+        new_value=measures["age"].map(esp_2013).astype(float) * (measures["ratio"].astype(float) * 100000)
+    )
+    standardised = pd.DataFrame(index=totals.index)
+    standardised["s_rate_all"] = weighted.groupby(measure_keys, sort=False)["new_value"].sum() / standard_population["all"]
+    for sex in ["male", "female"]:
+        rows = weighted[weighted["sex"] == sex]
+        standardised[f"s_rate_{sex}"] = rows.groupby(measure_keys, sort=False)["new_value"].sum() / standard_population[sex]
+
+    # One row per incidence/prevalence measure and month
+    table = totals[["numerator_all", "denominator_all", "rate_all"]].join(standardised).reset_index()
+    table = table[table["measure"].str.endswith(("_incidence", "_prevalence"))]
+    table = table.join(wide, on=["disease", "family_group", "month"])
+    for name in strata:
+        for value in ["numerator", "denominator", "rate"]:
+            if f"{value}_{name}" not in table:
+                table[f"{value}_{name}"] = np.nan
+    for name in standard_population:
+        table[f"s_rate_{name}"] = table[f"s_rate_{name}"].mask(table[f"rate_{name}"].isna())
+
+    table = table.sort_values(["measure", "month"], kind="stable")
+    table["disease_full"] = table["disease"].map(disease_title)
+    table["mo_year_diagn"] = table["month"].dt.strftime("%b-%Y")
+    table["measure"] = np.where(table["measure"].str.endswith("_incidence"), "Incidence", "Prevalence")
+
+    columns = ["disease", "disease_full", "measure", "mo_year_diagn"]
+    for name in ["all", "male", "female"]:
+        columns += [f"numerator_{name}", f"denominator_{name}", f"rate_{name}", f"s_rate_{name}"]
+    for name in list(strata)[2:]:
+        columns += [f"numerator_{name}", f"denominator_{name}", f"rate_{name}"]
+    return table[columns].reset_index(drop=True)
+
+# Table as written by Stata's export delimited with display formats (%14.0f counts, %14.4f rates, missing values empty)
+def formatted(table):
+    table = table.copy()
+    for column in table.columns:
+        if column.startswith(("numerator_", "denominator_")):
+            table[column] = table[column].map(lambda value: "" if pd.isna(value) else f"{value:.0f}")
+        elif column.startswith(("rate_", "s_rate_")):
+            table[column] = table[column].map(lambda value: "" if pd.isna(value) else f"{value:.4f}")
+    return table
+
+def write_tables(table, directory=tables_dir):
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    paths = []
+    for disease, rows in formatted(table).groupby("disease", sort=False):
+        path = Path(directory) / f"redacted_counts_{disease}.csv"
+        rows.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+# Differences between computed tables and existing redacted_counts files
+def compare_tables(table, directory):
+    differences = []
+    for disease, rows in formatted(table).groupby("disease", sort=False):
+        path = Path(directory) / f"redacted_counts_{disease}.csv"
+        if not path.exists():
+            differences.append(f"{path}: missing")
+            continue
+        existing = pd.read_csv(path, dtype=str, keep_default_na=False)
+        rows = rows.reset_index(drop=True)
+        if list(existing.columns) != list(rows.columns) or len(existing) != len(rows):
+            differences.append(f"{path}: columns or number of rows differ")
+            continue
+        mismatched = (existing.values != rows.values).any(axis=1)
+        differences += [f"{path}: row {row + 2} differs" for row in np.flatnonzero(mismatched)]
+    return differences
+
+
+if __name__ == "__main__":
+    timings = recorder()
+    parser = ArgumentParser()
+    parser.add_argument("--compare", type=str, help="directory of existing redacted_counts files to compare against")
+    parser.add_argument("--disease", type=str, help="process one disease's measures only")
+    args = parser.parse_args()
+
+    with timings.stage("read_measures"):
+        measures = read_measures(disease=args.disease)
+    with timings.stage("process"):
+        table = process(measures)
+    if args.compare:
+        differences = compare_tables(table, args.compare)
+        for difference in differences:
+            print(difference)
+        if differences:
+            sys.exit(1)
+        print(f"All redacted_counts files in {args.compare} match")
+    else:
+        paths = write_tables(table)
+        print(f"Wrote {len(paths)} redacted_counts files ({len(table)} rows) to {tables_dir}")
+    timings.finish(rows_in=len(measures), rows_out=len(table))
@@ -0,0 +1,254 @@
+# Figure renderer: draws every per-disease figure family from the redacted rates (as 100_incidence_graphs.do) or the counterfactual
+# forecasts (as 200_sarima.R) in a worker pool, straight to SVG.
+#
+# Incidence and prevalence figures (also writes output/tables/arima_standardised.csv for the forecasting stage):
+#   python analysis/render_figures.py rates
+# Forecast figures (from output/tables/values_incidence_{disease}.csv for each registered disease):
+#   python analysis/render_figures.py forecasts
+# One disease's figures (generate_yaml.py --schedule per-disease; rates also writes output/tables/arima_standardised_{disease}.csv):
+#   python analysis/render_figures.py rates asthma
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from disease_registry import registry
+from instrumentation import recorder
+
+tables_dir = Path("output/tables")
+figures_dir = Path("output/figures")
+
+# Approximate RGB values of the Stata colours used in 100_incidence_graphs.do
+colours = {
+    "emerald": "#008a60",
+    "gold": "#f0b400",
+    "eltblue": "#a8c6e8",
+    "midblue": "#3c7dc4",
+    "orange": "#ff7f00",
+    "red": "#e41a1c",
+    "ltblue": "#b3d4f0",
+    "ebblue": "#4a90d9",
+    "blue": "#1f4fc4",
+    "navy": "#1a2a6c",
+}
+
+# Collapsed 20-year age bands: band -> 10-year bands summed
+age_bands_20 = {"0_19": ["0_9", "10_19"], "20_39": ["20_29", "30_39"], "40_59": ["40_49", "50_59"], "60_79": ["60_69", "70_79"]}
+age_rates = ["0_19", "20_39", "40_59", "60_79", "80", "0_9", "10_19", "20_29", "30_39", "40_49", "50_59", "60_69", "70_79"]
+moving_average_columns = (
+    ["s_rate_all", "s_rate_male", "s_rate_female", "rate_all"]
+    + [f"rate_{band}" for band in ["0_9", "10_19", "20_29", "30_39", "40_49", "50_59", "60_69", "70_79", "80"]]
+    + [f"rate_{band}" for band in age_bands_20]
+    + [f"rate_{group}" for group in ["white", "mixed", "black", "asian", "other", "ethunk"]]
+    + [f"rate_{group}" for group in ["imd1", "imd2", "imd3", "imd4", "imd5", "imdunk"]]
+)
+
+# Diseases without ethnicity figures (small counts in some groups)
+no_ethnicity_figures = ["rheumatoid", "crohns_disease", "coeliac", "pmr", "epilepsy", "multiple_sclerosis", "osteoporosis", "ulcerative_colitis"]
+
+intervention = pd.Timestamp("2020-03-01")
+
+# Centred 3-month moving average (missing at either end, or if any of the three months is missing)
+def moving_average(values):
+    return (values.shift(1) + values + values.shift(-1)) / 3
+
+# All redacted_counts tables (or one disease's) with the derived columns used by the figures
+def read_rates(directory=tables_dir, disease=None):
+    paths = sorted(Path(directory).glob(f"redacted_counts_{disease or '*'}.csv"))
+    rates = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+    rates["mo_year_diagn"] = pd.to_datetime(rates["mo_year_diagn"], format="%b-%Y")
+    rates["year"] = rates["mo_year_diagn"].dt.year
+    rates = rates.sort_values(["disease", "measure", "mo_year_diagn"], kind="stable").reset_index(drop=True)
+    rates["disease_title"] = rates["disease"].map({name: disease.figure_title for name, disease in registry.items()})
+    rates["disease_title"] = rates["disease_title"].fillna(rates["disease_full"].str.replace("_", " "))
+
+    for band, bands in age_bands_20.items():
+        for value in ["numerator", "denominator"]:
+            rates[f"{value}_{band}"] = (rates[f"{value}_{bands[0]}"] + rates[f"{value}_{bands[1]}"]).fillna(0)
+        rates[f"rate_{band}"] = (rates[f"numerator_{band}"] / rates[f"denominator_{band}"] * 100000).replace([np.inf, -np.inf], np.nan)
+
+    # Age rates more than 70% missing for a disease's incidence are dropped, then missing age rates are drawn as zero
+    incidence = rates["measure"] == "Incidence"
+    for column in [f"rate_{band}" for band in age_rates]:
+        missing = rates[column].isna().groupby([rates["disease"], incidence]).transform("mean")
+        rates.loc[incidence & (missing > 0.7), column] = np.nan
+        rates[column] = rates[column].fillna(0)
+
+    grouped = rates.groupby(["disease", "measure"], sort=False)
+    averages = {f"{column}_ma": grouped[column].transform(moving_average) for column in moving_average_columns}
+    return pd.concat([rates, pd.DataFrame(averages)], axis=1)
+
+# Incidence series for the forecasting stage (as written by 100_incidence_graphs.do)
+def write_arima_standardised(rates, path=tables_dir / "arima_standardised.csv"):
+    incidence = rates[rates["measure"] == "Incidence"]
+    table = pd.DataFrame({
+        "disease": incidence["disease"],
+        "year": incidence["year"],
+        "mo_year_diagn": incidence["mo_year_diagn"].dt.strftime("%b-%Y"),
+        "numerator": incidence["numerator_all"].map(lambda value: "" if pd.isna(value) else f"{value:.0f}"),
+        "denominator": incidence["denominator_all"].map(lambda value: "" if pd.isna(value) else f"{value:.0f}"),
+        "incidence": incidence["s_rate_all"].map(lambda value: "" if pd.isna(value) else f"{value:.4f}"),
+    })
+    table.to_csv(path, index=False)
+
+# Y-axis tick format from the minimum standardised rate
+def rate_format(minimum):
+    if minimum < 1:
+        return "{x:.1f}"
+    if minimum < 10:
+        return "{x:.2g}"
+    return "{x:.0f}"
+
+# Prevalence y-axis range: 80% of the lowest and 120% of the highest sex-specific rate, rounded by magnitude of the mean rate
+def prevalence_range(rows):
+    average = rows["s_rate_all"].mean()
+    low = 0.8 * min(rows["s_rate_male"].min(), rows["s_rate_female"].min())
+    high = 1.2 * max(rows["s_rate_male"].max(), rows["s_rate_female"].max())
+    unit = 10 ** np.floor(np.log10(average)) / 10 if average > 1 else 0.01
+    return round(low / unit) * unit, round(high / unit) * unit
+
+# Figure families drawn from the rates: name -> (measure, columns drawn as (column, colour, style))
+rate_families = {
+    "inc_adj": ("Incidence", [("s_rate_all", "emerald", "scatter"), ("s_rate_all_ma", "emerald", "line")]),
+    "adj_sex": ("Incidence", [
+        ("s_rate_male", "eltblue", "scatter"), ("s_rate_male_ma", "midblue", "line"),
+        ("s_rate_female", "orange", "scatter"), ("s_rate_female_ma", "red", "line"),
+    ]),
+    "inc_comp": ("Incidence", [("rate_all_ma", "gold", "line"), ("s_rate_all_ma", "emerald", "line")]),
+    "unadj_age": ("Incidence", [
+        ("rate_0_19_ma", "ltblue", "line"), ("rate_20_39_ma", "eltblue", "line"), ("rate_40_59_ma", "ebblue", "line"),
+        ("rate_60_79_ma", "blue", "line"), ("rate_80_ma", "navy", "line"),
+    ]),
+    "unadj_imd": ("Incidence", [
+        ("rate_imd1_ma", "ltblue", "line"), ("rate_imd2_ma", "eltblue", "line"), ("rate_imd3_ma", "ebblue", "line"),
+        ("rate_imd4_ma", "blue", "line"), ("rate_imd5_ma", "navy", "line"),
+    ]),
+    "unadj_ethn": ("Incidence", [
+        ("rate_white_ma", "ltblue", "line"), ("rate_mixed_ma", "eltblue", "line"), ("rate_black_ma", "ebblue", "line"),
+        ("rate_asian_ma", "blue", "line"), ("rate_other_ma", "navy", "line"),
+    ]),
+    "prev_adj": ("Prevalence", [
+        ("s_rate_all", "emerald", "connected"), ("s_rate_male", "midblue", "connected"), ("s_rate_female", "red", "connected"),
+    ]),
+    "prev_comp": ("Prevalence", [("rate_all", "gold", "connected"), ("s_rate_all", "emerald", "connected")]),
+}
+
+# Figure families drawn from the forecasts (file stem prefix before _incidence_{disease})
+forecast_families = ["raw_pre_covid", "differenced_pre_covid", "seasonal_pre_covid", "obs_pred"]
+
+# Figures to draw from the rates: (family, disease, input slice, output path)
+def rate_tasks(rates):
+    tasks = []
+    for disease, rows in rates.groupby("disease", sort=True):
+        for family, (measure, series) in rate_families.items():
+            if family == "unadj_ethn" and disease in no_ethnicity_figures:
+                continue
+            columns = ["mo_year_diagn", "year", "disease_title", "s_rate_all", "s_rate_male", "s_rate_female"]
+            columns += [column for column, _, _ in series if column not in columns]
+            data = rows.loc[rows["measure"] == measure, columns].reset_index(drop=True)
+            tasks.append((family, disease, data, figures_dir / f"{family}_{disease}.svg"))
+    return tasks
+
+# Figures to draw from the forecasts: one set per registered disease with a values_incidence_{disease}.csv (or only one disease's);
+# stratified forecasts (values_incidence_{disease}_{stratum}.csv) have no figures
+def forecast_tasks(directory=tables_dir, disease=None):
+    tasks = []
+    for disease in [disease] if disease else sorted(registry):
+        path = Path(directory) / f"values_incidence_{disease}.csv"
+        if not path.exists():
+            continue
+        data = pd.read_csv(path, parse_dates=["mo_year_diagn"])
+        for family in forecast_families:
+            tasks.append((family, disease, data, figures_dir / f"{family}_incidence_{disease}.svg"))
+    return tasks
+
+def render(task):
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import StrMethodFormatter
+
+    family, disease, data, path = task
+    figure, axes = plt.subplots(figsize=(8, 6))
+    if family in rate_families:
+        measure, series = rate_families[family]
+        x = data["year"] if measure == "Prevalence" else data["mo_year_diagn"]
+        for column, colour, style in series:
+            if style == "scatter":
+                axes.scatter(x, data[column], color=colours[colour], alpha=0.2, s=15)
+            elif style == "connected":
+                axes.plot(x, data[column], color=colours[colour], marker="o", markerfacecolor=colours[colour] + "4d")
+            else:
+                axes.plot(x, data[column], color=colours[colour])
+        if measure == "Prevalence":
+            axes.set_xticks(range(2016, 2024))
+            axes.axvline(2020, color="grey", linewidth=0.8)
+            low, high = prevalence_range(data)
+            if np.isfinite(low) and np.isfinite(high) and high > low:
+                axes.set_ylim(low, high)
+        else:
+            axes.set_xticks(pd.to_datetime([f"{year}-01-01" for year in range(2016, 2025, 2)]))
+            axes.xaxis.set_major_formatter(matplotlib.dates.DateFormatter("%Y"))
+            axes.axvline(intervention, color="grey", linewidth=0.8)
+            if data["s_rate_all"].notna().any():
+                axes.yaxis.set_major_formatter(StrMethodFormatter(rate_format(data["s_rate_all"].min())))
+        axes.set_title(data["disease_title"].iloc[0] if len(data) else disease)
+    else:
+        observed = data.loc[data["mo_year_diagn"] < intervention]
+        if family == "obs_pred":
+            forecast = data.loc[data["mo_year_diagn"] >= intervention]
+            axes.scatter(data["mo_year_diagn"], data["incidence"], color="#5E716A", alpha=0.25, s=12)
+            axes.plot(data["mo_year_diagn"], data["moving_average"], color="#5E716A")
+            axes.scatter(forecast["mo_year_diagn"], forecast["mean"], color="orange", alpha=0.25, s=12)
+            axes.plot(forecast["mo_year_diagn"], forecast["mean_ma"], color="orange")
+            axes.fill_between(forecast["mo_year_diagn"], forecast["lower"], forecast["upper"], color="grey", alpha=0.3, linewidth=0)
+            axes.axvline(intervention, color="grey", linestyle="--")
+            axes.set_ylabel("Monthly incidence rate per 100,000")
+        else:
+            values = observed.set_index("mo_year_diagn")["incidence"]
+            if family == "differenced_pre_covid":
+                values = values.diff()
+            elif family == "seasonal_pre_covid":
+                values = values.diff().diff(12)
+            axes.plot(values.index, values, color="blue" if family == "raw_pre_covid" else "black")
+            if family != "raw_pre_covid":
+                axes.axhline(0, color="red")
+        axes.set_title(disease.replace("_", " ").title())
+    for side in ["top", "right"]:
+        axes.spines[side].set_visible(False)
+    axes.tick_params(labelsize="small")
+    axes.grid(False)
+    figure.savefig(path)
+    plt.close(figure)
+    return str(path)
+
+# Draw the figures in a worker pool
+def render_all(tasks, workers=None):
+    figures_dir.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(render, tasks))
+
+
+if __name__ == "__main__":
+    timings = recorder()
+    command = sys.argv[1] if len(sys.argv) > 1 else "rates"
+    disease = sys.argv[2] if len(sys.argv) > 2 else None
+    suffix = f"_{disease}" if disease else ""
+    with timings.stage("read_inputs"):
+        if command == "rates":
+            rates = read_rates(disease=disease)
+            write_arima_standardised(rates, tables_dir / f"arima_standardised{suffix}.csv")
+            tasks = rate_tasks(rates)
+        elif command == "forecasts":
+            tasks = forecast_tasks(disease=disease)
+        else:
+            sys.exit(f"Unknown command: {command} (expected rates or forecasts)")
+    with timings.stage("render"):
+        rendered = render_all(tasks, workers=os.cpu_count())
+    print(f"Rendered {len(rendered)} figures")
+    timings.finish(rows_in=sum(len(task[2]) for task in tasks), rows_out=len(rendered))
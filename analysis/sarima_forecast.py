@@ -0,0 +1,216 @@
+# Counterfactual incidence forecasts (Python version of the model fitting and forecasting in 200_sarima.R): a seasonal ARIMA is fitted
+# to each series up to the intervention (March 2020) and forecast over the rest of the study period, with bootstrapped 95% prediction
+# intervals and yearly observed vs predicted sums taken from the same simulated paths. Series (one per disease, or per disease and
+# stratum if arima_standardised.csv has a stratum column) are fitted in a process pool. Writes the same tables as 200_sarima.R:
+#  - output/tables/values_incidence_{disease}.csv: observed, predicted and 3-month moving averages by month
+#  - output/tables/change_incidence_byyear.csv: observed vs predicted incidence by year after the intervention
+#
+#   python analysis/sarima_forecast.py [--workers N] [--npaths N] [--seed N]
+# One disease (generate_yaml.py --schedule per-disease), from arima_standardised_{disease}.csv to change_incidence_byyear_{disease}.csv,
+# with its log in logs/sarima_log_{disease}.txt:
+#   python analysis/sarima_forecast.py --disease asthma
+
+import hashlib
+import os
+import warnings
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import disease_registry
+from forecast_bootstrap import path_quantiles, psi_weights, simulate_paths, window_matrix
+from instrumentation import recorder
+
+input_path = Path("output/tables/arima_standardised.csv")
+tables_dir = Path("output/tables")
+log_path = Path("logs/sarima_log.txt")
+
+variable = "incidence"
+intervention = date(2020, 3, 1)
+seasonal_period = 12
+
+# Model orders chosen for each disease (from the disease registry): (order, seasonal order, include drift); other diseases use select_model()
+model_orders = {disease.name: disease.sarima_order for disease in disease_registry.diseases if disease.sarima_order}
+
+# Observed vs predicted summary windows after the intervention: column suffix -> (first month offset, last month offset or None for end)
+summary_windows = {"2020": (0, 12), "2021": (12, 24), "2022": (24, 36), "202324": (36, None), "total": (0, None)}
+summary_columns = [
+    "observed", "sum_pred_rate", "sum_pred_rate_l", "sum_pred_rate_u",
+    "change_rate", "change_ratelow", "change_ratehigh",
+    "change_rate_per", "change_rate_per_low", "change_rate_per_high",
+]
+
+# Disease titles used in change_incidence_byyear.csv
+def disease_title(disease):
+    return disease_registry.registry[disease].figure_title if disease in disease_registry.registry else disease.replace("_", " ").title()
+
+# Monthly series from arima_standardised.csv, keyed by (disease, stratum), in file order with a 1-based month index
+def read_series(path=input_path):
+    df = pd.read_csv(path)
+    df = df.rename(columns={"numerator": "count"})
+    if "stratum" not in df:
+        df["stratum"] = "all"
+    df = df[["disease", "stratum", "year", "mo_year_diagn", variable, "count"]]
+    df["month"] = df["mo_year_diagn"].str[:3]
+    df["mon_year"] = df["mo_year_diagn"].str.replace("-", " ")
+    df["mo_year_diagn"] = pd.to_datetime("01 " + df["mon_year"], format="%d %b %Y")
+    series = {}
+    for key, rows in df.groupby(["disease", "stratum"], sort=False):
+        series[key] = rows.reset_index(drop=True).assign(index=lambda rows: np.arange(1, len(rows) + 1))
+    return series
+
+def months_between(start, end):
+    return (end.year - start.year) * 12 + end.month - start.month
+
+# Seed for a series, stable across runs and worker processes
+def series_seed(seed, key):
+    return int.from_bytes(hashlib.sha256(f"{seed}:{'/'.join(key)}".encode()).digest()[:8], "little")
+
+# Regression with seasonal ARIMA errors; drift is a linear time trend (as in forecast::Arima(include.drift = TRUE))
+def fit_model(y, order, seasonal_order, drift):
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+
+    exog = np.arange(1, len(y) + 1, dtype=float)[:, None] if drift else None
+    model = SARIMAX(y, exog=exog, order=order, seasonal_order=(*seasonal_order, seasonal_period))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return model.fit(disp=False)
+
+# Model with the lowest AICc over p, q <= 5 and P, Q <= 2 (p + q + P + Q <= 5) with one seasonal difference, as auto.arima(stepwise=FALSE)
+def select_model(y):
+    from statsmodels.tsa.stattools import kpss
+
+    seasonal_diff = y[seasonal_period:] - y[:-seasonal_period]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        d = int(kpss(seasonal_diff, nlags="auto")[1] < 0.05)
+    best = None
+    for p, q, P, Q in product(range(6), range(6), range(3), range(3)):
+        if p + q + P + Q > 5:
+            continue
+        for drift in ([False, True] if d == 0 else [False]):
+            try:
+                results = fit_model(y, (p, d, q), (P, 1, Q), drift)
+            except (np.linalg.LinAlgError, ValueError):
+                continue
+            if np.isfinite(results.aicc) and (best is None or results.aicc < best[0].aicc):
+                best = (results, ((p, d, q), (P, 1, Q), drift))
+    return best
+
+# Point forecast and npaths bootstrap paths over the forecast horizon (see forecast_bootstrap.py)
+def bootstrap_forecast(results, order, seasonal_order, drift, horizon, npaths, rng):
+    n = results.nobs
+    future_exog = np.arange(n + 1, n + horizon + 1, dtype=float)[:, None] if drift else None
+    mean = np.asarray(results.forecast(horizon, exog=future_exog))
+    burn_in = order[1] + seasonal_order[1] * seasonal_period
+    psi = psi_weights(results, order, seasonal_order, seasonal_period, horizon)
+    return mean, simulate_paths(mean, psi, np.asarray(results.resid)[burn_in:], npaths, rng)
+
+# Observed vs predicted sums over a window, with the 95% interval of the predicted sum from the window sums of the bootstrap paths
+def window_summary(observed, predicted, predicted_low, predicted_high):
+    summary = [
+        observed, predicted, predicted_low, predicted_high,
+        observed - predicted, observed - predicted_low, observed - predicted_high,
+        (observed - predicted) * 100 / predicted,
+        (observed - predicted_low) * 100 / predicted_low,
+        (observed - predicted_high) * 100 / predicted_high,
+    ]
+    return [round(value, 2) for value in summary]
+
+def forecast_series(task):
+    key, df, n_preintervention, npaths, seed = task
+    disease, stratum = key
+    y = df.loc[df["index"] <= n_preintervention, variable].to_numpy(dtype=float)
+    if disease in model_orders:
+        order, seasonal_order, drift = model_orders[disease]
+        results = fit_model(y, order, seasonal_order, drift)
+    else:
+        results, (order, seasonal_order, drift) = select_model(y)
+
+    horizon = len(df) - n_preintervention
+    rng = np.random.default_rng(series_seed(seed, key))
+    mean, paths = bootstrap_forecast(results, order, seasonal_order, drift, horizon, npaths, rng)
+    lower, upper = path_quantiles(paths)
+
+    # Observed values before the intervention, forecasts after
+    values = df.copy()
+    forecast_rows = values["index"] > n_preintervention
+    for column, forecast in [("mean", mean), ("lower", lower), ("upper", upper)]:
+        values[column] = values[variable].astype(float)
+        values.loc[forecast_rows, column] = forecast
+    values["moving_average"] = values[variable].rolling(3, center=True).mean()
+    values["mean_ma"] = values["mean"].rolling(3, center=True).mean()
+
+    summary = {"disease": disease_title(disease), "measure": variable}
+    if stratum != "all":
+        summary["stratum"] = stratum
+    windows = window_matrix(horizon, [(first, horizon if last is None else last) for first, last in summary_windows.values()])
+    observed = windows @ values.loc[forecast_rows, variable].to_numpy(dtype=float)
+    predicted_low, predicted_high = path_quantiles(paths @ windows.T)
+    for suffix, window_values in zip(summary_windows, zip(observed, windows @ mean, predicted_low, predicted_high)):
+        summary.update({f"{column}.{suffix}": value for column, value in zip(summary_columns, window_summary(*window_values))})
+
+    log = (
+        f"{disease} ({stratum}): ARIMA{order}{seasonal_order}[{seasonal_period}]{' with drift' if drift else ''}\n"
+        f"{results.summary().tables[1]}\n"
+        f"AIC: {results.aic:.2f}  BIC: {results.bic:.2f}  Sigma^2: {results.params[-1]:.2f}  Log Likelihood: {results.llf:.2f}\n"
+    )
+    return key, values, summary, log
+
+# Write a table in the layout of R's write.csv (strings quoted, missing values as NA, numbers to 15 significant digits)
+def write_csv(path, table):
+    def cell(value):
+        if isinstance(value, str):
+            return '"' + value.replace('"', '""') + '"'
+        if value is None or pd.isna(value):
+            return "NA"
+        if isinstance(value, pd.Timestamp):
+            return f'"{value:%Y-%m-%d}"'
+        return f"{value:.15g}"
+
+    with open(path, "w") as f:
+        f.write(",".join(cell(column) for column in table.columns) + "\n")
+        for row in table.itertuples(index=False):
+            f.write(",".join(cell(value) for value in row) + "\n")
+
+def values_path(disease, stratum):
+    name = disease if stratum == "all" else f"{disease}_{stratum}"
+    return tables_dir / f"values_{variable}_{name}.csv"
+
+
+if __name__ == "__main__":
+    timings = recorder()
+    parser = ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--npaths", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--disease", type=str)
+    args = parser.parse_args()
+
+    suffix = f"_{args.disease}" if args.disease else ""
+    log_path = log_path.with_name(f"{log_path.stem}{suffix}{log_path.suffix}")
+
+    with timings.stage("read_series"):
+        series = read_series(input_path.with_name(f"{input_path.stem}{suffix}.csv"))
+    start = min(df["mo_year_diagn"].min() for df in series.values())
+    n_preintervention = months_between(start.date(), intervention)
+    tasks = [(key, df, n_preintervention, args.npaths, args.seed) for key, df in series.items()]
+
+    tables_dir.mkdir(parents=True, exist_ok=True)
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    summaries = []
+    with timings.stage("forecast"), ProcessPoolExecutor(max_workers=args.workers) as pool, open(log_path, "w") as log:
+        # Results are collected in series order, so outputs do not depend on which worker finishes first
+        for (disease, stratum), values, summary, text in pool.map(forecast_series, tasks):
+            output = values.drop(columns=["stratum"]) if stratum == "all" else values
+            write_csv(values_path(disease, stratum), output)
+            summaries.append(summary)
+            log.write(text + "\n")
+    write_csv(tables_dir / f"change_incidence_byyear{suffix}.csv", pd.DataFrame(summaries))
+    print(f"Forecast {len(tasks)} series; wrote {tables_dir / f'change_incidence_byyear{suffix}.csv'}")
+    timings.finish(rows_in=sum(len(df) for df in series.values()), rows_out=len(summaries))
@@ -0,0 +1,146 @@
+# Sparse layout of the cohort output (generate_dataset): ehrQL writes one wide row per patient with five columns per disease, nearly
+# all empty or False as most patients have none of the conditions. The split action rewrites it as a narrow patient table (sex, date of
+# death, registration, ethnicity, IMD) and a long table with one row per patient and disease where a diagnosis or resolved date exists.
+# Dropped rows are those equal to the values of a patient with no codes (no dates, not resolved, no preceding registration, alive at
+# diagnosis if no date of death), which read_outputs.read_table restores when given the cohort directory, so readers of the wide
+# columns read either layout.
+#
+# Split a cohort output (CSV or Arrow; written in the same format):
+#   python analysis/sparse_cohort.py split output/dataset_definition.csv output/cohort
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from disease_registry import disease_names
+from instrumentation import recorder
+from read_outputs import output_extensions, read_chunks, read_table, stata_frame, table_format
+
+cohort_dir = Path("output/cohort")
+
+# Per-disease columns of the cohort, in the order dataset_definition.py adds them ({disease}_{field})
+disease_fields = ["resolved_date", "inc_date", "pre_reg", "alive_inc", "resolved"]
+date_fields = ["resolved_date", "inc_date"]
+
+# Wide column name -> (disease, field)
+def disease_columns(diseases):
+    return {f"{disease}_{field}": (disease, field) for disease in diseases for field in disease_fields}
+
+# Value of a field for patients with no row in the long table (alive at diagnosis is True without a date of death, as in ehrQL a
+# missing incident date compares as unknown)
+def default_values(field, patients, dtype=None):
+    if field in date_fields:
+        return pd.Series(pd.NaT, index=patients.index, dtype=dtype or "datetime64[ns]")
+    if field == "alive_inc":
+        return patients["date_of_death"].isna()
+    return pd.Series(False, index=patients.index)
+
+# Patient table and long disease table of a chunk of the wide cohort (rows kept where any date is present or a flag differs from its
+# default, so the split is lossless)
+def split_chunk(chunk, diseases):
+    columns = disease_columns(diseases)
+    patients = chunk[[column for column in chunk.columns if column not in columns]]
+    rows = []
+    for disease in diseases:
+        values = chunk[[f"{disease}_{field}" for field in disease_fields]].set_axis(disease_fields, axis=1)
+        keep = values[date_fields].notna().any(axis=1)
+        for field in disease_fields:
+            if field not in date_fields:
+                keep |= (values[field] != default_values(field, patients)).to_numpy()
+        rows.append(values[keep].assign(patient_id=chunk["patient_id"][keep], disease=disease))
+    long = pd.concat(rows, ignore_index=True).sort_values("patient_id", kind="stable")
+    return patients, long[["patient_id", "disease"] + disease_fields]
+
+# Write a table in an output format (CSV with the values ehrQL writes; Arrow with dates as date32, like ehrQL's Arrow outputs)
+def write_table(table, path):
+    if table_format(path) == "arrow":
+        import pyarrow as pa
+        import pyarrow.feather as feather
+
+        arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+        schema = pa.schema([
+            field.with_type(pa.date32()) if pa.types.is_timestamp(field.type) else field for field in arrow_table.schema
+        ])
+        feather.write_feather(arrow_table.cast(schema), str(path))
+    else:
+        frame = stata_frame(table)
+        # Whole-number columns (floats only because of missing values) written as integers
+        for column in frame.columns:
+            values = frame[column]
+            if pd.api.types.is_float_dtype(values) and np.array_equal(values.dropna(), values.dropna().round()):
+                frame[column] = values.astype("Int64")
+        frame.to_csv(path, index=False)
+
+def sparse_paths(directory, extension):
+    return Path(directory) / f"patients{extension}", Path(directory) / f"diseases{extension}"
+
+# Split a wide cohort output into the sparse layout, reading it in chunks; returns the paths written and the rows read and written
+def split(path, directory=cohort_dir, diseases=None):
+    diseases = diseases or disease_names()
+    patients, long = [], []
+    rows_in = 0
+    for chunk in read_chunks(path, string_columns=["sex", "ethnicity", "imd_quintile"]):
+        rows_in += len(chunk)
+        chunk_patients, chunk_long = split_chunk(chunk, [disease for disease in diseases if f"{disease}_inc_date" in chunk])
+        patients.append(chunk_patients)
+        long.append(chunk_long)
+    patients, long = pd.concat(patients, ignore_index=True), pd.concat(long, ignore_index=True)
+    long["disease"] = pd.Categorical(long["disease"], categories=diseases)
+
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    paths = sparse_paths(directory, output_extensions[table_format(path)])
+    for table, output in zip([patients, long], paths):
+        write_table(table, output)
+    return paths, rows_in, len(patients) + len(long)
+
+# Wide cohort columns (all columns if not given) read from the sparse layout, with the same column types as read_table on the wide output
+def read_sparse_cohort(directory, columns=None, string_columns=()):
+    patients_path = next(path for path in sorted(Path(directory).iterdir()) if path.name.split(".")[0] == "patients" and table_format(path))
+    extension = output_extensions[table_format(patients_path)]
+    mapping = disease_columns(disease_names())
+    if columns is None:
+        patient_columns = None
+        wanted = list(mapping)
+    else:
+        patient_columns = [column for column in columns if column not in mapping]
+        if "patient_id" not in patient_columns:
+            patient_columns = ["patient_id"] + patient_columns
+        wanted = [column for column in mapping if column in columns]
+        # Date of death is needed for the default of alive at diagnosis
+        if any(mapping[column][1] == "alive_inc" for column in wanted) and "date_of_death" not in patient_columns:
+            patient_columns = patient_columns + ["date_of_death"]
+    patients = read_table(patients_path, columns=patient_columns, string_columns=[column for column in string_columns if column not in mapping])
+    long = read_table(sparse_paths(directory, extension)[1], string_columns=["disease"])
+
+    by_disease = {str(disease): rows for disease, rows in long.groupby("disease", observed=True, sort=False)}
+    patient_index = pd.Index(patients["patient_id"])
+    values = {}
+    for column in wanted:
+        disease, field = mapping[column]
+        rows = by_disease.get(disease, long.iloc[:0])
+        series = default_values(field, patients, rows[field].dtype if field in date_fields else None)
+        if len(rows):
+            if series.dtype != rows[field].dtype and field not in date_fields:
+                series = series.astype(object)
+            series.iloc[patient_index.get_indexer(rows["patient_id"])] = rows[field].to_numpy()
+        values[column] = series
+    cohort = pd.concat([patients, pd.DataFrame(values, index=patients.index)], axis=1)
+    if columns is not None:
+        cohort = cohort[[column for column in cohort.columns if column in columns]]
+    return cohort
+
+
+if __name__ == "__main__":
+    timings = recorder()
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command != "split" or len(sys.argv) < 3:
+        sys.exit("Usage: python analysis/sparse_cohort.py split COHORT [DIRECTORY]")
+    path = sys.argv[2]
+    directory = sys.argv[3] if len(sys.argv) > 3 else cohort_dir
+    with timings.stage("split"):
+        paths, rows_in, rows_out = split(path, directory)
+    timings.finish(rows_in, rows_out)
+    for output in paths:
+        print(f"Wrote {output}")
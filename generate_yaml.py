@@ -1,4 +1,93 @@
-diseases = ["asthma", "copd", "chd", "stroke", "heart_failure", "dementia", "multiple_sclerosis", "epilepsy", "crohns_disease", "ulcerative_colitis", "dm_type2", "ckd", "psoriasis", "atopic_dermatitis", "osteoporosis", "rheumatoid", "depression", "depression_broad", "coeliac", "pmr"]
+import sys
+from argparse import ArgumentParser
+from datetime import date, timedelta
+
+sys.path.insert(0, "analysis")
+from measures_increment import next_month_start, refreshed_dir
+from action_cache import add_definition_args, append_run_args, update_manifest
+from disease_registry import cohort_end_date, disease_names, measure_families, missing_codelists
+from instrumentation import instrument_actions
+from patient_shards import shard_path
+from measures_shards import shard_path as measures_shard_path
+
+parser = ArgumentParser()
+# combined: one measures action covering every disease and the full study period; per-disease: one action per disease and financial year;
+# per-month / per-family: each disease and financial year split into one action per month (prevalence in its own yearly action) or per
+# measure family, recombined into the per-disease layout by measures_shards.py; interval: every interval computed in one Python pass
+# over the cohort, dates of birth and registration spells (interval_measures.py)
+parser.add_argument("--measures-mode", choices=["combined", "per-disease", "per-month", "per-family", "interval"], default="combined")
+# Study end date (last monthly interval ends in this month)
+parser.add_argument("--end-date", type=str, default="2024-11-30")
+# Only compute months from --since onward, merged into the combined measures of the months before (a measures_dataset_to_* action
+# pinned to the day before --since, run once and reused by later refreshes from the same month) in output/measures/refreshed/
+parser.add_argument("--incremental", action="store_true")
+# First month recomputed by --incremental (first day of a month)
+parser.add_argument("--since", type=str)
+# Format of cohort and measures outputs (arrow: typed, compressed columnar files, converted to Stata files for the do-files)
+parser.add_argument("--output-format", choices=["csv", "arrow"], default="csv")
+# Engine for redaction, rounding and standardisation of measures (python: one grouped pass over the consolidated measures table)
+parser.add_argument("--processing", choices=["stata", "python"], default="stata")
+# Engine for the counterfactual SARIMA forecasts (python: all series fitted in a process pool; tables only)
+parser.add_argument("--forecasting", choices=["r", "python"], default="r")
+# Figure renderer (python: every figure family drawn in a worker pool, skipping figures whose input data are unchanged)
+parser.add_argument("--figures", choices=["stata", "python"], default="stata")
+# Engine for the baseline tables (python: one streamed pass over the demographics cohort for the reference and all disease tables)
+parser.add_argument("--baseline", choices=["stata", "python"], default="stata")
+# Split each cohort extraction into N actions over disjoint patient shards, merged back into the usual cohort file
+parser.add_argument("--dataset-shards", type=int, default=1)
+# Derive event dates, ethnicity and IMD once in a features action, read by the cohort and measures actions
+parser.add_argument("--features", action="store_true")
+# Record wall time, CPU time, peak memory and rows of each Python stage in logs/timings/{action}.json (ehrQL actions are timed with
+# python analysis/instrumentation.py time; all ranked by python analysis/instrumentation.py summary)
+parser.add_argument("--instrument", action="store_true")
+# barrier: processing, figures and forecasts each run once for all diseases, after every measures action; per-disease: a chain of
+# processing, figures and forecasting actions per disease needing only that disease's measures (see disease_dag.py)
+parser.add_argument("--schedule", choices=["barrier", "per-disease"], default="barrier")
+# Also write the cohort as a narrow patient table and a long table of patient x disease rows with any diagnosis date (sparse_cohort.py),
+# read by the interval measures instead of the wide cohort
+parser.add_argument("--sparse-cohort", action="store_true")
+args = parser.parse_args()
+
+if args.incremental and args.output_format != "csv":
+    parser.error("--incremental merges CSV measures outputs; use --output-format csv")
+if args.incremental and args.measures_mode != "combined":
+    parser.error("--incremental extends the combined measures output; use --measures-mode combined")
+if args.incremental and args.schedule != "barrier":
+    parser.error("--incremental merges the measures of all diseases before processing; use --schedule barrier")
+if args.incremental and not args.since:
+    parser.error("--incremental needs --since, the first month to recompute")
+if args.since and not args.incremental:
+    parser.error("--since is only used with --incremental")
+if args.measures_mode in ("per-month", "per-family") and args.output_format != "csv":
+    parser.error(f"--measures-mode {args.measures_mode} reduces CSV measures shards; use --output-format csv")
+
+end_date = date.fromisoformat(args.end_date)
+if next_month_start(end_date) - end_date != timedelta(days=1):
+    parser.error("--end-date must be the last day of a month (the last monthly interval ends on it)")
+
+if args.dataset_shards < 1:
+    parser.error("--dataset-shards must be at least 1")
+if args.schedule == "per-disease" and (args.processing, args.figures, args.forecasting) != ("python", "python", "python"):
+    parser.error("--schedule per-disease runs the Python stages per disease; use --processing python --figures python --forecasting python")
+
+ext = {"csv": ".csv", "arrow": ".arrow"}[args.output_format]
+
+# Extra arguments and needs of the cohort and measures actions reading the features table
+features_output = f"output/features{ext}"
+features_format = {"features_args": "", "features_needs": ""}
+features_dataset_args = ""
+features_dataset_needs = ""
+if args.features:
+    features_format = {"features_args": f"\n      --features {features_output}", "features_needs": ", generate_features"}
+    features_dataset_args = f"\n      --\n      --features {features_output}"
+    features_dataset_needs = "\n    needs: [generate_features]"
+
+diseases = disease_names()
+
+# Fail before writing project.yaml if a registered codelist is not defined in codelists_ehrQL.py
+missing = missing_codelists()
+if missing:
+    parser.error("; ".join(f"codelist {codelist} of {disease} is not defined" for disease, codelist in missing))
 
 yaml_header = """
 version: '3.0'
@@ -8,71 +97,372 @@ expectations:
 
 actions:
              
-  generate_dataset:
-    run: ehrql:v1 generate-dataset analysis/dataset_definition.py
-      --output output/dataset_definition.csv
+"""
+
+yaml_template_features = """  generate_features:
+    run: ehrql:v1 generate-dataset analysis/dataset_definition_features.py
+      --output {output}
+    outputs:
+      highly_sensitive:
+        features: {output}
+
+"""
+
+yaml_template_dataset = """  {name}:
+    run: ehrql:v1 generate-dataset analysis/{definition}.py
+      --output output/{definition}{ext}{features_args}{features_needs}
+    outputs:
+      highly_sensitive:
+        cohort: output/{definition}{ext}
+"""
+
+yaml_template_dataset_shard = """
+  {name}_shard_{shard}:
+    run: ehrql:v1 generate-dataset analysis/{definition}.py
+      --output {output}
+      --
+      --shard {shard}
+      --shards {shards}{features_args}{features_needs}
+    outputs:
+      highly_sensitive:
+        cohort: {output}
+"""
+
+# Shards are merged by an action with the unsharded action's name, so downstream needs are the same in both modes
+yaml_template_dataset_merge = """
+  {name}:
+    run: python:v2 analysis/patient_shards.py merge output/{definition}{ext} {pattern}
+    needs: [{needs}]
     outputs:
       highly_sensitive:
-        cohort: output/dataset_definition.csv
+        cohort: output/{definition}{ext}
+"""
+
+yaml_template_sparse_cohort = """
+  split_cohort:
+    run: python:v2 analysis/sparse_cohort.py split output/dataset_definition{ext} output/cohort
+    needs: [generate_dataset]
+    outputs:
+      highly_sensitive:
+        patients: output/cohort/patients{ext}
+        diseases: output/cohort/diseases{ext}
+"""
+
+yaml_datasets = {
+    "generate_dataset": "dataset_definition",
+    "generate_dataset_demographics_disease": "dataset_definition_demographics_disease",
+}
+# Number of monthly intervals from start date up to and including the month of end date
+def months_between(start_date, end_date):
+    start_date, end_date = date.fromisoformat(str(start_date)), date.fromisoformat(str(end_date))
+    return (end_date.year - start_date.year) * 12 + (end_date.month - start_date.month) + 1
+
+# Study period for measures (financial years from April 2016 to study end date)
+study_start_date = "2016-04-01"
+study_end_date = args.end_date
+study_intervals = months_between(study_start_date, study_end_date)
 
-  generate_dataset_demographics_disease:
-    run: ehrql:v1 generate-dataset analysis/dataset_definition_demographics_disease.py
-      --output output/dataset_definition_demographics_disease.csv
+yaml_template_combined = """
+  measures_dataset:
+    run: ehrql:v1 generate-measures analysis/dataset_definition_measures.py
+      --output output/measures/measures_dataset{ext}
+      --
+      --start-date "{start_date}"
+      --intervals {intervals}
+      --diseases "{diseases}"{features_args}
+    needs: [generate_dataset{features_needs}]
     outputs:
       highly_sensitive:
-        cohort: output/dataset_definition_demographics_disease.csv        
+        measure_csv: output/measures/measures_dataset{ext}
 """
+
 yaml_template = """
   measures_dataset_{disease}_{year}:
     run: ehrql:v1 generate-measures analysis/dataset_definition_measures.py
-      --output output/measures/measures_dataset_{disease}_{year}.csv
+      --output output/measures/measures_dataset_{disease}_{year}{ext}
       --
       --start-date "{year}-04-01"
       --intervals {intervals}
+      --disease "{disease}"{features_args}
+    needs: [generate_dataset{features_needs}]
+    outputs:
+      highly_sensitive:
+        measure_csv: output/measures/measures_dataset_{disease}_{year}{ext}
+"""
+
+yaml_template_shard = """
+  measures_{disease}_{year}_{label}:
+    run: ehrql:v1 generate-measures analysis/dataset_definition_measures.py
+      --output {output}
+      --
+      --start-date "{start_date}"
+      --intervals {intervals}
       --disease "{disease}"
-    needs: [generate_dataset]
+      --measures "{families}"{features_args}
+    needs: [generate_dataset{features_needs}]
+    outputs:
+      highly_sensitive:
+        measure_csv: {output}
+"""
+
+yaml_template_reduce = """
+  reduce_measures_shards:
+    run: python:v2 analysis/measures_shards.py reduce
+    needs: [{needs}]
+    outputs:
+      highly_sensitive:
+        measure_csv: output/measures/measures_dataset_*.csv
+"""
+
+yaml_template_reduce_disease = """
+  reduce_measures_shards_{disease}:
+    run: python:v2 analysis/measures_shards.py reduce {disease}
+    needs: [{needs}]
+    outputs:
+      highly_sensitive:{outputs}
+"""
+
+yaml_template_interval = """
+  generate_registrations:
+    run: ehrql:v1 generate-dataset analysis/dataset_definition_registrations.py
+      --output output/registrations:{output_format}
+    outputs:
+      highly_sensitive:
+        registrations: output/registrations/*.{output_format}
+
+  measures_dataset:
+    run: python:v2 analysis/interval_measures.py
+      --start-date "{start_date}"
+      --intervals {intervals}
+      --diseases "{diseases}"
+      --cohort {cohort}
+      --registrations output/registrations
+    needs: [{cohort_needs}, generate_registrations]
     outputs:
       highly_sensitive:
-        measure_csv: output/measures/measures_dataset_{disease}_{year}.csv
+        measure_csv: output/measures/measures_dataset.csv
+"""
+
+yaml_template_increment = """
+  measures_increment_{label}:
+    run: ehrql:v1 generate-measures analysis/dataset_definition_measures.py
+      --output output/measures/increments/measures_increment_{label}.csv
+      --
+      --start-date "{start_date}"
+      --intervals {intervals}
+      --diseases "{diseases}"
+      --incremental{features_args}
+    needs: [generate_dataset{features_needs}]
+    outputs:
+      highly_sensitive:
+        measure_csv: output/measures/increments/measures_increment_{label}.csv
+"""
+
+# The combined measures up to the day before --since, the base of the refresh (its own action and output, so the merge reads
+# exactly this output rather than whichever combined measures a previous run left behind)
+yaml_template_base = """
+  measures_dataset_to_{label}:
+    run: ehrql:v1 generate-measures analysis/dataset_definition_measures.py
+      --output output/measures/base/measures_dataset_to_{label}.csv
+      --
+      --start-date "{start_date}"
+      --intervals {intervals}
+      --diseases "{diseases}"{features_args}
+    needs: [generate_dataset{features_needs}]
+    outputs:
+      highly_sensitive:
+        measure_csv: output/measures/base/measures_dataset_to_{label}.csv
+"""
+
+# Checks when run that the base measures cover every month before --since, so the merged months have no gap
+yaml_template_merge = """
+  merge_measures_increments:
+    run: python:v2 analysis/measures_increment.py merge --since {since}
+      --base output/measures/base/measures_dataset_to_{base_label}.csv
+      output/measures/increments/measures_increment_{label}.csv
+    needs: [measures_dataset_to_{base_label}, measures_increment_{label}]
+    outputs:
+      highly_sensitive:
+        measure_csv: {output}
 """
 
 yaml_body = ""
 all_needs = []
+# Measures actions of each disease (diseases measured together in one action need all of all_needs)
+disease_needs = {}
 
-for year in range(2016, 2025):
-    intervals = 8 if year == 2024 else 12  # Set monthly intervals according to year
-    for disease in diseases:
-        yaml_body += yaml_template.format(disease=disease, year=year, intervals=intervals)
-        all_needs.append(f"measures_dataset_{disease}_{year}")
+# Measures directory read by consolidation (the merged refresh output with --incremental)
+consolidate_args = ""
 
-needs_list = ", ".join(all_needs)
+if args.incremental:
+    # The combined measures pinned to the day before --since (with that end date, so the same --since always gives the same base
+    # action and output), then the new months for every disease
+    since = date.fromisoformat(args.since)
+    if since.day != 1:
+        parser.error("--since must be the first day of a month")
+    if not date.fromisoformat(study_start_date) < since <= end_date:
+        parser.error(f"--since must be after the first study month ({study_start_date}) and not after --end-date")
+    base_end = since - timedelta(days=1)
+    base_label = base_end.strftime("%Y_%m")
+    base_action = yaml_template_base.format(
+        label=base_label, start_date=study_start_date, intervals=months_between(study_start_date, base_end), diseases=",".join(diseases),
+        **features_format,
+    )
+    # Always given its end date, so a later --end-date (passed to every other definition) does not change the base
+    base_action = append_run_args(base_action, f"--end-date {base_end}")
+    label = since.strftime("%Y_%m")
+    yaml_body += base_action
+    yaml_body += yaml_template_increment.format(
+        label=label,
+        start_date=since,
+        intervals=months_between(since, study_end_date),
+        diseases=",".join(diseases),
+        **features_format,
+    )
+    yaml_body += yaml_template_merge.format(
+        since=since, base_label=base_label, label=label, output=f"{refreshed_dir}/measures_dataset.csv"
+    )
+    all_needs.append("merge_measures_increments")
+    consolidate_args = f" {refreshed_dir}"
+elif args.measures_mode == "combined":
+    yaml_body += yaml_template_combined.format(start_date=study_start_date, intervals=study_intervals, diseases=",".join(diseases), ext=ext, **features_format)
+    all_needs.append("measures_dataset")
+elif args.measures_mode == "interval":
+    yaml_body += yaml_template_interval.format(
+        output_format=args.output_format, start_date=study_start_date, intervals=study_intervals, diseases=",".join(diseases),
+        cohort="output/cohort" if args.sparse_cohort else f"output/dataset_definition{ext}",
+        cohort_needs="split_cohort" if args.sparse_cohort else "generate_dataset",
+    )
+    all_needs.append("measures_dataset")
+elif args.measures_mode == "per-disease":
+    for year in range(int(study_start_date[:4]), int(study_end_date[:4]) + 1):
+        intervals = min(12, months_between(f"{year}-04-01", study_end_date))  # Set monthly intervals according to year
+        if intervals < 1:
+            continue
+        for disease in diseases:
+            yaml_body += yaml_template.format(disease=disease, year=year, intervals=intervals, ext=ext, **features_format)
+            all_needs.append(f"measures_dataset_{disease}_{year}")
+            disease_needs.setdefault(disease, []).append(f"measures_dataset_{disease}_{year}")
+else:
+    # Shards of each disease and financial year: (label, start date, intervals, measure families)
+    shard_needs = []
+    shard_years = []
+    for year in range(int(study_start_date[:4]), int(study_end_date[:4]) + 1):
+        intervals = min(12, months_between(f"{year}-04-01", study_end_date))
+        if intervals < 1:
+            continue
+        # Prevalence is measured over whole financial years, so it stays one action per year (none for a part year)
+        shards = [("prevalence", date(year, 4, 1), intervals, ["prevalence"])] if intervals == 12 else []
+        if args.measures_mode == "per-family":
+            shards += [(family, date(year, 4, 1), intervals, [family]) for family in measure_families[1:]]
+        else:
+            for month in range(intervals):
+                month_start = date(year + (3 + month) // 12, (3 + month) % 12 + 1, 1)
+                shards.append((month_start.strftime("%Y_%m"), month_start, 1, measure_families[1:]))
+        for disease in diseases:
+            for label, start_date, shard_intervals, families in shards:
+                yaml_body += yaml_template_shard.format(
+                    disease=disease,
+                    year=year,
+                    label=label,
+                    output=measures_shard_path(disease, year, label),
+                    start_date=start_date,
+                    intervals=shard_intervals,
+                    families=",".join(families),
+                    **features_format,
+                )
+                shard_needs.append(f"measures_{disease}_{year}_{label}")
+                disease_needs.setdefault(disease, []).append(f"measures_{disease}_{year}_{label}")
+        shard_years.append(year)
+    if args.schedule == "per-disease":
+        # Each disease's shards are reduced as soon as they are done
+        for disease in diseases:
+            yaml_body += yaml_template_reduce_disease.format(
+                disease=disease,
+                needs=", ".join(disease_needs[disease]),
+                outputs="".join(f"\n        measure_csv_{year}: output/measures/measures_dataset_{disease}_{year}.csv" for year in shard_years),
+            )
+            disease_needs[disease] = [f"reduce_measures_shards_{disease}"]
+            all_needs.append(f"reduce_measures_shards_{disease}")
+    else:
+        yaml_body += yaml_template_reduce.format(needs=", ".join(shard_needs))
+        all_needs.append("reduce_measures_shards")
 
-yaml_footer_template = f"""
-  run_baseline_data_reference_all:
-    run: stata-mp:latest analysis/000_baseline_data_reference_all.do
+yaml_template_convert = """
+  convert_demographics_dta:
+    run: python:v2 analysis/read_outputs.py to-dta output/dataset_definition_demographics_disease{ext}
     needs: [generate_dataset_demographics_disease]
     outputs:
-      moderately_sensitive:
-        log1: logs/baseline_data_reference_all.log   
-        table1: output/tables/reference_table_rounded_all.csv       
+      highly_sensitive:
+        cohort: output/dataset_definition_demographics_disease.dta
 
-  run_baseline_data_diseases:
-    run: stata-mp:latest analysis/001_baseline_data_diseases.do
-    needs: [generate_dataset_demographics_disease]
+"""
+
+yaml_template_consolidate = """
+  consolidate_measures:
+    run: python:v2 analysis/consolidate_measures.py{directory}
+    needs: [{needs}]
     outputs:
-      moderately_sensitive:
-        log1: logs/baseline_data_diseases.log   
-        table1: output/tables/baseline_table_rounded.csv
+      highly_sensitive:
+        measures: output/data/measures_consolidated/*/*.parquet
+        measures_dta: output/data/measures_consolidated.dta
+"""
+
+# Columnar cohort outputs are converted to Stata files for the do-files (the Python baseline stage reads them directly)
+demographics_needs = "generate_dataset_demographics_disease"
+if args.output_format != "csv" and args.baseline == "stata":
+    yaml_body += yaml_template_convert.format(ext=ext)
+    demographics_needs = "convert_demographics_dta"
+
+# Measures actions each disease's processing needs (all of them for diseases measured together), before all_needs is replaced
+disease_needs = {disease: disease_needs.get(disease, all_needs) for disease in diseases}
+
+# Consolidate all measures outputs (any format) into one partitioned table in a single pass (per-disease processing reads each
+# disease's measures outputs directly)
+if args.schedule == "barrier":
+    yaml_body += yaml_template_consolidate.format(directory=consolidate_args, needs=", ".join(all_needs))
+    all_needs = ["consolidate_measures"]
 
+needs_list = ", ".join(["generate_dataset"] + all_needs)
+
+if args.processing == "python":
+    processing_action = f"""
+  run_data_processing:
+    run: python:v2 analysis/redact_standardise.py
+    needs: [{', '.join(all_needs)}]
+    outputs:
+      moderately_sensitive:
+        table1: output/tables/redacted_counts_*.csv
+"""
+else:
+    processing_action = f"""
   run_data_processing:
-    run: stata-mp:latest analysis/002_processing_data.do
-    needs: [generate_dataset, {needs_list}]
+    run: stata-mp:latest analysis/002_processing_data.do output/data/measures_consolidated.dta
+    needs: [{needs_list}]
     outputs:
       moderately_sensitive:
         log1: logs/processing_data.log   
         table1: output/tables/redacted_counts_*.csv
+"""
 
-  run_incidence_graphs:
+if args.figures == "python":
+    graphs_action = """  run_incidence_graphs:
+    run: python:v2 analysis/render_figures.py rates
+    needs: [run_data_processing]
+    outputs:
+      moderately_sensitive:
+        figure1: output/figures/inc_comp_*.svg
+        figure2: output/figures/prev_comp_*.svg
+        figure3: output/figures/prev_adj_*.svg
+        figure4: output/figures/inc_adj_*.svg
+        figure5: output/figures/adj_sex_*.svg
+        figure6: output/figures/unadj_age_*.svg
+        figure7: output/figures/unadj_ethn_*.svg
+        figure8: output/figures/unadj_imd_*.svg
+        table1: output/tables/arima_standardised.csv
+"""
+else:
+    graphs_action = """  run_incidence_graphs:
     run: stata-mp:latest analysis/100_incidence_graphs.do
     needs: [run_data_processing]
     outputs:
@@ -87,7 +477,21 @@ yaml_footer_template = f"""
         figure7: output/figures/unadj_ethn_*.svg
         figure8: output/figures/unadj_imd_*.svg
         table1: output/tables/arima_standardised.csv
+"""
 
+if args.forecasting == "python":
+    forecasting_action = """
+  run_sarima:
+    run: python:v2 analysis/sarima_forecast.py
+    needs: [run_incidence_graphs]
+    outputs:
+      moderately_sensitive:
+        log1: logs/sarima_log.txt
+        table1: output/tables/change_incidence_byyear.csv
+        table3: output/tables/values_*.csv
+"""
+else:
+    forecasting_action = """
   run_sarima:
     run: r:latest analysis/200_sarima.R
     needs: [run_incidence_graphs]
@@ -105,11 +509,149 @@ yaml_footer_template = f"""
         table3: output/tables/values_*.csv   
 """
 
+# Forecast figures drawn by the renderer when forecasts come from the Python stage
+forecast_figures_action = ""
+if args.figures == "python" and args.forecasting == "python":
+    forecast_figures_action = """
+  render_forecast_figures:
+    run: python:v2 analysis/render_figures.py forecasts
+    needs: [run_sarima]
+    outputs:
+      moderately_sensitive:
+        figure1: output/figures/raw_pre_covid_*.svg
+        figure2: output/figures/differenced_pre_covid_*.svg
+        figure3: output/figures/seasonal_pre_covid_*.svg
+        figure4: output/figures/obs_pred_*.svg
+"""
+
+# Per-disease chains of processing, figures and forecasts, and the all-disease tables recombined after every disease's forecasts
+yaml_template_disease_chain = """
+  process_{disease}:
+    run: python:v2 analysis/redact_standardise.py --disease {disease}
+    needs: [{needs}]
+    outputs:
+      moderately_sensitive:
+        table1: output/tables/redacted_counts_{disease}.csv
+
+  graphs_{disease}:
+    run: python:v2 analysis/render_figures.py rates {disease}
+    needs: [process_{disease}]
+    outputs:
+      moderately_sensitive:{rate_figures}
+        table1: output/tables/arima_standardised_{disease}.csv
+
+  sarima_{disease}:
+    run: python:v2 analysis/sarima_forecast.py --disease {disease}
+    needs: [graphs_{disease}]
+    outputs:
+      moderately_sensitive:
+        log1: logs/sarima_log_{disease}.txt
+        table1: output/tables/change_incidence_byyear_{disease}.csv
+        table3: output/tables/values_incidence_{disease}.csv
+
+  forecast_figures_{disease}:
+    run: python:v2 analysis/render_figures.py forecasts {disease}
+    needs: [sarima_{disease}]
+    outputs:
+      moderately_sensitive:{forecast_figures}
+"""
+
+yaml_template_gather = """
+  gather_disease_tables:
+    run: python:v2 analysis/disease_dag.py gather
+    needs: [{needs}]
+    outputs:
+      moderately_sensitive:
+        table1: output/tables/arima_standardised.csv
+        table2: output/tables/change_incidence_byyear.csv
+"""
+
+if args.schedule == "per-disease":
+    # Figure lists come from the renderer (numpy, matplotlib), only needed for per-disease chains
+    from disease_dag import forecast_figures, rate_figures
+
+    processing_action = ""
+    for disease in diseases:
+        processing_action += yaml_template_disease_chain.format(
+            disease=disease,
+            needs=", ".join(disease_needs[disease]),
+            rate_figures="".join(f"\n        figure{index}: {path}" for index, path in enumerate(rate_figures(disease), start=1)),
+            forecast_figures="".join(f"\n        figure{index}: {path}" for index, path in enumerate(forecast_figures(disease), start=1)),
+        )
+    processing_action += yaml_template_gather.format(needs=", ".join(f"sarima_{disease}" for disease in diseases))
+    graphs_action = forecasting_action = forecast_figures_action = ""
+
+if args.baseline == "python":
+    baseline_actions = f"""
+  run_baseline_tables:
+    run: python:v2 analysis/baseline_tables.py --input output/dataset_definition_demographics_disease{ext}
+    needs: [{demographics_needs}]
+    outputs:
+      moderately_sensitive:
+        table1: output/tables/reference_table_rounded_all.csv
+        table2: output/tables/baseline_table_rounded.csv
+"""
+else:
+    baseline_actions = f"""
+  run_baseline_data_reference_all:
+    run: stata-mp:latest analysis/000_baseline_data_reference_all.do
+    needs: [{demographics_needs}]
+    outputs:
+      moderately_sensitive:
+        log1: logs/baseline_data_reference_all.log   
+        table1: output/tables/reference_table_rounded_all.csv       
+
+  run_baseline_data_diseases:
+    run: stata-mp:latest analysis/001_baseline_data_diseases.do
+    needs: [{demographics_needs}]
+    outputs:
+      moderately_sensitive:
+        log1: logs/baseline_data_diseases.log   
+        table1: output/tables/baseline_table_rounded.csv
+"""
+
+yaml_footer_template = f"""{baseline_actions}{processing_action}
+{graphs_action}{forecasting_action}{forecast_figures_action}"""
+
 yaml_footer = yaml_footer_template.format(needs_list=needs_list)
 
+if args.dataset_shards == 1:
+    yaml_dataset = "\n".join(yaml_template_dataset.format(name=name, definition=definition, ext=ext, features_args=features_dataset_args, features_needs=features_dataset_needs) for name, definition in yaml_datasets.items())
+else:
+    yaml_dataset = ""
+    for name, definition in yaml_datasets.items():
+        shard_actions = []
+        for shard in range(args.dataset_shards):
+            output = shard_path(f"output/{definition}{ext}", shard, args.dataset_shards)
+            yaml_dataset += yaml_template_dataset_shard.format(
+                name=name, definition=definition, output=output, shard=shard, shards=args.dataset_shards,
+                features_args=features_format["features_args"], features_needs=features_dataset_needs,
+            )
+            shard_actions.append(f"{name}_shard_{shard}")
+        pattern = shard_path(f"output/{definition}{ext}", "*", args.dataset_shards)
+        yaml_dataset += yaml_template_dataset_merge.format(name=name, definition=definition, ext=ext, pattern=pattern, needs=", ".join(shard_actions))
+
+if args.sparse_cohort:
+    yaml_dataset += yaml_template_sparse_cohort.format(ext=ext)
+
 # Combine header, body, and footer
-generated_yaml = yaml_header + yaml_body + yaml_footer
+if args.features:
+    yaml_dataset = yaml_template_features.format(output=features_output) + yaml_dataset.lstrip("\n")
+
+generated_yaml = yaml_header.format(ext=ext) + yaml_dataset.lstrip("\n") + yaml_body + yaml_footer
+# Every definition reads the study end date (events, admissions and registrations up to it), so measures cover only months in the cohort
+if args.end_date != cohort_end_date:
+    generated_yaml = add_definition_args(generated_yaml, f"--end-date {args.end_date}")
+if args.instrument:
+    generated_yaml = instrument_actions(generated_yaml)
 
 # Save to a file
 with open("project.yaml", "w") as file:
-    file.write(generated_yaml)
\ No newline at end of file
+    file.write(generated_yaml)
+
+# Hash each action's inputs (definition source, codelists, parameters) and report which actions need to be rerun
+manifest = update_manifest(generated_yaml, diseases)
+rerun = [name for name, entry in manifest.items() if not entry["skippable"]]
+print(f"{len(rerun)} of {len(manifest)} actions have changed inputs or missing outputs (see action_manifest.json)")
+if rerun and len(rerun) < len(manifest):
+    print("opensafely run " + " ".join(rerun))
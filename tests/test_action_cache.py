@@ -0,0 +1,177 @@
+# Action cache (action_cache.py) on a small project: action hashes change with the run command, the script and its local imports,
+# the codelists of the action's diseases and the hashes of the outputs it reads, and an action is skippable only while its hash is
+# unchanged and its outputs are newer than the hash.
+
+import os
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+import action_cache
+from action_cache import action_blocks, action_hashes, add_definition_args, parse_actions, update_manifest
+
+project = """version: '4.0'
+
+actions:
+
+  generate_features:
+    run: ehrql:v1 generate-dataset analysis/dataset_definition_features.py
+      --output output/features.csv
+    outputs:
+      highly_sensitive:
+        dataset: output/features.csv
+
+  measures_asthma:
+    run: ehrql:v1 generate-measures analysis/dataset_definition_measures.py
+      --output output/measures_asthma.csv
+      --
+      --disease "asthma"
+    needs: [generate_features]
+    outputs:
+      moderately_sensitive:
+        measures: output/measures_asthma.csv
+
+  measures_copd:
+    run: ehrql:v1 generate-measures analysis/dataset_definition_measures.py
+      --output output/measures_copd.csv
+      --
+      --disease "copd"
+    outputs:
+      moderately_sensitive:
+        measures: output/measures_copd.csv
+
+  measures_copd_features:
+    run: ehrql:v1 generate-measures analysis/dataset_definition_measures.py
+      --output output/measures_copd_features.csv
+      --
+      --disease "copd"
+      --features output/features.csv
+    needs: [generate_features]
+    outputs:
+      moderately_sensitive:
+        measures: output/measures_copd_features.csv
+
+  process_measures:
+    run: python:v2 analysis/process.py
+    needs: [measures_asthma, measures_copd]
+    outputs:
+      moderately_sensitive:
+        table: output/tables/*.csv
+"""
+
+sources = {
+    "analysis/dataset_definition_features.py": "import helpers\n",
+    "analysis/dataset_definition_measures.py": "import helpers\nimport codelists_ehrQL\n",
+    "analysis/helpers.py": "index_date = '2016-04-01'\n",
+    "analysis/process.py": "import pandas\n",
+    "analysis/codelists_ehrQL.py": (
+        "from ehrql import codelist_from_csv\n"
+        "ethnicity_codes = codelist_from_csv('codelists/ethnicity.csv', column='code', category_column='group')\n"
+        "asthma_diag = codelist_from_csv('codelists/asthma_diag.csv', column='code')\n"
+        "asthma_emerg = codelist_from_csv('codelists/asthma_emerg.csv', column='code')\n"
+        "asthma_snomed = asthma_diag + asthma_emerg\n"
+        "copd_snomed = codelist_from_csv('codelists/copd.csv', column='code')\n"
+    ),
+    "codelists/ethnicity.csv": "code,group\n1,White\n",
+    "codelists/asthma_diag.csv": "code\n100\n",
+    "codelists/asthma_emerg.csv": "code\n101\n",
+    "codelists/copd.csv": "code\n200\n",
+}
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    for name, text in sources.items():
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text(text)
+    monkeypatch.chdir(tmp_path)
+    codelist_files = action_cache.codelist_files
+    monkeypatch.setattr(action_cache, "codelist_files", lambda: codelist_files(tmp_path / "analysis/codelists_ehrQL.py"))
+    monkeypatch.setattr(action_cache, "registry", {
+        "asthma": SimpleNamespace(codelists={"snomed": "asthma_snomed"}),
+        "copd": SimpleNamespace(codelists={"snomed": "copd_snomed"}),
+    })
+    action_cache.imported_modules.cache_clear()
+    yield tmp_path
+    action_cache.imported_modules.cache_clear()
+
+def hashes(text=project):
+    action_cache.imported_modules.cache_clear()
+    return action_hashes(parse_actions(text), ["asthma", "copd"])[0]
+
+# Actions whose hashes differ between two runs of hashes()
+def changed(before, after):
+    return sorted(name for name in before if before[name] != after[name])
+
+def test_parse_actions():
+    actions = parse_actions(project)
+    assert list(actions) == ["generate_features", "measures_asthma", "measures_copd", "measures_copd_features", "process_measures"]
+    assert actions["measures_asthma"]["run"].endswith('--output output/measures_asthma.csv -- --disease "asthma"')
+    assert actions["process_measures"]["needs"] == ["measures_asthma", "measures_copd"]
+    assert actions["process_measures"]["outputs"] == ["output/tables/*.csv"]
+
+def test_definition_args_added_to_ehrql_actions():
+    text = add_definition_args(project, "--end-date 2025-01-31")
+    blocks = action_blocks(text)[1]
+    assert blocks["generate_features"].count("\n      --\n      --end-date 2025-01-31") == 1
+    assert '--disease "asthma"\n      --end-date 2025-01-31' in blocks["measures_asthma"]
+    assert "--end-date" not in blocks["process_measures"]
+    # Actions already given the option keep their own value
+    assert add_definition_args(text, "--end-date 2025-02-28") == text
+
+def test_codelist_change_reruns_its_diseases_only(tree):
+    before = hashes()
+    (tree / "codelists/asthma_emerg.csv").write_text("code\n101\n102\n")
+    # The features table covers every disease, so it and the action reading it change; the copd measures without it do not
+    assert changed(before, hashes()) == ["generate_features", "measures_asthma", "measures_copd_features", "process_measures"]
+
+def test_shared_codelist_change_reruns_every_ehrql_action(tree):
+    before = hashes()
+    (tree / "codelists/ethnicity.csv").write_text("code,group\n1,White\n2,Asian\n")
+    assert changed(before, hashes()) == [
+        "generate_features", "measures_asthma", "measures_copd", "measures_copd_features", "process_measures",
+    ]
+
+def test_local_import_change_reruns_importing_actions_and_readers(tree):
+    before = hashes()
+    (tree / "analysis/helpers.py").write_text("index_date = '2017-04-01'\n")
+    assert changed(before, hashes()) == [
+        "generate_features", "measures_asthma", "measures_copd", "measures_copd_features", "process_measures",
+    ]
+
+def test_needs_only_feed_the_hash_when_their_outputs_are_read(tree):
+    before = hashes()
+    (tree / "analysis/dataset_definition_features.py").write_text("import helpers\nimport codelists_ehrQL\n")
+    # measures_asthma needs the features action (for ordering) but does not read its output
+    assert changed(before, hashes()) == ["generate_features", "measures_copd_features"]
+
+def test_run_command_change(tree):
+    before = hashes()
+    after = hashes(project.replace("analysis/process.py", "analysis/process.py --workers 2"))
+    assert changed(before, after) == ["process_measures"]
+
+def test_manifest_skippable_after_outputs_written(tree):
+    manifest = update_manifest(project, ["asthma", "copd"])
+    assert not any(entry["skippable"] for entry in manifest.values())
+
+    later = time.time() + 60
+    for output in ["output/features.csv", "output/measures_asthma.csv", "output/measures_copd.csv", "output/tables/asthma.csv"]:
+        (tree / output).parent.mkdir(parents=True, exist_ok=True)
+        (tree / output).write_text("")
+        os.utime(tree / output, (later, later))
+    manifest = update_manifest(project, ["asthma", "copd"])
+    assert {name: entry["skippable"] for name, entry in manifest.items()} == {
+        "generate_features": True, "measures_asthma": True, "measures_copd": True, "measures_copd_features": False,
+        "process_measures": True,
+    }
+
+    # A changed input makes the action and its readers rerun, even though their outputs exist
+    (tree / "codelists/copd.csv").write_text("code\n200\n201\n")
+    manifest = update_manifest(project, ["asthma", "copd"])
+    assert {name: entry["skippable"] for name, entry in manifest.items()} == {
+        "generate_features": False, "measures_asthma": True, "measures_copd": False, "measures_copd_features": False,
+        "process_measures": False,
+    }
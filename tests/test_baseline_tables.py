@@ -0,0 +1,92 @@
+# Streamed baseline tables (baseline_tables.py): running statistics merged chunk by chunk (Chan's parallel update) equal one-pass
+# statistics, and the accumulated counts do not depend on the chunk size.
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+from baseline_tables import (
+    RunningStats, accumulate, age_band_codes, build_tables, category_codes, imd_categories, n_codes, round_to, variables,
+)
+
+diseases = ["asthma", "copd"]
+
+@pytest.mark.parametrize("chunk_sizes", [[200], [1] * 200, [7, 0, 50, 1, 142]])
+def test_running_stats_equal_one_pass(chunk_sizes):
+    rng = np.random.default_rng(0)
+    values = rng.normal(50, 20, size=(200, 4))
+    values[rng.random(values.shape) < 0.3] = np.nan
+    values[:, 2] = np.nan
+    values[:199, 3] = np.nan
+    stats = RunningStats(4)
+    start = 0
+    for size in chunk_sizes:
+        stats.update(values[start:start + size])
+        start += size
+    assert stats.n.tolist() == (~np.isnan(values)).sum(axis=0).tolist()
+    with np.errstate(invalid="ignore"), pytest.warns(RuntimeWarning):
+        expected_mean = np.nan_to_num(np.nanmean(values, axis=0))
+        expected_sd = np.nanstd(values, axis=0, ddof=1)
+    np.testing.assert_allclose(stats.mean, expected_mean)
+    # Fewer than two values (no values, or one) have a missing SD, as Stata's collapse (sd)
+    np.testing.assert_allclose(stats.sd(), np.where(stats.n > 1, expected_sd, np.nan))
+
+def test_stata_rounding():
+    assert round_to([2.4, 2.5, 7.5, 12.49], 5).tolist() == [0, 5, 10, 10]
+
+def test_codes():
+    assert category_codes(pd.Series(["2", "Unknown", None, "6"]), imd_categories).tolist() == [1, 5, n_codes - 1, n_codes - 1]
+    assert age_band_codes(np.array([0, 9.9, 79.5, 80, 104, -1, np.nan]), 9).tolist() == [0, 0, 7, 8, 8, n_codes - 1, n_codes - 1]
+
+def cohort(patients=300, seed=1):
+    rng = np.random.default_rng(seed)
+    table = pd.DataFrame({
+        "sex": rng.choice(["female", "male", "unknown"], patients, p=[0.48, 0.48, 0.04]),
+        "age": rng.integers(0, 100, patients),
+        "ethnicity": rng.choice([*variables["ethnicity"][1], ""], patients),
+        "imd_quintile": rng.choice(imd_categories, patients),
+    })
+    for disease in diseases:
+        table[f"{disease}_inc_case"] = rng.choice(["T", "F"], patients)
+        table[f"{disease}_age"] = np.where(rng.random(patients) < 0.1, np.nan, rng.integers(-1, 100, patients))
+        table[f"{disease}_pre_reg"] = rng.choice(["T", "F", ""], patients, p=[0.8, 0.15, 0.05])
+        table[f"{disease}_alive_inc"] = rng.choice(["T", "F"], patients, p=[0.9, 0.1])
+    return table
+
+def test_counts_do_not_depend_on_chunk_size(tmp_path):
+    path = tmp_path / "dataset_definition_demographics_disease.csv"
+    cohort().to_csv(path, index=False)
+    whole = accumulate(path, diseases)
+    chunked = accumulate(path, diseases, chunk_size=7)
+    assert (whole.counts == chunked.counts).all()
+    assert (whole.rows == chunked.rows).all()
+    np.testing.assert_allclose(whole.age.mean, chunked.age.mean)
+    np.testing.assert_allclose(whole.age.sd(), chunked.age.sd())
+    for name in build_tables(whole):
+        pd.testing.assert_frame_equal(build_tables(whole)[name], build_tables(chunked)[name])
+
+def test_counts_equal_grouped_counts(tmp_path):
+    table = cohort()
+    path = tmp_path / "dataset_definition_demographics_disease.csv"
+    table.to_csv(path, index=False)
+    accumulated = accumulate(path, diseases)
+    known = table[table["sex"].isin(["female", "male"])]
+    gender = list(variables).index("gender")
+    imd = list(variables).index("imd")
+    assert accumulated.rows[0] == len(known)
+    assert accumulated.counts[0, gender, :2].tolist() == [(known["sex"] == "female").sum(), (known["sex"] == "male").sum()]
+    for index, disease in enumerate(diseases, start=1):
+        cases = known[
+            (known[f"{disease}_inc_case"] == "T") & (known[f"{disease}_age"] >= 0)
+            & (known[f"{disease}_pre_reg"] == "T") & (known[f"{disease}_alive_inc"] == "T")
+        ]
+        assert accumulated.rows[index] == len(cases)
+        assert accumulated.counts[index, imd, :len(imd_categories)].tolist() == [
+            (cases["imd_quintile"] == category).sum() for category in imd_categories
+        ]
+        assert accumulated.age.mean[index] == pytest.approx(cases[f"{disease}_age"].mean())
+        assert accumulated.age.sd()[index] == pytest.approx(cases[f"{disease}_age"].std())
@@ -0,0 +1,103 @@
+# Measures consolidation (consolidate_measures.py): the inputs chosen from a measures directory, and per-disease/year files in any
+# format consolidated into one table with disease and measure family parsed, written as a partitioned Parquet table and a Stata file.
+
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as parquet
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+import consolidate_measures
+from consolidate_measures import consolidate, measures_inputs, write_outputs
+
+header = "measure,interval_start,interval_end,ratio,numerator,denominator,sex,age,ethnicity,imd\n"
+files = {
+    "measures_dataset_asthma_2016.csv": (
+        "asthma_incidence,2016-04-01,2016-04-30,0.5,5,10,female,age_40_49,,\n"
+        "asthma_inc_imd,2016-04-01,2016-04-30,0.25,1,4,,,,2\n"
+    ),
+    "measures_dataset_asthma_2017.csv": "asthma_incidence,2017-04-01,2017-04-30,0.1,1,10,male,age_0_9,,\n",
+    "measures_dataset_heart_failure_2016.csv": "heart_failure_inc_ethn,2016-05-01,2016-05-31,,0,0,,,White,\n",
+}
+
+def write_files(directory):
+    directory.mkdir(exist_ok=True)
+    for name, rows in files.items():
+        (directory / name).write_text(header + rows)
+    return directory
+
+def test_inputs_per_disease_and_year(tmp_path):
+    directory = write_files(tmp_path / "measures")
+    assert [path.name for path in measures_inputs(directory)] == sorted(files)
+    assert [path.name for path in measures_inputs(directory, "asthma")] == [
+        "measures_dataset_asthma_2016.csv", "measures_dataset_asthma_2017.csv",
+    ]
+    assert measures_inputs(directory, "heart") == []
+
+def test_inputs_one_file_per_stem(tmp_path):
+    directory = write_files(tmp_path / "measures")
+    (directory / "measures_dataset_asthma_2016.arrow").write_bytes(b"")
+    (directory / "registrations.csv").write_text("")
+    assert len(measures_inputs(directory)) == len(files)
+
+def test_inputs_prefer_combined_output(tmp_path):
+    directory = write_files(tmp_path / "measures")
+    (directory / "measures_dataset.csv").write_text(header)
+    assert [path.name for path in measures_inputs(directory)] == ["measures_dataset.csv"]
+
+def test_consolidate_parses_measures(tmp_path):
+    measures = consolidate(measures_inputs(write_files(tmp_path / "measures")))
+    assert len(measures) == 4
+    assert measures[["disease", "measure_family"]].values.tolist() == [
+        ["asthma", "incidence"], ["asthma", "inc_imd"], ["asthma", "incidence"], ["heart_failure", "inc_ethn"],
+    ]
+    # Group values stay strings (IMD quintile "2" is not read as a number)
+    assert measures["imd"].tolist()[:2] == [pd.NA, "2"]
+
+def test_consolidate_any_format(tmp_path):
+    directory = write_files(tmp_path / "measures")
+    expected = consolidate(measures_inputs(directory))
+    arrow_directory = tmp_path / "arrow"
+    arrow_directory.mkdir()
+    for path in measures_inputs(directory):
+        table = pd.read_csv(path, dtype={column: "string" for column in ["sex", "age", "ethnicity", "imd"]})
+        for column in ["interval_start", "interval_end"]:
+            table[column] = pd.to_datetime(table[column]).dt.date
+        feather.write_feather(pa.Table.from_pandas(table, preserve_index=False), str(arrow_directory / f"{path.stem}.arrow"))
+    measures = consolidate(measures_inputs(arrow_directory))
+    for column in ["measure", "numerator", "denominator", "sex", "age", "ethnicity", "imd", "disease", "measure_family"]:
+        assert measures[column].astype(object).where(measures[column].notna(), None).tolist() == (
+            expected[column].astype(object).where(expected[column].notna(), None).tolist()
+        ), column
+    assert (measures["interval_start"].dt.date == expected["interval_start"].dt.date).all()
+
+def test_write_outputs(tmp_path, monkeypatch):
+    monkeypatch.setattr(consolidate_measures, "consolidated_dir", tmp_path / "data" / "measures_consolidated")
+    monkeypatch.setattr(consolidate_measures, "consolidated_dta", tmp_path / "data" / "measures_consolidated.dta")
+    write_outputs(consolidate(measures_inputs(write_files(tmp_path / "measures"))))
+
+    partitions = sorted(path.name for path in (tmp_path / "data" / "measures_consolidated").iterdir())
+    assert partitions == ["disease=asthma", "disease=heart_failure"]
+    asthma = parquet.read_table(tmp_path / "data" / "measures_consolidated" / "disease=asthma").to_pandas()
+    assert len(asthma) == 3
+
+    # The Stata file has the measures CSV columns and values, sorted by measure, interval and group
+    dta = pd.read_stata(tmp_path / "data" / "measures_consolidated.dta")
+    assert list(dta.columns) == header.strip().split(",")
+    assert dta[["measure", "interval_start", "imd"]].values.tolist() == [
+        ["asthma_inc_imd", "2016-04-01", "2"],
+        ["asthma_incidence", "2016-04-01", ""],
+        ["asthma_incidence", "2017-04-01", ""],
+        ["heart_failure_inc_ethn", "2016-05-01", ""],
+    ]
+    assert dta["numerator"].tolist() == [1, 5, 1, 0]
+
+def test_consolidate_rejects_unknown_measures(tmp_path):
+    directory = write_files(tmp_path / "measures")
+    (directory / "measures_dataset_asthma_2018.csv").write_text(header + "asthma_mortality,2018-04-01,2018-04-30,0,0,1,,,,\n")
+    with pytest.raises(ValueError, match="Unrecognised measure"):
+        consolidate(measures_inputs(directory))
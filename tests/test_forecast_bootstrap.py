@@ -0,0 +1,48 @@
+# Batched bootstrap forecasts (forecast_bootstrap.py): paths drawn as one array per model equal the step-by-step recursion of each
+# path, and window sums and quantiles are taken from the same paths.
+
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+from forecast_bootstrap import path_quantiles, psi_matrix, psi_weights, simulate_paths, window_matrix
+
+def test_psi_matrix():
+    assert psi_matrix(np.array([1.0, 0.5, 0.25])).tolist() == [[1.0, 0.0, 0.0], [0.5, 1.0, 0.0], [0.25, 0.5, 1.0]]
+
+def test_paths_equal_recursion():
+    psi = np.array([1.0, 0.8, 0.5, 0.3, 0.1])
+    mean = np.array([10.0, 11.0, 12.0, 13.0, 14.0])
+    residuals = np.array([-1.5, -0.2, 0.1, 0.4, 1.2])
+    paths = simulate_paths(mean, psi, residuals, 50, np.random.default_rng(3))
+
+    # The same innovations, propagated one path and step at a time
+    shocks = np.random.default_rng(3).choice(residuals, size=(50, len(psi)))
+    expected = np.array([
+        [mean[step] + sum(psi[step - lag] * path_shocks[lag] for lag in range(step + 1)) for step in range(len(psi))]
+        for path_shocks in shocks
+    ])
+    np.testing.assert_allclose(paths, expected)
+
+def test_windows_and_quantiles():
+    windows = window_matrix(5, [(0, 2), (2, 5), (0, 5)])
+    assert windows.tolist() == [[1, 1, 0, 0, 0], [0, 0, 1, 1, 1], [1, 1, 1, 1, 1]]
+    paths = np.arange(100 * 5, dtype=float).reshape(100, 5)
+    sums = paths @ windows.T
+    np.testing.assert_allclose(sums[:, 2], paths.sum(axis=1))
+    low, high = path_quantiles(sums)
+    np.testing.assert_allclose(low, np.quantile(sums, 0.025, axis=0))
+    np.testing.assert_allclose(high, np.quantile(sums, 0.975, axis=0))
+
+def test_psi_weights_include_differencing():
+    pytest.importorskip("statsmodels")
+    ar1 = SimpleNamespace(polynomial_reduced_ar=np.array([1.0, -0.5]), polynomial_reduced_ma=np.array([1.0]))
+    np.testing.assert_allclose(psi_weights(ar1, (1, 0, 0), (0, 0, 0), 12, 4), [1, 0.5, 0.25, 0.125])
+    # A first difference integrates the AR(1) weights; a seasonal difference repeats each innovation every season
+    np.testing.assert_allclose(psi_weights(ar1, (1, 1, 0), (0, 0, 0), 12, 4), [1, 1.5, 1.75, 1.875])
+    white_noise = SimpleNamespace(polynomial_reduced_ar=np.array([1.0]), polynomial_reduced_ma=np.array([1.0]))
+    np.testing.assert_allclose(psi_weights(white_noise, (0, 0, 0), (0, 1, 0), 3, 7), [1, 0, 0, 1, 0, 0, 1])
@@ -0,0 +1,181 @@
+# Closed-form interval measures (interval_measures.py) against a direct evaluation of the definitions of
+# dataset_definition_measures.py at every interval start, on a small cohort with registration spells, births, deaths and diagnoses on
+# and around interval boundaries.
+
+import sys
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+from interval_measures import (
+    add_months, age_band_codes, age_bands, compute_measures, covered, first_interval_on_or_after, last_interval_before,
+    last_interval_on_or_before,
+)
+
+start_date = date(2016, 4, 1)
+first_month = 2016 * 12 + 3
+intervals = 24
+diseases = ["asthma", "copd"]
+families = ["prevalence", "incidence", "inc_ethn", "inc_imd"]
+
+def test_interval_indices_at_month_boundaries():
+    dates = ["2016-04-01", "2016-04-02", "2016-04-30", "2016-05-01", None]
+    assert list(first_interval_on_or_after(dates, first_month)[:4]) == [0, 1, 1, 1]
+    assert np.isnan(first_interval_on_or_after(dates, first_month)[4])
+    # A spell ending on an interval start still covers it for current registration, but not for 12-month preceding registration
+    assert list(last_interval_on_or_before(dates, first_month, intervals)) == [0, 0, 0, 1, intervals - 1]
+    assert list(last_interval_before(dates, first_month, intervals)) == [-1, 0, 0, 0, intervals - 1]
+
+def test_covered_merges_ranges_per_patient():
+    patient = np.array([0, 0, 1, 2, 2])
+    first = np.array([0, 3, np.nan, 5, -4])
+    last = np.array([1, 4, 2, 2, 20])
+    mask = covered(patient, first, last, 3, 6)
+    assert mask.tolist() == [
+        [True, True, False, True, True, False],
+        [False] * 6,
+        [True] * 6,
+    ]
+
+def test_age_bands_at_birthdays():
+    # Tenth birthday on the first interval start (counted from that interval), the day after it, and no date of birth
+    codes = age_band_codes(["2006-04-01", "2006-04-02", None], first_month, 13)
+    assert codes[0].tolist() == [1] * 13
+    assert codes[1].tolist() == [0] + [1] * 12
+    assert codes[2].tolist() == [-1] * 13
+
+# Cohort covering the edge cases of each condition: spells starting and ending on and around interval starts, exactly 12 months of
+# preceding registration, overlapping and gapped spells, deaths on an interval start, births during the study and resolved diagnoses
+cohort = pd.DataFrame([
+    # patient_id, sex, date_of_death, ethnicity, imd_quintile, asthma (inc, resolved date, resolved, pre_reg, alive_inc), copd (...)
+    (1, "female", None, "White", "1", "2016-05-01", None, False, True, True, None, None, False, False, False),
+    (2, "male", "2017-01-01", "Asian", "5", "2016-09-15", "2016-12-01", True, True, True, "2015-01-01", None, False, True, True),
+    (3, "female", None, None, "3", "2017-04-30", None, False, False, True, "2017-06-01", "2017-06-02", True, True, True),
+    (4, "male", None, "White", None, None, None, False, False, False, "2016-04-01", None, False, True, True),
+    (5, "female", "2016-10-20", "Black", "2", "2016-10-01", None, False, True, False, None, None, False, False, False),
+    (6, "male", None, "Asian", "1", "2017-11-30", None, False, True, True, None, None, False, False, False),
+    (7, "unknown", None, "White", "4", "2016-06-01", None, False, True, True, None, None, False, False, False),
+    (8, "female", None, "Mixed", "2", None, None, False, False, False, "2016-07-10", "2016-07-10", True, True, True),
+], columns=[
+    "patient_id", "sex", "date_of_death", "ethnicity", "imd_quintile",
+    "asthma_inc_date", "asthma_resolved_date", "asthma_resolved", "asthma_pre_reg", "asthma_alive_inc",
+    "copd_inc_date", "copd_resolved_date", "copd_resolved", "copd_pre_reg", "copd_alive_inc",
+])
+births = pd.DataFrame({
+    "patient_id": range(1, 9),
+    "date_of_birth": ["1980-04-01", "1950-04-02", "2016-06-15", "1975-12-01", "1990-01-01", None, "1960-03-01", "2005-04-01"],
+})
+spells = pd.DataFrame([
+    (1, "2010-01-01", None),
+    (2, "2015-04-01", "2016-09-01"),
+    (2, "2016-09-01", None),
+    (3, "2016-06-15", "2017-04-01"),
+    (3, "2017-04-02", None),
+    (4, "2015-05-01", "2017-05-01"),
+    (5, "2014-01-01", None),
+    (6, "2016-11-02", "2018-02-28"),
+    (7, "2000-01-01", None),
+    (8, "2015-07-01", "2016-08-01"),
+    (8, "2016-10-01", "2017-10-01"),
+], columns=["patient_id", "start_date", "end_date"])
+
+def parse(value):
+    return None if value is None or pd.isna(value) else date.fromisoformat(value)
+
+def age_on(date_of_birth, day):
+    return day.year - date_of_birth.year - ((day.month, day.day) < (date_of_birth.month, date_of_birth.day))
+
+def age_band(date_of_birth, day):
+    if date_of_birth is None or age_on(date_of_birth, day) < 0:
+        return None
+    age = age_on(date_of_birth, day)
+    return [name for name, lowest in age_bands if age >= lowest][-1]
+
+# Numerator and denominator of every measure cell, evaluating the ehrQL definitions patient by patient at each interval start
+def expected_cells():
+    cells = {}
+    birth_dates = dict(zip(births["patient_id"], births["date_of_birth"].map(parse)))
+    patient_spells = {
+        patient_id: [(parse(start), parse(end)) for _, start, end in rows.itertuples(index=False)]
+        for patient_id, rows in spells.groupby("patient_id")
+    }
+    for interval in range(intervals):
+        index_date = add_months(start_date, interval)
+        interval_end = add_months(index_date, 1) - timedelta(days=1)
+        patients = []
+        for patient in cohort.itertuples(index=False):
+            patient = patient._asdict()
+            registrations = patient_spells.get(patient["patient_id"], [])
+            band = age_band(birth_dates[patient["patient_id"]], index_date)
+            death = parse(patient["date_of_death"])
+            age_sex_known = band is not None and patient["sex"] in ("male", "female")
+            alive = death is None or death > index_date
+            current = any(start <= index_date and (end is None or end >= index_date) for start, end in registrations)
+            preceding = any(
+                start <= add_months(index_date, -12) and (end is None or end > index_date) for start, end in registrations
+            )
+            status = {"patient": patient, "band": band, "prevalence_denominator": age_sex_known and alive and current}
+            for disease in diseases:
+                inc_date, resolved_date = parse(patient[f"{disease}_inc_date"]), parse(patient[f"{disease}_resolved_date"])
+                resolved = patient[f"{disease}_resolved"]
+                prevalent = inc_date is not None and inc_date < index_date and (not resolved or resolved_date > index_date)
+                incident = inc_date is not None and index_date <= inc_date <= interval_end
+                status[disease] = {
+                    "prevalent": prevalent,
+                    "incidence_denominator": not prevalent and age_sex_known and alive and preceding,
+                    "incidence_numerator": (
+                        incident and patient[f"{disease}_pre_reg"] and patient[f"{disease}_alive_inc"] and age_sex_known
+                    ),
+                }
+            patients.append(status)
+        population = [any(status[disease]["incidence_denominator"] for disease in diseases) for status in patients]
+
+        for disease in diseases:
+            for family in families:
+                if family == "prevalence" and interval % 12:
+                    continue
+                for status, in_population in zip(patients, population):
+                    patient = status["patient"]
+                    group = {
+                        "prevalence": (patient["sex"], status["band"]),
+                        "incidence": (patient["sex"], status["band"]),
+                        "inc_ethn": (patient["ethnicity"],),
+                        "inc_imd": (patient["imd_quintile"],),
+                    }[family]
+                    if any(value is None or pd.isna(value) for value in group) or patient["sex"] not in ("male", "female"):
+                        continue
+                    if family == "prevalence":
+                        denominator = status["prevalence_denominator"]
+                        numerator = status[disease]["prevalent"] and denominator
+                    else:
+                        denominator = status[disease]["incidence_denominator"]
+                        numerator = status[disease]["incidence_numerator"] and in_population
+                    key = (f"{disease}_{family}", index_date.isoformat(), *group)
+                    counts = cells.get(key, (0, 0))
+                    cells[key] = (counts[0] + int(numerator), counts[1] + int(denominator))
+    return {key: counts for key, counts in cells.items() if counts != (0, 0)}
+
+def computed_cells(rows):
+    group_columns = {"prevalence": ["sex", "age"], "incidence": ["sex", "age"], "inc_ethn": ["ethnicity"], "inc_imd": ["imd"]}
+    cells = {}
+    for row in rows:
+        family = next(family for family in families if row["measure"].endswith(f"_{family}"))
+        key = (row["measure"], row["interval_start"], *(row[column] for column in group_columns[family]))
+        cells[key] = (row["numerator"], row["denominator"])
+    return cells
+
+@pytest.mark.parametrize("chunk_size", [100000, 3])
+def test_measures_match_direct_evaluation(monkeypatch, chunk_size):
+    import interval_measures
+
+    monkeypatch.setattr(interval_measures, "chunk_size", chunk_size)
+    rows = compute_measures(cohort, births, spells, diseases, families, start_date, intervals)
+    assert computed_cells(rows) == expected_cells()
+
+def test_prevalence_intervals_are_financial_years():
+    rows = compute_measures(cohort, births, spells, ["asthma"], ["prevalence"], start_date, intervals)
+    assert {(row["interval_start"], row["interval_end"]) for row in rows} == {("2016-04-01", "2017-03-31"), ("2017-04-01", "2018-03-31")}
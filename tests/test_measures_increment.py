@@ -0,0 +1,64 @@
+# Incremental measures refresh (measures_increment.py): increment rows merged into the pinned base measures replace the base rows of
+# the same measure, interval and group, and a base that stops before the day before --since is rejected.
+
+import sys
+from datetime import date
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+from disease_registry import split_measure
+from measures_increment import existing_coverage, merge_increments, read_rows
+
+header = "measure,interval_start,interval_end,ratio,numerator,denominator,sex,age\n"
+base = (
+    "asthma_prevalence,2024-04-01,2025-03-31,0.1,10,100,,\n"
+    "asthma_incidence,2024-10-01,2024-10-31,0.01,1,100,female,age_40_49\n"
+    "asthma_incidence,2024-11-01,2024-11-30,0.02,2,100,female,age_40_49\n"
+    "copd_incidence,2024-11-01,2024-11-30,0.03,3,100,male,age_60_69\n"
+)
+# The new month, and the financial year prevalence recomputed with it
+increment = (
+    "asthma_prevalence,2024-04-01,2025-03-31,0.12,12,100,,\n"
+    "asthma_incidence,2024-12-01,2024-12-31,0.04,4,100,female,age_40_49\n"
+    "copd_incidence,2024-12-01,2024-12-31,0.05,5,100,male,age_60_69\n"
+)
+
+def write(path, rows):
+    path.write_text(header + rows)
+    return path
+
+def test_split_measure():
+    assert split_measure("heart_failure_inc_imd") == ("heart_failure", "inc_imd")
+    assert split_measure("asthma_prevalence") == ("asthma", "prevalence")
+    with pytest.raises(ValueError, match="Unrecognised measure"):
+        split_measure("asthma_mortality")
+
+def test_coverage_ignores_prevalence(tmp_path):
+    assert existing_coverage([write(tmp_path / "base.csv", base)]) == {"asthma": date(2024, 11, 30), "copd": date(2024, 11, 30)}
+
+def test_merge_replaces_and_appends_rows(tmp_path):
+    output = tmp_path / "refreshed" / "measures_dataset.csv"
+    merge_increments(
+        date(2024, 12, 1), write(tmp_path / "base.csv", base), [write(tmp_path / "increment.csv", increment)], output
+    )
+    fieldnames, rows = read_rows(output)
+    assert fieldnames == header.strip().split(",")
+    # Rows stay grouped by measure in first-seen order, by interval within each measure
+    assert [(row["measure"], row["interval_start"], row["numerator"]) for row in rows] == [
+        ("asthma_prevalence", "2024-04-01", "12"),
+        ("asthma_incidence", "2024-10-01", "1"),
+        ("asthma_incidence", "2024-11-01", "2"),
+        ("asthma_incidence", "2024-12-01", "4"),
+        ("copd_incidence", "2024-11-01", "3"),
+        ("copd_incidence", "2024-12-01", "5"),
+    ]
+
+def test_merge_rejects_base_with_gap(tmp_path):
+    # The copd measures of the base stop a month before the day before --since
+    gap = base.replace("copd_incidence,2024-11-01,2024-11-30", "copd_incidence,2024-10-01,2024-10-31")
+    output = tmp_path / "measures_dataset.csv"
+    with pytest.raises(ValueError, match="does not cover copd up to 2024-11-30"):
+        merge_increments(date(2024, 12, 1), write(tmp_path / "base.csv", gap), [write(tmp_path / "increment.csv", increment)], output)
+    assert not output.exists()
@@ -0,0 +1,81 @@
+# Reduce step of measures_shards.py: per-month and per-family shards of two diseases recombine into the per-disease/year files a single
+# measures action writes (same columns, rows and order), whether reduced together or one disease at a time.
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+from measures_increment import read_rows, write_rows
+from measures_shards import layout_columns, reduce_shards, shard_path
+
+diseases = ["asthma", "copd"]
+year = 2016
+months = ["2016-04-01", "2016-05-01", "2016-06-01"]
+family_groups = {
+    "prevalence": [{"sex": "female", "age": "age_40_49"}, {"sex": "male", "age": "age_40_49"}],
+    "incidence": [{"sex": "female", "age": "age_40_49"}, {"sex": "male", "age": "age_50_59"}],
+    "inc_ethn": [{"ethnicity": "White"}, {"ethnicity": "Asian"}],
+    "inc_imd": [{"imd": "1 (most deprived)"}, {"imd": "5 (least deprived)"}],
+}
+
+# Rows of one disease's measures over the months, in the order a single measures action writes them (measure family, then interval)
+def unsharded_rows(disease):
+    rows = []
+    for family, groups in family_groups.items():
+        for month_index, start in enumerate(months):
+            for group_index, group in enumerate(groups):
+                numerator = 10 * month_index + group_index + 1
+                rows.append({
+                    "measure": f"{disease}_{family}", "interval_start": start, "interval_end": start, "ratio": str(numerator / 100),
+                    "numerator": str(numerator), "denominator": "100", **group,
+                })
+    return rows
+
+def write_shards(directory, by):
+    directory.mkdir()
+    for disease in diseases:
+        rows = unsharded_rows(disease)
+        if by == "month":
+            for start in months:
+                label = start[:7].replace("-", "_")
+                write_rows(
+                    shard_path(disease, year, label, directory), layout_columns(family_groups),
+                    [row for row in rows if row["interval_start"] == start],
+                )
+        else:
+            for family in family_groups:
+                write_rows(
+                    shard_path(disease, year, family, directory), layout_columns([family]),
+                    [row for row in rows if row["measure"] == f"{disease}_{family}"],
+                )
+
+def expected_file(disease):
+    return layout_columns(family_groups), [{column: row.get(column, "") for column in layout_columns(family_groups)} for row in unsharded_rows(disease)]
+
+@pytest.mark.parametrize("by", ["month", "family"])
+def test_reduce_equals_unsharded(tmp_path, by):
+    write_shards(tmp_path / "shards", by)
+    output_dir = tmp_path / "measures"
+    output_dir.mkdir()
+    written = reduce_shards(tmp_path / "shards", output_dir)
+    assert sorted(written) == [output_dir / f"measures_dataset_{disease}_{year}.csv" for disease in diseases]
+    for disease in diseases:
+        fieldnames, rows = read_rows(output_dir / f"measures_dataset_{disease}_{year}.csv")
+        assert (fieldnames, rows) == expected_file(disease)
+
+@pytest.mark.parametrize("disease", diseases)
+def test_reduce_one_disease(tmp_path, disease):
+    write_shards(tmp_path / "shards", "month")
+    output_dir = tmp_path / "measures"
+    output_dir.mkdir()
+    assert list(reduce_shards(tmp_path / "shards", output_dir, disease)) == [output_dir / f"measures_dataset_{disease}_{year}.csv"]
+    assert read_rows(output_dir / f"measures_dataset_{disease}_{year}.csv") == expected_file(disease)
+
+def test_reduce_rejects_cell_in_two_shards(tmp_path):
+    write_shards(tmp_path / "shards", "month")
+    rows = [row for row in unsharded_rows("asthma") if row["interval_start"] == months[0]]
+    write_rows(shard_path("asthma", year, "copy", tmp_path / "shards"), layout_columns(family_groups), rows)
+    with pytest.raises(ValueError, match="is in shards"):
+        reduce_shards(tmp_path / "shards", tmp_path)
@@ -0,0 +1,72 @@
+# Merging of patient-sharded cohort outputs (patient_shards.py): shards written as ehrQL writes them (sorted by patient_id) merge
+# into the rows and order of a single extraction.
+
+import sys
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.feather as feather
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+from patient_shards import merge, shard_path
+
+header = "patient_id,sex,asthma_inc_date\n"
+rows = [f"{patient_id},{'female' if patient_id % 2 else 'male'},2019-0{patient_id % 9 + 1}-01\n" for patient_id in range(1, 41)]
+
+# Rows of one shard (patients by patient_id modulo shards, as an ehrQL output sorted by patient_id)
+def shard_rows(shard, shards):
+    return [row for row in rows if int(row.split(",")[0]) % shards == shard]
+
+def write_csv_shards(directory, shards, terminator="\n"):
+    paths = []
+    for shard in range(shards):
+        path = directory / f"dataset_{shard}_of_{shards}.csv"
+        path.write_bytes("".join([header, *shard_rows(shard, shards)]).replace("\n", terminator).encode())
+        paths.append(path)
+    return paths
+
+def test_shard_path():
+    assert shard_path("output/dataset_definition.csv.gz", 1, 4) == Path("output/shards/dataset_definition_1_of_4.csv.gz")
+
+@pytest.mark.parametrize("shards", [1, 3, 7])
+def test_csv_merge_equals_single_extraction(tmp_path, shards):
+    output = tmp_path / "merged" / "dataset.csv"
+    assert merge(output, write_csv_shards(tmp_path, shards)) == len(rows)
+    assert output.read_text() == "".join([header, *rows])
+
+def test_csv_merge_keeps_line_terminators(tmp_path):
+    output = tmp_path / "dataset.csv"
+    merge(output, write_csv_shards(tmp_path, 3, terminator="\r\n"))
+    assert output.read_bytes() == "".join([header, *rows]).replace("\n", "\r\n").encode()
+
+def test_csv_merge_keeps_empty_shards(tmp_path):
+    paths = write_csv_shards(tmp_path, 3)
+    empty = tmp_path / "dataset_3_of_4.csv"
+    empty.write_text(header)
+    output = tmp_path / "dataset.csv"
+    assert merge(output, [*paths, empty]) == len(rows)
+    assert output.read_text() == "".join([header, *rows])
+
+def test_csv_merge_rejects_different_columns(tmp_path):
+    paths = write_csv_shards(tmp_path, 2)
+    paths[1].write_text("patient_id,sex\n2,male\n")
+    with pytest.raises(ValueError, match="different columns"):
+        merge(tmp_path / "dataset.csv", paths)
+
+def test_merge_without_shards(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        merge(tmp_path / "dataset.csv", [])
+
+def test_arrow_merge_orders_by_patient_id(tmp_path):
+    paths = []
+    for shard in range(3):
+        patient_ids = [patient_id for patient_id in range(1, 41) if patient_id % 3 == shard]
+        path = tmp_path / f"dataset_{shard}_of_3.arrow"
+        feather.write_feather(pa.table({"patient_id": patient_ids, "age": [patient_id * 2 for patient_id in patient_ids]}), path)
+        paths.append(path)
+    output = tmp_path / "dataset.arrow"
+    assert merge(output, paths) == 40
+    merged = feather.read_table(output)
+    assert merged.column("patient_id").to_pylist() == list(range(1, 41))
+    assert merged.column("age").to_pylist() == [patient_id * 2 for patient_id in range(1, 41)]
@@ -0,0 +1,102 @@
+# Output reader shim (read_outputs.py): a cohort written as CSV, gzipped CSV, Arrow and Parquet reads back as the same typed frame,
+# whole or in chunks, and converts to the Stata values of the CSV output.
+
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as parquet
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+from read_outputs import output_files, output_path, read_chunks, read_table, stata_frame, table_format, to_dta
+
+string_columns = ["sex", "imd_quintile"]
+
+# Cohort as ehrQL writes it to CSV (booleans as T/F, dates as YYYY-MM-DD, missing values empty)
+csv_text = """patient_id,sex,imd_quintile,age,asthma_inc_date,asthma_resolved,date_of_death
+1,female,1 (most deprived),34,2018-02-01,T,
+2,male,2,,,F,2020-05-06
+3,female,5 (least deprived),81,2016-04-01,F,
+4,male,,7,,,
+"""
+
+def arrow_table():
+    return pa.table({
+        "patient_id": pa.array([1, 2, 3, 4], pa.int64()),
+        "sex": ["female", "male", "female", "male"],
+        "imd_quintile": ["1 (most deprived)", "2", "5 (least deprived)", None],
+        "age": pa.array([34, None, 81, 7], pa.int64()),
+        "asthma_inc_date": pa.array([pd.Timestamp("2018-02-01").date(), None, pd.Timestamp("2016-04-01").date(), None], pa.date32()),
+        "asthma_resolved": [True, False, False, None],
+        "date_of_death": pa.array([None, pd.Timestamp("2020-05-06").date(), None, None], pa.date32()),
+    })
+
+def write_output(path):
+    output_format = table_format(path)
+    if output_format == "csv":
+        path.write_text(csv_text)
+    elif output_format == "csv.gz":
+        import gzip
+
+        path.write_bytes(gzip.compress(csv_text.encode()))
+    elif output_format == "arrow":
+        feather.write_feather(arrow_table(), str(path))
+    else:
+        parquet.write_table(arrow_table(), str(path))
+    return path
+
+formats = ["csv", "csv.gz", "arrow", "parquet"]
+
+# Values of a table for comparison across formats: dates at one resolution (Arrow dates read back as milliseconds), and missing values
+# as None whether read as NaN (CSV) or null (Arrow)
+def comparable(table):
+    table = table.apply(lambda values: values.astype("datetime64[ns]") if pd.api.types.is_datetime64_any_dtype(values) else values)
+    return table.astype(object).where(table.notna(), None)
+
+def test_output_paths(tmp_path):
+    assert output_path("output/measures/measures_dataset", "arrow") == "output/measures/measures_dataset.arrow"
+    assert [table_format(f"cohort.{extension}") for extension in ["csv", "csv.gz", "arrow", "parquet", "dta"]] == [*formats, None]
+    for output_format in formats:
+        write_output(Path(output_path(tmp_path / "cohort", output_format)))
+    (tmp_path / "cohort.dta").write_text("")
+    assert [path.name for path in output_files([tmp_path])] == ["cohort.arrow", "cohort.csv", "cohort.csv.gz", "cohort.parquet"]
+
+@pytest.mark.parametrize("output_format", formats[1:])
+def test_formats_read_as_csv(tmp_path, output_format):
+    expected = read_table(write_output(tmp_path / "cohort.csv"), string_columns=string_columns)
+    table = read_table(write_output(Path(output_path(tmp_path / "cohort", output_format))), string_columns=string_columns)
+    pd.testing.assert_frame_equal(comparable(expected), comparable(table))
+
+def test_csv_column_types(tmp_path):
+    table = read_table(write_output(tmp_path / "cohort.csv"), string_columns=string_columns)
+    assert pd.api.types.is_datetime64_any_dtype(table["asthma_inc_date"])
+    assert pd.api.types.is_datetime64_any_dtype(table["date_of_death"])
+    assert table["asthma_resolved"].tolist()[:3] == [True, False, False]
+    # String columns are never inferred as numbers (IMD quintile "2" stays a string)
+    assert table["imd_quintile"].tolist()[:3] == ["1 (most deprived)", "2", "5 (least deprived)"]
+
+@pytest.mark.parametrize("output_format", formats)
+def test_chunks_equal_whole_table(tmp_path, output_format):
+    path = write_output(Path(output_path(tmp_path / "cohort", output_format)))
+    columns = ["patient_id", "sex", "asthma_inc_date"]
+    whole = read_table(path, columns=columns, string_columns=["sex"])
+    chunks = pd.concat(list(read_chunks(path, chunk_size=3, columns=columns, string_columns=["sex"])), ignore_index=True)
+    pd.testing.assert_frame_equal(whole, chunks, check_dtype=False)
+
+@pytest.mark.parametrize("output_format", formats)
+def test_stata_values_match_csv(tmp_path, output_format):
+    path = write_output(Path(output_path(tmp_path / "cohort", output_format)))
+    expected = pd.read_csv(write_output(tmp_path / "cohort.csv"), dtype=str, keep_default_na=False)
+    frame = stata_frame(read_table(path, string_columns=string_columns))
+    for column in ["sex", "imd_quintile", "asthma_inc_date", "asthma_resolved", "date_of_death"]:
+        assert frame[column].tolist() == expected[column].tolist(), column
+
+def test_to_dta(tmp_path):
+    dta_path = to_dta(write_output(tmp_path / "cohort.arrow"))
+    assert dta_path == tmp_path / "cohort.dta"
+    dta = pd.read_stata(dta_path)
+    assert dta["asthma_inc_date"].tolist() == ["2018-02-01", "", "2016-04-01", ""]
+    assert dta["asthma_resolved"].tolist() == ["T", "F", "F", ""]
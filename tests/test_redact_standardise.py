@@ -0,0 +1,21 @@
+# Redaction, rounding and standardisation of redact_standardise.py against redacted_counts files expected from 002_processing_data.do.
+#
+# fixtures/redact_standardise/measures_dataset.csv: asthma incidence (April and May 2020, with the male counts redacted in April, the
+# female counts in May, and a different ethnicity and IMD group redacted in each month), asthma prevalence (financial year 2020,
+# one age and sex group redacted) and rheumatoid incidence (every count redacted, including the overall counts).
+# fixtures/redact_standardise/redacted_counts_{disease}.csv: the tables expected from it, derived by following each step of
+# 002_processing_data.do by hand. They have not been checked against a Stata run; once the do-file has been run on the fixture, its
+# tables should replace these.
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+from consolidate_measures import consolidate
+from redact_standardise import compare_tables, prepared, process
+
+fixtures_dir = Path(__file__).parent / "fixtures" / "redact_standardise"
+
+def test_process_matches_expected_tables():
+    measures = prepared(consolidate([fixtures_dir / "measures_dataset.csv"]))
+    assert compare_tables(process(measures), fixtures_dir) == []
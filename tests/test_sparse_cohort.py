@@ -0,0 +1,82 @@
+# Sparse cohort layout (sparse_cohort.py): a wide cohort output split into the patient and long disease tables reads back (through
+# read_outputs.read_table on the cohort directory) as the wide output, in CSV and Arrow.
+
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+from read_outputs import read_table
+from sparse_cohort import split
+
+diseases = ["asthma", "copd"]
+string_columns = ["sex", "ethnicity", "imd_quintile"]
+
+# Wide cohort as ehrQL writes it: patients with no codes, a diagnosis, a resolved diagnosis, a death with and without a diagnosis, and
+# flags that differ from their defaults without any date
+wide = pd.DataFrame({
+    "patient_id": [1, 2, 3, 4, 5, 6],
+    "sex": ["female", "male", "female", "male", "female", "male"],
+    "date_of_death": [None, None, "2019-03-02", None, "2021-01-15", None],
+    "registration_start": ["2010-01-01", "2015-06-01", "2001-02-03", "2016-04-01", "1999-09-09", "2012-12-12"],
+    "ethnicity": ["White", "Asian or Asian British", None, "Mixed", "Unknown", "White"],
+    "imd_quintile": ["1 (most deprived)", "2", "Unknown", "5 (least deprived)", "3", "4"],
+    "asthma_resolved_date": [None, "2018-05-01", None, None, None, None],
+    "asthma_inc_date": [None, "2017-02-10", "2018-11-30", None, None, None],
+    "asthma_pre_reg": [False, True, True, False, False, True],
+    "asthma_alive_inc": [True, True, True, True, False, True],
+    "asthma_resolved": [False, True, False, False, False, False],
+    "copd_resolved_date": [None, None, None, None, None, None],
+    "copd_inc_date": [None, None, None, "2020-07-07", "2020-12-01", None],
+    "copd_pre_reg": [False, False, False, True, True, False],
+    "copd_alive_inc": [True, True, False, True, True, True],
+    "copd_resolved": [False, False, False, False, False, True],
+})
+date_columns = [column for column in wide.columns if column.endswith("_date") or column in ("date_of_death", "registration_start")]
+
+def write_wide(path):
+    if path.suffix == ".arrow":
+        table = wide.copy()
+        for column in date_columns:
+            table[column] = pd.to_datetime(table[column]).dt.date
+        feather.write_feather(pa.Table.from_pandas(table, preserve_index=False), str(path))
+    else:
+        table = wide.copy()
+        for column in table.columns:
+            if table[column].dtype == bool:
+                table[column] = table[column].map({True: "T", False: "F"})
+        table.to_csv(path, index=False)
+
+@pytest.mark.parametrize("extension", [".csv", ".arrow"])
+def test_sparse_layout_reads_back_as_wide(tmp_path, extension):
+    path = tmp_path / f"dataset_definition{extension}"
+    write_wide(path)
+    (patients_path, diseases_path), rows_in, rows_out = split(path, tmp_path / "cohort", diseases)
+    assert patients_path.name == f"patients{extension}"
+    assert rows_in == len(wide)
+
+    # Only patients with a date or a flag differing from its default have a disease row (not alive at diagnosis is the default after
+    # a death)
+    long = read_table(diseases_path, string_columns=["disease"])
+    assert list(zip(long["patient_id"], long["disease"])) == [
+        (2, "asthma"), (3, "asthma"), (4, "copd"), (5, "copd"), (6, "asthma"), (6, "copd"),
+    ]
+    assert rows_out == len(wide) + len(long)
+
+    expected = read_table(path, string_columns=string_columns)
+    sparse = read_table(tmp_path / "cohort", list(expected.columns), string_columns=string_columns)
+    pd.testing.assert_frame_equal(expected, sparse[list(expected.columns)], check_dtype=False, check_categorical=False)
+
+def test_sparse_layout_reads_selected_columns(tmp_path):
+    path = tmp_path / "dataset_definition.csv"
+    write_wide(path)
+    split(path, tmp_path / "cohort", diseases)
+    columns = ["patient_id", "copd_alive_inc", "asthma_inc_date"]
+    sparse = read_table(tmp_path / "cohort", columns)
+    assert sorted(sparse.columns) == sorted(columns)
+    expected = read_table(path, columns)
+    pd.testing.assert_frame_equal(expected, sparse[list(expected.columns)], check_dtype=False)